@@ -16,6 +16,8 @@ import { ErrorHandler, NetworkError, ResponseError } from './ErrorHandler';
 import { Prompts } from './Prompts';
 
 const LOCAL_SERVER_BASE_URL = 'http://127.0.0.1:5000/';
+// Images committed one by one reload the page at most this often
+const IMAGE_RELOAD_INTERVAL_MS = 2000;
 const generateGUID = () => {
   return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function (c) {
     const r = (Math.random() * 16) | 0,
@@ -259,36 +261,6 @@ function App() {
     }
   };
 
-  const pollForImages = async (sessionId: string, iframeUrl: string) => {
-    const intervalId = setInterval(async () => {
-      try {
-        const response = await fetch(LOCAL_SERVER_BASE_URL + `image_readycheck/${sessionId}`, {
-          method: 'GET',
-        });
-
-        // Check if the response is not OK and throw a custom error
-        if (!response.ok) {
-          throw new ResponseError(response.status, response.statusText);
-        }
-
-        const data = await response.json();
-        if (data.images_ready) {
-          clearInterval(intervalId);
-          setTimeout(() => {
-            setIframeUrl(`${iframeUrl}?t=${new Date().getTime()}`);
-          }, 1000);
-        }
-      } catch (error) {
-        ErrorHandler.handleError(error, "Failing to get an image response from Dalle server.");
-      }
-    }, 1000);
-
-    // Set a timeout to stop polling after 2 minutes
-    setTimeout(() => {
-      clearInterval(intervalId);
-    }, 60000 * 2); // 2 minutes
-  };
-
   const isSessionSelected = (sessionId: string) => {
     const dropdown = document.getElementById('session-history') as HTMLSelectElement;
     if (dropdown) {
@@ -298,36 +270,100 @@ function App() {
     return false;
   };
 
-  const pollForOutput = async (sessionId: string) => {
-    const intervalId = setInterval(async () => {
-      try {
-        const response = await fetch(LOCAL_SERVER_BASE_URL + `getoutput/${sessionId}`, {
-          method: 'POST',
+  const eventSourceRef = useRef<{ sessionId: string, source: EventSource } | null>(null);
+  const templateTextRef = useRef<string>('');
+  const imageReloadRef = useRef<{ timer: ReturnType<typeof setTimeout> | null, last: number }>({ timer: null, last: 0 });
+
+  const cancelImageReload = () => {
+    if (imageReloadRef.current.timer) {
+      clearTimeout(imageReloadRef.current.timer);
+      imageReloadRef.current.timer = null;
+    }
+  };
+
+  const subscribeToEvents = (sessionId: string) => {
+    // One stream per session; it stays open across prompts and reconnects by itself
+    if (eventSourceRef.current?.sessionId === sessionId) {
+      return;
+    }
+    eventSourceRef.current?.source.close();
+    cancelImageReload();
+
+    const source = new EventSource(LOCAL_SERVER_BASE_URL + `events/${sessionId}`);
+    eventSourceRef.current = { sessionId, source };
+
+    source.addEventListener('started', () => {
+      templateTextRef.current = '';
+      cancelImageReload();
+    });
+
+    source.addEventListener('template_chunk', (event) => {
+      const data = JSON.parse(event.data);
+      // Chunks missed while disconnected leave a gap; the finished template replaces the partial one anyway
+      if (data.offset === templateTextRef.current.length) {
+        templateTextRef.current += data.text;
+        setHtmlSource(templateTextRef.current);
+      }
+    });
+
+    source.addEventListener('template_ready', (event) => {
+      const data = JSON.parse(event.data);
+      setIframeUrl(`${data.templateurl}?t=${new Date().getTime()}`);
+      setLoading(false);
+    });
+
+    source.addEventListener('title_ready', () => {
+      if (!isSessionSelected(sessionId)) {
+        fetchSessionHistory().then(() => {
+          setSessionDropDown(sessionId);
         });
-        const data = await response.json();
-        if (data.status === 'ready') {
-          clearInterval(intervalId);
-          setHtmlSource(data.htmldata);
-          setIframeUrl(data.templateurl);
-          setLoading(false);
-          pollForImages(sessionId, data.templateurl);
-
-          if (!isSessionSelected(sessionId)) {
-            fetchSessionHistory().then(() => {
-              setSessionDropDown(sessionId);
-            });
-          }
-        }
-      } catch (error) {
-        ErrorHandler.handleError(error, "Failing to get an html response from ChatGPT server.");
       }
-    }, 1000);
+    });
 
-    setTimeout(() => {
-      clearInterval(intervalId);
-    }, 60000); // 60 seconds timeout
+    source.addEventListener('image_ready', (event) => {
+      const data = JSON.parse(event.data);
+      // The last image is shown by images_ready
+      if (data.counts.pending === 0 || imageReloadRef.current.timer) {
+        return;
+      }
+      const reload = () => {
+        imageReloadRef.current = { timer: null, last: Date.now() };
+        setIframeUrl(LOCAL_SERVER_BASE_URL + `jobs/${sessionId}/index.html?t=${new Date().getTime()}`);
+      };
+      const wait = imageReloadRef.current.last + IMAGE_RELOAD_INTERVAL_MS - Date.now();
+      if (wait <= 0) {
+        reload();
+      } else {
+        // Images that arrive meanwhile are shown by the same reload
+        imageReloadRef.current.timer = setTimeout(reload, wait);
+      }
+    });
+
+    source.addEventListener('images_ready', () => {
+      cancelImageReload();
+      setIframeUrl(LOCAL_SERVER_BASE_URL + `jobs/${sessionId}/index.html?t=${new Date().getTime()}`);
+    });
+
+    source.addEventListener('job_failed', (event) => {
+      const data = JSON.parse(event.data);
+      if (data.stage === 'images') {
+        // Image jobs are retried by the server, and the page keeps its placeholders meanwhile
+        ErrorHandler.logError(data);
+        return;
+      }
+      setLoading(false);
+      ErrorHandler.handleError(new Error(data.error), "Failing to get an html response from ChatGPT server.");
+    });
   };
 
+  useEffect(() => {
+    return () => {
+      eventSourceRef.current?.source.close();
+      eventSourceRef.current = null;
+      cancelImageReload();
+    };
+  }, [sessionId]);
+
   const isImage = (fileName: string): boolean => {
     const fileExtension = (fileName.split('.').pop() || '').toLowerCase();
     return ['jpg', 'jpeg', 'png', 'gif', 'bmp'].includes(fileExtension);
@@ -387,7 +423,7 @@ function App() {
         scrollToLastElement('conversations-container');
 
         if (currentSessionId) {
-          pollForOutput(currentSessionId);
+          subscribeToEvents(currentSessionId);
         }
 
         setResponse(JSON.stringify(data));
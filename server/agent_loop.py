@@ -0,0 +1,56 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import threading
+
+# Flask runs every async view in its own short-lived event loop. Model calls and background
+# pipeline work run on this long-lived loop instead, so the async clients and their connection
+# pools outlive a single request and background work is not cancelled when the request ends.
+_loop = None
+_lock = threading.Lock()
+
+def get_agent_loop():
+    """
+    Returns the process-wide agent event loop, starting its thread on first use.
+
+    Returns:
+    asyncio.AbstractEventLoop: The agent event loop.
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="agent-loop", daemon=True)
+            thread.start()
+    return _loop
+
+def run_on_agent_loop(coro):
+    """
+    Runs a coroutine on the agent event loop and returns an awaitable for its result on the caller's loop.
+
+    Args:
+    coro: The coroutine to run.
+
+    Returns:
+    asyncio.Future: A future that resolves with the result of the coroutine.
+    """
+    return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, get_agent_loop()))
+
+def submit_to_agent_loop(coro):
+    """
+    Starts a coroutine on the agent event loop without waiting for it. Exceptions are reported when it finishes.
+
+    Args:
+    coro: The coroutine to run.
+
+    Returns:
+    concurrent.futures.Future: A future that resolves with the result of the coroutine.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_agent_loop())
+    future.add_done_callback(_report_exception)
+    return future
+
+def _report_exception(future):
+    if not future.cancelled() and future.exception():
+        print(f"Background task failed: {future.exception()}")
@@ -7,4 +7,12 @@ abs_path = os.path.abspath(rel_path)
 sys.path.insert(1, abs_path)
 
 from dalle_agent import DallEAgent
-from azure_agent import AzureOpenAIAgent
\ No newline at end of file
+from azure_agent import AzureOpenAIAgent, MalformedResponseError
+from context_policy import ContextPolicy, TokenBudgetPolicy, SlidingWindowPolicy, SummarizingPolicy
+from client_pool import ClientRegistry, client_registry
+from response_cache import ResponseCache
+from prompt_registry import PromptRegistry, prompt_registry
+from credential_profiles import CredentialProfiles, credential_profiles
+from agent_journal import AgentJournal
+from transport import Cassette, ReplayTransport, SyntheticTransport, RecordingTransport, create_transport_factory, start_image_stub
+from call_scheduler import CallScheduler, text_scheduler, image_scheduler, priority_for_role, INTERACTIVE, TEMPLATE, BACKGROUND
@@ -0,0 +1,154 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+import os
+import threading
+import time
+import uuid
+
+class AgentJournal:
+    """
+    Persists the state of an agent as a snapshot file plus an append-only journal next to it.
+    Each save appends one JSON line per new message to '<filepath>.journal', and the
+    journal is periodically compacted into a fresh snapshot. Loading replays the journal on top of the snapshot.
+    Every snapshot gets a new generation ID that its journal entries carry, so entries of an older snapshot are never
+    replayed onto a newer one.
+    """
+
+    # Number of journal entries after which the journal is compacted into a new snapshot
+    compact_after_entries = 100
+    # Journal writes are fsynced once this many entries are unsynced or this much time has passed
+    fsync_every_entries = 20
+    fsync_interval_seconds = 1.0
+
+    @classmethod
+    def configure(cls, compact_after_entries: int, fsync_every_entries: int, fsync_interval_seconds: float):
+        """
+        Sets the compaction and fsync batching thresholds of all journals.
+
+        :param compact_after_entries: Number of journal entries after which the journal is compacted.
+        :param fsync_every_entries: Number of unsynced entries after which the journal is fsynced.
+        :param fsync_interval_seconds: Number of seconds after which unsynced entries are fsynced.
+        """
+        cls.compact_after_entries = compact_after_entries
+        cls.fsync_every_entries = fsync_every_entries
+        cls.fsync_interval_seconds = fsync_interval_seconds
+
+    def __init__(self):
+        self.filepath = None
+        self.generation = None
+        self.persisted_count = 0
+        self.persisted_header = None
+        self.journal_entries = 0
+        self.unsynced_entries = 0
+        self.last_fsync = time.time()
+        self.needs_snapshot = True
+        self._lock = threading.Lock()
+
+    def mark_rewritten(self):
+        """
+        Records that the history was rewritten, so the next save writes a full snapshot.
+        """
+        self.needs_snapshot = True
+
+    def save(self, filepath: str, state: dict):
+        """
+        Persists the state of an agent, appending only what changed since the last save.
+
+        :param filepath: The path of the snapshot file.
+        :param state: The state of the agent, as returned by its get_state method.
+        """
+        messages = state["messages"]
+        header = json.dumps({k: v for k, v in state.items() if k != "messages"}, sort_keys=True)
+
+        with self._lock:
+            if (self.needs_snapshot or filepath != self.filepath or header != self.persisted_header
+                    or len(messages) < self.persisted_count or self.journal_entries >= self.compact_after_entries):
+                self._write_snapshot(filepath, state, header)
+                return
+
+            entries = [{"op": "append", "index": i, "message": messages[i]} for i in range(self.persisted_count, len(messages))]
+            if entries:
+                self._append_entries(filepath, entries)
+            self.persisted_count = len(messages)
+
+    def _write_snapshot(self, filepath, state, header):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        generation = uuid.uuid4().hex
+        temp_path = f"{filepath}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps({**state, "journal_generation": generation}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, filepath)
+
+        # Entries left behind by a crash between these two steps belong to the previous generation and are skipped
+        # on load; replaying them could resurrect a conversation that was reset
+        journal_path = f"{filepath}.journal"
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+
+        self.filepath = filepath
+        self.generation = generation
+        self.persisted_count = len(state["messages"])
+        self.persisted_header = header
+        self.journal_entries = 0
+        self.unsynced_entries = 0
+        self.needs_snapshot = False
+
+    def _append_entries(self, filepath, entries):
+        with open(f"{filepath}.journal", 'a') as f:
+            f.write("".join(json.dumps({**entry, "generation": self.generation}) + "\n" for entry in entries))
+            f.flush()
+            self.journal_entries += len(entries)
+            self.unsynced_entries += len(entries)
+            if self.unsynced_entries >= self.fsync_every_entries or time.time() - self.last_fsync >= self.fsync_interval_seconds:
+                os.fsync(f.fileno())
+                self.unsynced_entries = 0
+                self.last_fsync = time.time()
+
+    @classmethod
+    def load(cls, filepath: str):
+        """
+        Reads a snapshot and replays its journal.
+
+        :param filepath: The path of the snapshot file.
+        :return: A tuple of (the state of the agent, a journal in sync with the files on disk).
+        """
+        with open(filepath, 'r') as f:
+            state = json.loads(f.read())
+        messages = state["messages"]
+        # Snapshots written before generations were introduced have none, nor have their journal entries
+        generation = state.pop("journal_generation", None)
+
+        journal = cls()
+        journal.generation = generation
+        journal.needs_snapshot = False
+        journal_path = f"{filepath}.journal"
+        if os.path.exists(journal_path):
+            with open(journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn final line from a crash mid-write, everything before it is intact
+                        print(f"Ignoring incomplete journal entry in {journal_path}")
+                        journal.needs_snapshot = True
+                        break
+                    if entry.get("generation") != generation:
+                        # Left behind by a crash right after a newer snapshot replaced the older one
+                        journal.needs_snapshot = True
+                        continue
+                    index = entry["index"]
+                    if entry["op"] == "append" and index == len(messages):
+                        messages.append(entry["message"])
+                    elif index < len(messages):
+                        # 'set' entries of journals written while messages could still be changed in place
+                        messages[index] = entry["message"]
+                    journal.journal_entries += 1
+
+        journal.filepath = filepath
+        journal.persisted_count = len(messages)
+        journal.persisted_header = json.dumps({k: v for k, v in state.items() if k != "messages"}, sort_keys=True)
+        return state, journal
@@ -0,0 +1,87 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Model calls take seconds to minutes, so the default sub-second buckets are of little use
+_LLM_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 240)
+
+LLM_REQUESTS = Counter(
+    "sitebuilder_llm_requests_total",
+    "Chat completion requests by agent role and outcome (ok, error or cache_hit).",
+    ["role", "outcome"]
+)
+LLM_LATENCY = Histogram(
+    "sitebuilder_llm_request_duration_seconds",
+    "Duration of chat completion requests by agent role.",
+    ["role"],
+    buckets=_LLM_BUCKETS
+)
+LLM_FIRST_CHUNK_LATENCY = Histogram(
+    "sitebuilder_llm_first_chunk_seconds",
+    "Time until the first chunk of a streamed chat completion arrives, by agent role.",
+    ["role"],
+    buckets=_LLM_BUCKETS
+)
+LLM_PROMPT_TOKENS = Counter(
+    "sitebuilder_llm_prompt_tokens_total",
+    "Prompt tokens sent to the model by agent role.",
+    ["role"]
+)
+LLM_COMPLETION_TOKENS = Counter(
+    "sitebuilder_llm_completion_tokens_total",
+    "Completion tokens received from the model by agent role.",
+    ["role"]
+)
+
+IMAGE_REQUESTS = Counter(
+    "sitebuilder_image_generation_requests_total",
+    "Image generation calls by outcome (ok, error or no_image).",
+    ["outcome"]
+)
+IMAGE_LATENCY = Histogram(
+    "sitebuilder_image_generation_duration_seconds",
+    "Duration of image generation calls, including retries.",
+    buckets=_LLM_BUCKETS
+)
+IMAGE_RETRIES = Counter(
+    "sitebuilder_image_generation_retries_total",
+    "Image generation retries with a revised prompt."
+)
+
+SCHEDULER_QUEUE_DEPTH = Gauge(
+    "sitebuilder_model_call_queue_depth",
+    "Model calls waiting for admission by scheduler and priority class.",
+    ["scheduler", "priority"]
+)
+SCHEDULER_WAIT_LATENCY = Histogram(
+    "sitebuilder_model_call_queue_wait_seconds",
+    "Time model calls wait for admission by scheduler and priority class.",
+    ["scheduler", "priority"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+)
+SCHEDULER_THROTTLED = Counter(
+    "sitebuilder_model_call_throttled_total",
+    "Model calls rejected with a 429 by scheduler.",
+    ["scheduler"]
+)
+SCHEDULER_RETRIES = Counter(
+    "sitebuilder_model_call_retries_total",
+    "Model call retries by scheduler and reason (status code or connection).",
+    ["scheduler", "reason"]
+)
+
+
+def record_completion(role: str, seconds: float, prompt_tokens: int, completion_tokens: int):
+    """
+    Records a successful chat completion.
+
+    :param role: The role of the agent, e.g. 'template_agent'.
+    :param seconds: The duration of the request.
+    :param prompt_tokens: The number of prompt tokens.
+    :param completion_tokens: The number of completion tokens.
+    """
+    LLM_REQUESTS.labels(role, "ok").inc()
+    LLM_LATENCY.labels(role).observe(seconds)
+    LLM_PROMPT_TOKENS.labels(role).inc(prompt_tokens)
+    LLM_COMPLETION_TOKENS.labels(role).inc(completion_tokens)
@@ -1,12 +1,24 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import asyncio
 import json
-import os
-from openai import AzureOpenAI
+import time
+from openai import NOT_GIVEN
+from client_pool import client_registry
+from context_policy import ContextPolicy, count_message_tokens, count_tokens
+from response_cache import ResponseCache
+from prompt_registry import prompt_registry
+from credential_profiles import credential_profiles
+from agent_journal import AgentJournal
+from agent_metrics import LLM_REQUESTS, LLM_FIRST_CHUNK_LATENCY, record_completion
+from call_scheduler import text_scheduler, priority_for_role
+
+class MalformedResponseError(ValueError):
+    """Raised when a JSON mode response is not a JSON object, e.g. because it was cut off at max_tokens."""
 
 class AzureOpenAIAgent:
-    def __init__(self, api_key: str, api_version: str, base_url: str, model: str = "gpt-4o", system_message: str = None, messages: list = None):
+    def __init__(self, api_key: str = None, api_version: str = None, base_url: str = None, model: str = "gpt-4o", system_message: str = None, messages: list = None, context_policy: ContextPolicy = None, response_cache: ResponseCache = None, system_prompt_id: str = None, credential_profile: str = None, max_tokens: int = 4000, temperature: float = None):
         """
         Initializes the OpenAILLMAgent class with the given API key, API version, model, and optional system message.
         
@@ -15,18 +27,42 @@ class AzureOpenAIAgent:
         :param model: The model name to use, default is 'gpt-4o'.
         :param system_message: An optional system message to guide the behavior of the LLM.
         :param messages: An optional list of messages to initialize the conversation history.
+        :param context_policy: An optional policy deciding which part of the history is sent with each request, default is the full history.
+        :param response_cache: An optional cache of responses; requests that hit it skip the network.
+        :param system_prompt_id: An optional ID of a registered system prompt, used instead of system_message and persisted by reference.
+        :param credential_profile: An optional name of a registered credential profile, used instead of the API key, API version and base URL and persisted by reference.
+        :param max_tokens: The maximum number of tokens of each response, default is 4000.
+        :param temperature: An optional sampling temperature, default is the service's default.
         """
+        if credential_profile:
+            profile = credential_profiles.get(credential_profile)
+            api_key = profile["api_key"]
+            api_version = profile["api_version"]
+            base_url = profile["base_url"]
+        if system_prompt_id:
+            system_message = prompt_registry.get(system_prompt_id)
+
         self.api_key = api_key
         self.api_version = api_version
         self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
         self.messages = messages if messages is not None else []
         self.base_url = base_url
+        self.context_policy = context_policy if context_policy is not None else ContextPolicy()
+        self.response_cache = response_cache
+        self.system_message = system_message
+        self.system_prompt_id = system_prompt_id
+        self.system_prompt_version = prompt_registry.get_current_version(system_prompt_id) if system_prompt_id else None
+        self.credential_profile = credential_profile
+        self.journal = AgentJournal()
+        # Label for metrics; AgentFactory sets it to the agent's role
+        self.role = system_prompt_id or "agent"
+        # Optional callable rewriting the content of assistant messages when they are sent back to the model, set by AgentFactory.
+        # The history keeps the raw responses.
+        self.content_renderer = None
 
-        self.client = AzureOpenAI(
-            api_key=api_key,
-            api_version="2024-02-01",
-            azure_endpoint=base_url
-        )
+        self.client = client_registry.get_client(api_key, api_version, base_url)
                 
         if system_message and not messages:
             self.messages.append({"role": "system", "content": system_message}) 
@@ -42,43 +78,394 @@ class AzureOpenAIAgent:
         :param file_content: The content of the file to be uploaded, if any.
         :return: A dictionary containing the LLM's response.
         """
+        self.add_prompt(prompt, file_content)
+        messages = self.context_policy.apply(self.render_history())
+        
+        response_message = self.get_cached_response(messages)
+        if response_message is None:
+            response_message = self.complete(messages)
+            self.cache_response(messages, response_message)
+
+        self.messages.append({"role": "assistant", "content": response_message})
+        
+        return response_message
+
+    async def asend_prompt(self, prompt: str, file_content: bytes = None) -> str:
+        """
+        Sends a prompt to the LLM without blocking the event loop and returns the response.
+        
+        :param prompt: The text prompt to send to the LLM.
+        :param file_content: The content of the file to be uploaded, if any.
+        :return: The LLM's response.
+        """
+        self.add_prompt(prompt, file_content)
+        messages = await self.acontext_messages()
+        
+        response_message = self.get_cached_response(messages)
+        if response_message is None:
+            response_message = await self.acomplete(messages)
+            self.cache_response(messages, response_message)
+
+        self.messages.append({"role": "assistant", "content": response_message})
+        
+        return response_message
+
+    async def astream_prompt(self, prompt: str, file_content: bytes = None, on_chunk=None) -> str:
+        """
+        Sends a prompt to the LLM as a streamed completion without blocking the event loop, handing each chunk of the response to a callback as it arrives.
+        
+        :param prompt: The text prompt to send to the LLM.
+        :param file_content: The content of the file to be uploaded, if any.
+        :param on_chunk: An optional callable invoked with each text chunk of the response.
+        :return: The full response text once the stream has completed.
+        """
+        self.add_prompt(prompt, file_content)
+        messages = await self.acontext_messages()
+
+        response_message = self.get_cached_response(messages)
+        if response_message is not None:
+            if on_chunk:
+                on_chunk(response_message)
+        else:
+            response_message = await self.astream(messages, on_chunk)
+            self.cache_response(messages, response_message)
+
+        self.messages.append({"role": "assistant", "content": response_message})
+        
+        return response_message
+
+    async def asend_json_prompt(self, prompt: str, file_content: bytes = None, instructions: str = None, render=None) -> dict:
+        """
+        Sends a prompt to the LLM in JSON mode without blocking the event loop and returns the parsed response.
+        
+        :param prompt: The text prompt to send to the LLM.
+        :param file_content: The content of the file to be uploaded, if any.
+        :param instructions: Optional instructions describing the JSON object to respond with, sent with this request only and not kept in the history.
+        :param render: An optional callable turning the parsed response into the text kept in the history, by default the JSON itself.
+        :return: The parsed response.
+        :raises MalformedResponseError: If the response is not a JSON object. The prompt is then removed from the history again, so the caller can retry it another way.
+        """
+        history_length = len(self.messages)
+        self.add_prompt(prompt, file_content)
+        messages = await self.acontext_messages()
+        if instructions:
+            messages = messages + [{"role": "system", "content": instructions}]
+
+        response_message = self.get_cached_response(messages, response_format="json_object")
+        cached = response_message is not None
+        if not cached:
+            response_message = await self.acomplete(messages, response_format={"type": "json_object"})
+
+        try:
+            response = json.loads(response_message)
+        except json.JSONDecodeError:
+            response = None
+        if not isinstance(response, dict):
+            # Leaving the prompt unanswered would put two user turns in a row into every later request
+            del self.messages[history_length:]
+            raise MalformedResponseError(f"Expected a JSON object, got: {response_message[:200]!r}")
+        if not cached:
+            self.cache_response(messages, response_message, response_format="json_object")
+
+        self.messages.append({"role": "assistant", "content": render(response) if render else response_message})
+        
+        return response
+
+    def complete(self, messages: list) -> str:
+        """
+        Requests a chat completion for a list of messages and records its metrics.
+        
+        :param messages: The list of messages to send to the model.
+        :return: The response text.
+        """
+        reserved_tokens = self.estimate_tokens(messages, self.max_tokens)
+        started = time.perf_counter()
+        try:
+            response = text_scheduler.call(priority_for_role(self.role), reserved_tokens, lambda: self.client.chat.completions.create(
+                messages=messages,
+                **self.get_request_params()
+            ))
+        except Exception:
+            LLM_REQUESTS.labels(self.role, "error").inc()
+            raise
+
+        response_message = response.choices[0].message.content
+        self.record_usage(started, messages, response_message, reserved_tokens, response.usage)
+        return response_message
+
+    async def acomplete(self, messages: list, response_format: dict = None) -> str:
+        """
+        Requests a chat completion for a list of messages without blocking the event loop and records its metrics.
+        
+        :param messages: The list of messages to send to the model.
+        :param response_format: An optional response format, e.g. {"type": "json_object"} for JSON mode.
+        :return: The response text.
+        """
+        reserved_tokens = self.estimate_tokens(messages, self.max_tokens)
+        client = self.get_async_client()
+        started = time.perf_counter()
+        try:
+            response = await text_scheduler.acall(priority_for_role(self.role), reserved_tokens, lambda: client.chat.completions.create(
+                messages=messages,
+                response_format=response_format or NOT_GIVEN,
+                **self.get_request_params()
+            ))
+        except Exception:
+            LLM_REQUESTS.labels(self.role, "error").inc()
+            raise
+
+        response_message = response.choices[0].message.content
+        self.record_usage(started, messages, response_message, reserved_tokens, response.usage)
+        return response_message
+
+    async def astream(self, messages: list, on_chunk=None) -> str:
+        """
+        Requests a streamed chat completion for a list of messages without blocking the event loop and records its metrics.
+        
+        :param messages: The list of messages to send to the model.
+        :param on_chunk: An optional callable invoked with each text chunk of the response.
+        :return: The full response text once the stream has completed.
+        """
+        reserved_tokens = self.estimate_tokens(messages, self.max_tokens)
+        client = self.get_async_client()
+        started = time.perf_counter()
+        try:
+            stream = await text_scheduler.acall(priority_for_role(self.role), reserved_tokens, lambda: client.chat.completions.create(
+                messages=messages,
+                stream=True,
+                **self.get_request_params()
+            ))
+
+            response_chunks = []
+            async for chunk in stream:
+                # Azure sends content filter results as chunks without choices
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not response_chunks:
+                        LLM_FIRST_CHUNK_LATENCY.labels(self.role).observe(time.perf_counter() - started)
+                    response_chunks.append(delta)
+                    if on_chunk:
+                        on_chunk(delta)
+        except Exception:
+            LLM_REQUESTS.labels(self.role, "error").inc()
+            raise
+
+        response_message = "".join(response_chunks)
+        self.record_usage(started, messages, response_message, reserved_tokens)
+        return response_message
+
+    def record_usage(self, started: float, messages: list, response_message: str, reserved_tokens: int, usage=None):
+        """
+        Records the latency and token usage of a completed request, and returns the tokens it reserved but did not use to the scheduler.
+        Streamed responses carry no usage, so their tokens are counted locally.
+        
+        :param started: The perf_counter value when the request was started.
+        :param messages: The list of messages sent to the model.
+        :param response_message: The response text.
+        :param reserved_tokens: The number of tokens the request was admitted with.
+        :param usage: The usage reported by the service, if any.
+        """
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens, completion_tokens = count_message_tokens(messages), count_tokens(response_message)
+        record_completion(self.role, time.perf_counter() - started, prompt_tokens, completion_tokens)
+        text_scheduler.settle(reserved_tokens, prompt_tokens + completion_tokens)
+
+    @staticmethod
+    def estimate_tokens(messages: list, max_tokens: int) -> int:
+        """
+        Estimates the tokens a request counts against the tokens-per-minute quota, which like the service assumes the full max_tokens.
+        
+        :param messages: The list of messages to send to the model.
+        :param max_tokens: The maximum number of tokens of the response.
+        :return: The estimated number of tokens.
+        """
+        return count_message_tokens(messages) + max_tokens
+
+    def add_prompt(self, prompt: str, file_content: bytes = None):
+        """
+        Appends a user prompt, and the content of an uploaded file if any, to the conversation history.
+        
+        :param prompt: The text prompt to send to the LLM.
+        :param file_content: The content of the file to be uploaded, if any.
+        """
         self.messages.append({"role": "user", "content": prompt})
         
         if file_content:
             self.messages.append({"role": "user", "content": f"File content: {file_content}"})
+
+    async def acontext_messages(self) -> list:
+        """
+        Applies the context policy from a coroutine, moving policies that call the model themselves off the event loop.
         
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=self.messages,
-            max_tokens=4000 
-        )
-            
-        response_message = response.choices[0].message.content
-        self.messages.append({"role": "assistant", "content": response_message})
+        :return: The list of messages to send to the model.
+        """
+        if self.context_policy.blocking:
+            return await asyncio.to_thread(self.context_policy.apply, self.render_history())
+        return self.context_policy.apply(self.render_history())
+
+    def render_history(self) -> list:
+        """
+        Returns the conversation history as it is sent to the model, with the content renderer applied to assistant messages.
+
+        :return: The list of messages, sharing the messages the renderer leaves unchanged with the history.
+        """
+        if not self.content_renderer:
+            return self.messages
+        rendered = []
+        for msg in self.messages:
+            if msg["role"] == "assistant" and msg.get("content"):
+                content = self.content_renderer(msg["content"])
+                if content != msg["content"]:
+                    msg = {**msg, "content": content}
+            rendered.append(msg)
+        return rendered
+
+    def get_cached_response(self, messages: list, **params) -> str:
+        """
+        Looks up the response to a request in the response cache, if the agent has one.
         
+        :param messages: The list of messages that would be sent to the model.
+        :param params: Any request parameters besides the agent's own that affect the response, e.g. the response format.
+        :return: The cached response, or None if there is no cache or no entry.
+        """
+        if self.response_cache is None:
+            return None
+        response_message = self.response_cache.get(self.get_cache_key(messages, **params))
+        if response_message is not None:
+            LLM_REQUESTS.labels(self.role, "cache_hit").inc()
         return response_message
 
+    def cache_response(self, messages: list, response_message: str, **params):
+        """
+        Stores the response to a request in the response cache, if the agent has one.
+        
+        :param messages: The list of messages sent to the model.
+        :param response_message: The response of the model.
+        :param params: Any request parameters besides the agent's own that affect the response, e.g. the response format.
+        """
+        if self.response_cache is not None and response_message:
+            self.response_cache.put(self.get_cache_key(messages, **params), response_message)
+
+    def get_request_params(self) -> dict:
+        """
+        Returns the model parameters sent with each chat completion request.
+        
+        :return: A dictionary of request parameters.
+        """
+        params = {"model": self.model, "max_tokens": self.max_tokens}
+        if self.temperature is not None:
+            params["temperature"] = self.temperature
+        return params
+
+    def get_cache_key(self, messages: list, **params) -> str:
+        """
+        Builds the response cache key of a request.
+        
+        :param messages: The list of messages sent to the model.
+        :param params: Any request parameters besides the agent's own that affect the response, e.g. the response format.
+        :return: The cache key.
+        """
+        request_params = self.get_request_params()
+        return ResponseCache.make_key(request_params.pop("model"), messages, **request_params, **params)
+
+    def get_async_client(self):
+        """
+        Returns the shared async client for the running event loop.
+        
+        :return: An AsyncAzureOpenAI client.
+        """
+        return client_registry.get_async_client(self.api_key, self.api_version, self.base_url)
+
+    def summarize_messages(self, summary: str, messages: list) -> str:
+        """
+        Folds a list of messages into a running summary of the conversation without adding to the history.
+        
+        :param summary: The summary of the conversation so far, if any.
+        :param messages: The messages to fold into the summary.
+        :return: The updated summary.
+        """
+        transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+        summary_prompt = f"""Please update the summary of a conversation between a user and an assistant with the new messages below.
+        Keep every requirement and preference the user stated. Only output the summary.
+
+        Summary so far: {summary or "None"}
+
+        New messages:
+        {transcript}
+        """
+        summary_messages = [{"role": "user", "content": summary_prompt}]
+        reserved_tokens = self.estimate_tokens(summary_messages, 500)
+        response = text_scheduler.call(priority_for_role(self.role), reserved_tokens, lambda: self.client.chat.completions.create(
+            model=self.model,
+            messages=summary_messages,
+            max_tokens=500
+        ))
+        if response.usage is not None:
+            text_scheduler.settle(reserved_tokens, response.usage.total_tokens)
+        return response.choices[0].message.content
+
+    def get_context_stats(self) -> dict:
+        """
+        Returns the counters of the context policy, including how many tokens it saved.
+        
+        :return: A dictionary of context policy statistics.
+        """
+        return self.context_policy.get_stats()
+
     def reset(self):
         """
         Resets the conversation history, effectively creating a new chat.
         """
+        self.context_policy.reset()
+        self.journal.mark_rewritten()
         self.messages = []
-        if hasattr(self, 'system_message') and self.system_message:
+        if self.system_message:
             self.messages.append({"role": "system", "content": self.system_message})
 
+    def get_persisted_offset(self) -> int:
+        """
+        Returns the number of leading messages that are not persisted because they are rehydrated on load.
+        
+        :return: 1 if the system message is persisted by reference, otherwise 0.
+        """
+        if self.system_prompt_id and self.messages and self.messages[0]["role"] == "system":
+            return 1
+        return 0
+
     def serialize(self) -> str:
         """
         Serializes the state of the agent to a JSON string.
         
         :return: A JSON string representing the state of the agent.
         """
-        return json.dumps({
-            "api_key": self.api_key,
-            "api_version": self.api_version,
-            "model": self.model,
-            "messages": self.messages,
-            "base_url": self.base_url
-        })
+        return json.dumps(self.get_state())
+
+    def get_state(self) -> dict:
+        """
+        Returns the persisted state of the agent.
+        
+        :return: A dictionary representing the state of the agent.
+        """
+        state = {"model": self.model}
+
+        if self.credential_profile:
+            state["credential_profile"] = self.credential_profile
+        else:
+            state["api_key"] = self.api_key
+            state["api_version"] = self.api_version
+            state["base_url"] = self.base_url
+
+        if self.system_prompt_id:
+            # The system prompt is rehydrated from the prompt registry on load
+            state["system_prompt_id"] = self.system_prompt_id
+            state["system_prompt_version"] = self.system_prompt_version
+        state["messages"] = self.messages[self.get_persisted_offset():]
+
+        return state
 
     @classmethod
     def deserialize(cls, json_str: str):
@@ -88,13 +475,30 @@ class AzureOpenAIAgent:
         :param json_str: A JSON string representing the state of the agent.
         :return: An AzureOpenAIAgent instance.
         """
-        data = json.loads(json_str)
+        return cls.from_state(json.loads(json_str))
+
+    @classmethod
+    def from_state(cls, data: dict):
+        """
+        Creates an AzureOpenAIAgent instance from its persisted state.
+        
+        :param data: A dictionary representing the state of the agent.
+        :return: An AzureOpenAIAgent instance.
+        """
+        messages = data["messages"]
+        system_prompt_id = data.get("system_prompt_id")
+        if system_prompt_id:
+            # Sessions pick up the current version of their prompt, so a new version rolls out without rewriting state files
+            messages = [{"role": "system", "content": prompt_registry.get(system_prompt_id)}] + messages
+
         return cls(
-            api_key=data["api_key"],
-            api_version=data["api_version"],
+            api_key=data.get("api_key"),
+            api_version=data.get("api_version"),
             model=data["model"],
-            messages=data["messages"],
-            base_url=data["base_url"]
+            messages=messages,
+            base_url=data.get("base_url"),
+            system_prompt_id=system_prompt_id,
+            credential_profile=data.get("credential_profile")
         )
 
     def save(self, filepath: str):
@@ -103,10 +507,7 @@ class AzureOpenAIAgent:
         
         :param filepath: The path to the file where the state should be saved.
         """
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        
-        with open(filepath, 'w') as f:
-            f.write(self.serialize())
+        self.journal.save(filepath, self.get_state())
 
     @classmethod
     def load(cls, filepath: str):
@@ -116,9 +517,10 @@ class AzureOpenAIAgent:
         :param filepath: The path to the file from which the state should be loaded.
         :return: An AzureOpenAIAgent instance.
         """
-        with open(filepath, 'r') as f:
-            json_str = f.read()
-        return cls.deserialize(json_str)
+        state, journal = AgentJournal.load(filepath)
+        agent = cls.from_state(state)
+        agent.journal = journal
+        return agent
     
     def get_messages(self) -> list:
         """
@@ -0,0 +1,339 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from openai import APIConnectionError
+from agent_metrics import SCHEDULER_QUEUE_DEPTH, SCHEDULER_WAIT_LATENCY, SCHEDULER_THROTTLED, SCHEDULER_RETRIES
+
+# Priority classes of model calls; lower values are served first
+INTERACTIVE = 0
+TEMPLATE = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", TEMPLATE: "template", BACKGROUND: "background"}
+
+ROLE_PRIORITIES = {
+    "orchestrator_agent": INTERACTIVE,
+    "template_agent": TEMPLATE,
+    "session_title_agent": TEMPLATE,
+    "image_prompt_agent": BACKGROUND,
+    "image_gen_agent": BACKGROUND
+}
+
+_RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def priority_for_role(role: str) -> int:
+    """
+    Returns the priority class of the calls made by an agent.
+
+    :param role: The role of the agent, e.g. 'template_agent'.
+    :return: The priority class, TEMPLATE for unknown roles.
+    """
+    return ROLE_PRIORITIES.get(role, TEMPLATE)
+
+
+class _TokenBucket:
+    # Holds up to a minute's worth of a quota and refills continuously; a limit of 0 means unlimited
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float, headroom: float) -> float:
+        if not self.capacity:
+            return 0.0
+        # A request larger than the bucket goes through once the bucket is full
+        needed = min(self.capacity, amount + headroom * self.capacity)
+        return max(0.0, (needed - self.level) / self.rate)
+
+    def take(self, amount: float):
+        if self.capacity:
+            self.level -= amount
+
+    def give(self, amount: float):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class _Ticket:
+    def __init__(self, priority: int, seq: int, tokens: int, loop=None):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.loop = loop
+        self.event = asyncio.Event() if loop else None
+        self.enqueued = time.perf_counter()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class CallScheduler:
+    def __init__(self, name: str, requests_per_minute: int = 0, tokens_per_minute: int = 0, background_headroom: float = 0.2, max_retries: int = 5, base_backoff: float = 1.0, max_backoff: float = 60.0):
+        """
+        Initializes the CallScheduler, which queues the model calls of all agents and sessions for one deployment
+        and admits them in priority order within the deployment's requests-per-minute and tokens-per-minute quota.
+        Rate limited and transient failures are retried with exponential backoff, and a 429 pauses every caller
+        for as long as the service asks.
+
+        :param name: The name of the scheduler, used as a metrics label.
+        :param requests_per_minute: The requests-per-minute quota, or 0 for no limit.
+        :param tokens_per_minute: The tokens-per-minute quota, or 0 for no limit.
+        :param background_headroom: The fraction of each quota that background calls leave for interactive calls.
+        :param max_retries: The maximum number of retries of a failed call.
+        :param base_backoff: The backoff in seconds before the first retry; it doubles with every retry.
+        :param max_backoff: The maximum backoff in seconds.
+        """
+        self.name = name
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._waiting = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self.configure(requests_per_minute, tokens_per_minute, background_headroom, max_retries, base_backoff, max_backoff)
+
+    def configure(self, requests_per_minute: int, tokens_per_minute: int, background_headroom: float = 0.2, max_retries: int = 5, base_backoff: float = 1.0, max_backoff: float = 60.0):
+        """
+        Sets the quota and retry policy, starting with full buckets.
+
+        :param requests_per_minute: The requests-per-minute quota, or 0 for no limit.
+        :param tokens_per_minute: The tokens-per-minute quota, or 0 for no limit.
+        :param background_headroom: The fraction of each quota that background calls leave for interactive calls.
+        :param max_retries: The maximum number of retries of a failed call.
+        :param base_backoff: The backoff in seconds before the first retry; it doubles with every retry.
+        :param max_backoff: The maximum backoff in seconds.
+        """
+        with self._lock:
+            self._requests = _TokenBucket(requests_per_minute)
+            self._tokens = _TokenBucket(tokens_per_minute)
+            self.background_headroom = background_headroom
+            self.max_retries = max_retries
+            self.base_backoff = base_backoff
+            self.max_backoff = max_backoff
+            self._wake_all()
+
+    def call(self, priority: int, tokens: int, request):
+        """
+        Runs a model call once the quota admits it, retrying rate limited and transient failures.
+
+        :param priority: The priority class of the call.
+        :param tokens: The number of tokens the call is expected to use.
+        :param request: A callable without arguments that makes the call.
+        :return: The result of the call.
+        """
+        attempt = 0
+        while True:
+            self.acquire(priority, tokens)
+            try:
+                return request()
+            except Exception as error:
+                self.refund(tokens)
+                delay = self.get_retry_delay(error, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                print(f"Retrying {self.name} call after {type(error).__name__} (Retry {attempt}/{self.max_retries})")
+            time.sleep(delay)
+
+    async def acall(self, priority: int, tokens: int, request):
+        """
+        Runs a model call once the quota admits it without blocking the event loop, retrying rate limited and transient failures.
+
+        :param priority: The priority class of the call.
+        :param tokens: The number of tokens the call is expected to use.
+        :param request: A callable without arguments that returns the awaitable making the call.
+        :return: The result of the call.
+        """
+        attempt = 0
+        while True:
+            await self.aacquire(priority, tokens)
+            try:
+                return await request()
+            except Exception as error:
+                self.refund(tokens)
+                delay = self.get_retry_delay(error, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                print(f"Retrying {self.name} call after {type(error).__name__} (Retry {attempt}/{self.max_retries})")
+            await asyncio.sleep(delay)
+
+    def acquire(self, priority: int, tokens: int):
+        """
+        Blocks until the quota admits a call and no call of a higher priority is waiting.
+
+        :param priority: The priority class of the call.
+        :param tokens: The number of tokens the call is expected to use.
+        """
+        with self._lock:
+            ticket = self._enqueue(priority, tokens)
+            try:
+                while True:
+                    wait = self._try_admit(ticket)
+                    if wait == 0:
+                        return
+                    self._condition.wait(wait)
+            except BaseException:
+                self._dequeue(ticket)
+                raise
+
+    async def aacquire(self, priority: int, tokens: int):
+        """
+        Waits without blocking the event loop until the quota admits a call and no call of a higher priority is waiting.
+
+        :param priority: The priority class of the call.
+        :param tokens: The number of tokens the call is expected to use.
+        """
+        with self._lock:
+            ticket = self._enqueue(priority, tokens, asyncio.get_running_loop())
+        try:
+            while True:
+                with self._lock:
+                    wait = self._try_admit(ticket)
+                    if wait == 0:
+                        return
+                    ticket.event.clear()
+                try:
+                    await asyncio.wait_for(ticket.event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                self._dequeue(ticket)
+            raise
+
+    def settle(self, reserved: int, used: int):
+        """
+        Returns the tokens a call reserved but did not use, e.g. because the completion was shorter than max_tokens.
+
+        :param reserved: The number of tokens the call was admitted with.
+        :param used: The number of tokens the call actually used.
+        """
+        if used < reserved:
+            self.refund(reserved - used)
+
+    def refund(self, tokens: int):
+        """
+        Returns tokens to the quota, e.g. for a call the service rejected.
+
+        :param tokens: The number of tokens to return.
+        """
+        with self._lock:
+            self._tokens.refill(time.monotonic())
+            self._tokens.give(tokens)
+            self._wake_all()
+
+    def get_retry_delay(self, error: Exception, attempt: int) -> float:
+        """
+        Decides whether a failed call is retried and after how long. A 429 also pauses every other caller.
+
+        :param error: The exception raised by the call.
+        :param attempt: The number of retries made so far.
+        :return: The delay in seconds before retrying, or None if the error is not retried.
+        """
+        status_code = getattr(error, "status_code", None)
+        if attempt >= self.max_retries:
+            return None
+        if status_code not in _RETRYABLE_STATUS_CODES and not isinstance(error, APIConnectionError):
+            return None
+
+        # Full jitter keeps the callers that were throttled together from retrying together
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        if status_code == 429:
+            SCHEDULER_THROTTLED.labels(self.name).inc()
+            retry_after = self.get_retry_after(error)
+            if retry_after is not None:
+                delay = retry_after
+            print(f"Rate limited, pausing {self.name} calls for {delay:.1f}s")
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self._wake_all()
+            # Admission already waits out the pause
+            delay = 0.0
+        SCHEDULER_RETRIES.labels(self.name, str(status_code or "connection")).inc()
+        return delay
+
+    @staticmethod
+    def get_retry_after(error: Exception) -> float:
+        """
+        Reads how long the service asked to wait from the headers of a rate limited response.
+
+        :param error: The exception raised by the call.
+        :return: The number of seconds to wait, or None if the response does not say.
+        """
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+            try:
+                return float(response.headers[header]) * scale
+            except (KeyError, ValueError):
+                continue
+        return None
+
+    def get_queue_depth(self) -> int:
+        """
+        Returns the number of calls waiting for admission.
+
+        :return: The number of waiting calls.
+        """
+        with self._lock:
+            return len(self._waiting)
+
+    def _enqueue(self, priority, tokens, loop=None):
+        ticket = _Ticket(priority, next(self._seq), tokens, loop)
+        heapq.heappush(self._waiting, ticket)
+        SCHEDULER_QUEUE_DEPTH.labels(self.name, PRIORITY_NAMES.get(priority, str(priority))).inc()
+        # A new call may outrank the one at the head of the queue
+        self._wake_all()
+        return ticket
+
+    def _dequeue(self, ticket):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            SCHEDULER_QUEUE_DEPTH.labels(self.name, PRIORITY_NAMES.get(ticket.priority, str(ticket.priority))).dec()
+            self._wake_all()
+
+    def _try_admit(self, ticket):
+        # Returns 0 once the ticket is admitted, otherwise how long to wait before trying again (None to wait for a wake-up)
+        if self._waiting[0] is not ticket:
+            return None
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        self._requests.refill(now)
+        self._tokens.refill(now)
+        headroom = self.background_headroom if ticket.priority >= BACKGROUND else 0.0
+        wait = max(self._requests.time_until(1, headroom), self._tokens.time_until(ticket.tokens, headroom))
+        if wait > 0:
+            return wait
+
+        self._requests.take(1)
+        self._tokens.take(ticket.tokens)
+        self._dequeue(ticket)
+        SCHEDULER_WAIT_LATENCY.labels(self.name, PRIORITY_NAMES.get(ticket.priority, str(ticket.priority))).observe(time.perf_counter() - ticket.enqueued)
+        return 0
+
+    def _wake_all(self):
+        self._condition.notify_all()
+        for ticket in self._waiting:
+            if ticket.event is not None:
+                ticket.loop.call_soon_threadsafe(ticket.event.set)
+
+
+# Process-wide schedulers, one per deployment, shared by all agents
+text_scheduler = CallScheduler("text")
+image_scheduler = CallScheduler("image")
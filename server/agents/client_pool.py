@@ -0,0 +1,117 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import threading
+import weakref
+import httpx
+from openai import AzureOpenAI, AsyncAzureOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+class ClientRegistry:
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20, keepalive_expiry: float = 30.0):
+        """
+        Initializes the ClientRegistry, which hands out one shared AzureOpenAI client per endpoint, API version and key
+        so that agents across all sessions reuse the same connection pool.
+
+        :param max_connections: The maximum number of concurrent connections per client.
+        :param max_keepalive_connections: The maximum number of idle connections kept alive per client.
+        :param keepalive_expiry: The number of seconds an idle connection is kept alive.
+        """
+        self._clients = {}
+        # Async connection pools are bound to the event loop they were created on, so async clients are kept per loop
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.transport_factory = None
+        self.configure(max_connections, max_keepalive_connections, keepalive_expiry)
+
+    def configure(self, max_connections: int, max_keepalive_connections: int, keepalive_expiry: float):
+        """
+        Sets the connection limits used for clients created from now on.
+
+        :param max_connections: The maximum number of concurrent connections per client.
+        :param max_keepalive_connections: The maximum number of idle connections kept alive per client.
+        :param keepalive_expiry: The number of seconds an idle connection is kept alive.
+        """
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+
+    def set_transport_factory(self, transport_factory):
+        """
+        Sets the factory of the HTTP transports used by clients created from now on, e.g. to record, replay
+        or synthesize traffic instead of calling the service (see transport.py).
+
+        :param transport_factory: A callable taking (limits, is_async) and returning an httpx transport, or None for live traffic.
+        """
+        self.transport_factory = transport_factory
+
+    def _transport(self, is_async):
+        return self.transport_factory(self.limits, is_async) if self.transport_factory else None
+
+    def get_client(self, api_key: str, api_version: str, base_url: str) -> AzureOpenAI:
+        """
+        Returns the shared client for the given endpoint, API version and key, creating it on first use.
+        Callers borrow the client and must not close it.
+
+        :param api_key: The API key for Azure OpenAI.
+        :param api_version: The API version for Azure OpenAI.
+        :param base_url: The base URL for Azure OpenAI.
+        :return: A shared AzureOpenAI client.
+        """
+        key = (base_url, api_version, api_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = AzureOpenAI(
+                    api_key=api_key,
+                    api_version=api_version,
+                    azure_endpoint=base_url,
+                    # Retries go through the call schedulers, so that a 429 holds back every caller instead of each client retrying on its own
+                    max_retries=0,
+                    http_client=DefaultHttpxClient(limits=self.limits, transport=self._transport(False))
+                )
+                self._clients[key] = client
+                print(f"Created pooled Azure OpenAI client for {base_url} ({len(self._clients)} clients in registry)")
+        return client
+
+    def get_async_client(self, api_key: str, api_version: str, base_url: str) -> AsyncAzureOpenAI:
+        """
+        Returns the shared async client for the given endpoint, API version and key on the running event loop, creating it on first use.
+        Callers borrow the client and must not close it.
+
+        :param api_key: The API key for Azure OpenAI.
+        :param api_version: The API version for Azure OpenAI.
+        :param base_url: The base URL for Azure OpenAI.
+        :return: A shared AsyncAzureOpenAI client.
+        """
+        loop = asyncio.get_running_loop()
+        key = (base_url, api_version, api_key)
+        with self._lock:
+            loop_clients = self._async_clients.setdefault(loop, {})
+            client = loop_clients.get(key)
+            if client is None:
+                client = AsyncAzureOpenAI(
+                    api_key=api_key,
+                    api_version=api_version,
+                    azure_endpoint=base_url,
+                    max_retries=0,
+                    http_client=DefaultAsyncHttpxClient(limits=self.limits, transport=self._transport(True))
+                )
+                loop_clients[key] = client
+                print(f"Created pooled async Azure OpenAI client for {base_url}")
+        return client
+
+    def close_all(self):
+        """
+        Closes every pooled synchronous client and empties the registry. Async clients are released along with their event loop.
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+        for client in clients:
+            client.close()
+
+# Process-wide registry shared by all agents
+client_registry = ClientRegistry()
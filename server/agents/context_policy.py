@@ -0,0 +1,245 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+_encoding_unavailable = False
+
+# Per-message overhead the chat format adds on top of the content tokens
+_MESSAGE_OVERHEAD_TOKENS = 4
+_HTML_PATTERN = re.compile(r'<!DOCTYPE html|<html[\s>]', re.IGNORECASE)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens in a piece of text with the local tokenizer.
+    Falls back to a rough estimate of four characters per token if tiktoken or its encoding is unavailable.
+
+    :param text: The text to measure.
+    :return: The number of tokens in the text.
+    """
+    global _encoding, _encoding_unavailable
+
+    if not text:
+        return 0
+
+    if _encoding is None and tiktoken and not _encoding_unavailable:
+        try:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"Tokenizer unavailable, estimating token counts instead: {e}")
+            _encoding_unavailable = True
+
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def count_message_tokens(messages: list) -> int:
+    """
+    Counts the tokens a list of chat messages will take up in a request.
+
+    :param messages: The list of chat messages.
+    :return: The number of tokens in the messages.
+    """
+    return sum(_MESSAGE_OVERHEAD_TOKENS + count_tokens(str(msg.get("content") or "")) for msg in messages)
+
+
+def split_pinned(messages: list):
+    """
+    Splits the leading system messages off a conversation so that policies never drop them.
+
+    :param messages: The list of chat messages.
+    :return: A tuple of (pinned system messages, remaining messages).
+    """
+    pinned_count = 0
+    while pinned_count < len(messages) and messages[pinned_count]["role"] == "system":
+        pinned_count += 1
+    return messages[:pinned_count], messages[pinned_count:]
+
+
+class ContextPolicy:
+    """
+    Decides which part of an agent's conversation history is sent with each request.
+    The base policy sends the full history; subclasses trim it and keep track of how many tokens they saved.
+    """
+
+    name = "full_history"
+    # Policies that call the model themselves are moved off the event loop by async callers
+    blocking = False
+
+    def __init__(self):
+        self.calls = 0
+        self.tokens_in_history = 0
+        self.tokens_sent = 0
+
+    def apply(self, messages: list) -> list:
+        """
+        Builds the list of messages to send for a request, recording how many tokens were saved.
+
+        :param messages: The full conversation history of the agent.
+        :return: The list of messages to send to the model.
+        """
+        context = self.select(messages)
+        self.calls += 1
+        self.tokens_in_history += count_message_tokens(messages)
+        self.tokens_sent += count_message_tokens(context)
+        return context
+
+    def select(self, messages: list) -> list:
+        """
+        Selects the messages to send. Subclasses override this; it must not modify the history in place.
+
+        :param messages: The full conversation history of the agent.
+        :return: The list of messages to send to the model.
+        """
+        return list(messages)
+
+    def reset(self):
+        """
+        Clears any state the policy keeps about the conversation, called when the agent starts a new chat.
+        """
+        pass
+
+    def get_stats(self) -> dict:
+        """
+        Returns the counters of the policy.
+
+        :return: A dictionary with the number of calls and the tokens in history, sent and saved.
+        """
+        return {
+            "policy": self.name,
+            "calls": self.calls,
+            "tokens_in_history": self.tokens_in_history,
+            "tokens_sent": self.tokens_sent,
+            "tokens_saved": self.tokens_in_history - self.tokens_sent
+        }
+
+
+class TokenBudgetPolicy(ContextPolicy):
+    """
+    Keeps the request within a token budget. System messages are pinned, older full-page HTML
+    responses are replaced with short stubs and the oldest remaining messages are dropped until the budget is met.
+    """
+
+    name = "token_budget"
+
+    def __init__(self, max_tokens: int, keep_html_versions: int = 1):
+        """
+        :param max_tokens: The token budget for the messages of each request.
+        :param keep_html_versions: How many of the most recent assistant HTML responses to send in full.
+        """
+        super().__init__()
+        self.max_tokens = max_tokens
+        self.keep_html_versions = keep_html_versions
+
+    def select(self, messages: list) -> list:
+        pinned, history = split_pinned(messages)
+
+        html_positions = [i for i, msg in enumerate(history) if msg["role"] == "assistant" and _HTML_PATTERN.search(msg.get("content") or "")]
+        stale_positions = set(html_positions[:max(len(html_positions) - self.keep_html_versions, 0)])
+        history = [self.stub(msg) if i in stale_positions else msg for i, msg in enumerate(history)]
+
+        budget = self.max_tokens - count_message_tokens(pinned)
+        history_tokens = [count_message_tokens([msg]) for msg in history]
+        total = sum(history_tokens)
+        start = 0
+        # Always keep the latest message, even if it alone exceeds the budget
+        while start < len(history) - 1 and total > budget:
+            total -= history_tokens[start]
+            start += 1
+
+        return pinned + history[start:]
+
+    @staticmethod
+    def stub(message: dict) -> dict:
+        """
+        Replaces an earlier HTML response with a short stub.
+
+        :param message: The assistant message containing a full HTML page.
+        :return: A new message holding the stub.
+        """
+        return {
+            "role": message["role"],
+            "content": f"[An earlier version of the page ({len(message['content'])} characters) was omitted. The latest version appears later in the conversation.]"
+        }
+
+
+class SlidingWindowPolicy(ContextPolicy):
+    """
+    Pins the system messages and sends only the most recent messages of the conversation.
+    """
+
+    name = "sliding_window"
+
+    def __init__(self, max_messages: int):
+        """
+        :param max_messages: The number of most recent non-system messages to send.
+        """
+        super().__init__()
+        self.max_messages = max_messages
+
+    def select(self, messages: list) -> list:
+        pinned, history = split_pinned(messages)
+        return pinned + history[-self.max_messages:]
+
+
+class SummarizingPolicy(ContextPolicy):
+    """
+    Pins the system messages, sends the most recent messages verbatim and folds older messages
+    into a running summary that is sent as an extra system message.
+    """
+
+    name = "summarize"
+    blocking = True
+
+    def __init__(self, summarize, keep_messages: int, max_tokens: int):
+        """
+        :param summarize: A callable taking the previous summary and a list of messages and returning a new summary.
+        :param keep_messages: The number of most recent non-system messages always sent verbatim.
+        :param max_tokens: Older messages are only summarized once the history exceeds this many tokens.
+        """
+        super().__init__()
+        self.summarize = summarize
+        self.keep_messages = keep_messages
+        self.max_tokens = max_tokens
+        self.summary = ""
+        self.summarized_count = 0
+        self.summary_calls = 0
+
+    def select(self, messages: list) -> list:
+        pinned, history = split_pinned(messages)
+
+        if self.summarized_count > len(history):
+            # The history was reset underneath us
+            self.reset()
+
+        unsummarized = history[self.summarized_count:]
+        if len(unsummarized) > self.keep_messages and count_message_tokens(pinned + unsummarized) > self.max_tokens:
+            to_fold = unsummarized[:-self.keep_messages] if self.keep_messages else unsummarized
+            try:
+                self.summary = self.summarize(self.summary, to_fold)
+                self.summarized_count += len(to_fold)
+                self.summary_calls += 1
+                unsummarized = history[self.summarized_count:]
+            except Exception as e:
+                print(f"An error occurred while summarizing the conversation: {e}")
+
+        if self.summary:
+            pinned = pinned + [{"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"}]
+        return pinned + unsummarized
+
+    def reset(self):
+        self.summary = ""
+        self.summarized_count = 0
+
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        stats["summary_calls"] = self.summary_calls
+        return stats
@@ -0,0 +1,44 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import threading
+
+class CredentialProfiles:
+    def __init__(self):
+        """
+        Initializes the CredentialProfiles registry, which maps a profile name to an endpoint, API version and key
+        so that persisted agent state can reference credentials by name instead of embedding them.
+        """
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, api_key: str, api_version: str, base_url: str):
+        """
+        Registers or replaces a credential profile.
+
+        :param name: The name of the profile.
+        :param api_key: The API key for Azure OpenAI.
+        :param api_version: The API version for Azure OpenAI.
+        :param base_url: The base URL for Azure OpenAI.
+        """
+        with self._lock:
+            self._profiles[name] = {
+                "api_key": api_key,
+                "api_version": api_version,
+                "base_url": base_url
+            }
+
+    def get(self, name: str) -> dict:
+        """
+        Returns a credential profile.
+
+        :param name: The name of the profile.
+        :return: A dictionary with the api_key, api_version and base_url of the profile.
+        """
+        profile = self._profiles.get(name)
+        if profile is None:
+            raise KeyError(f"No credential profile registered with name '{name}'")
+        return profile
+
+# Process-wide registry shared by all agents
+credential_profiles = CredentialProfiles()
@@ -1,13 +1,16 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-from openai import AzureOpenAI
+from client_pool import client_registry
+from credential_profiles import credential_profiles
+from agent_journal import AgentJournal
+from agent_metrics import IMAGE_LATENCY, IMAGE_REQUESTS, IMAGE_RETRIES
+from call_scheduler import image_scheduler, priority_for_role
 import json
-import os
 import re
 
 class DallEAgent:
-    def __init__(self, api_key: str, api_version: str, base_url:str, model: str = "dall-e-3", messages: list = None):
+    def __init__(self, api_key: str = None, api_version: str = None, base_url:str = None, model: str = "dall-e-3", messages: list = None, credential_profile: str = None):
         """
         Initialize the ImageGenerationAgent with the necessary API key.
 
@@ -16,19 +19,26 @@ class DallEAgent:
         :param base_url: The base URL for Azure OpenAI.
         :param model: The model name to use, default is 'gpt-4o'.
         :param messages: An optional list of messages to initialize the conversation history.
+        :param credential_profile: An optional name of a registered credential profile, used instead of the API key, API version and base URL and persisted by reference.
         """
+        if credential_profile:
+            profile = credential_profiles.get(credential_profile)
+            api_key = profile["api_key"]
+            api_version = profile["api_version"]
+            base_url = profile["base_url"]
+
         self.api_key = api_key
         self.api_version = api_version
         self.base_url = base_url
         self.model = model
         self.messages = messages if messages is not None else []
+        self.credential_profile = credential_profile
+        self.journal = AgentJournal()
+        # Label for metrics; AgentFactory sets it to the agent's role
+        self.role = "image_gen_agent"
 
         print("Initializing ImageGenerationAgent...")
-        self.client = AzureOpenAI(
-            api_key=api_key,
-            api_version=api_version,
-            azure_endpoint=base_url
-        )
+        self.client = client_registry.get_client(api_key, api_version, base_url)
         print("Initialization complete.")
 
     def extract_revised_prompt(self, error_message: str) -> str:
@@ -64,44 +74,110 @@ class DallEAgent:
             print(f"Exception occurred: {e}")
             return None
 
-    def generate_image(self, prompt, size="1024x1024", retries=3):
+    def generate_image(self, prompt, size="1024x1024", retries=3, response_format="url", quality="standard"):
         """
         Generate an image based on the provided prompt.
 
         :param prompt: The textual description for the image.
         :param size: The size of the generated image (default is '1024x1024').
-        :param retries: The number of retries if the initial prompt fails (default is 3).
-        :return: The URL of the generated image.
+        :param retries: The number of retries with a revised prompt if the initial prompt is rejected (default is 3). Rate limited calls are retried by the scheduler.
+        :param response_format: 'url' to return the URL of the image, or 'b64_json' to return the image itself, base64 encoded (default is 'url').
+        :param quality: 'standard', or 'hd' for finer detail at a higher cost and latency (default is 'standard').
+        :return: The URL or the base64 encoded data of the generated image.
         """
         retry_count = 0
 
-        while retry_count < retries:
-            try:
-                print(f"Generating image with prompt: '{prompt}' and size: '{size}'")
-                response = self.client.images.generate(
-                    prompt=prompt,
-                    n=1,
-                    size=size,
-                    quality="standard",
-                    model=self.model
-                )
-                print("Image generation response received.")
-                if response.data and response.data[0].url is not None:
-                    image_url = response.data[0].url
-                    print(f"Generated image URL: {image_url}")
-                    return image_url
-                else:
-                    print("No image URL found.")
-                    break
-            except Exception as e:
-                print(f"An error occurred during image generation: {e}")
-                revised_prompt = self.extract_revised_prompt(str(e))
-                if revised_prompt:
-                    prompt = revised_prompt
+        with IMAGE_LATENCY.time():
+            while retry_count < retries:
+                try:
+                    print(f"Generating image with prompt: '{prompt}', size: '{size}' and quality: '{quality}'")
+                    response = image_scheduler.call(priority_for_role(self.role), 0, lambda: self.client.images.generate(
+                        prompt=prompt,
+                        n=1,
+                        size=size,
+                        quality=quality,
+                        model=self.model,
+                        response_format=response_format
+                    ))
+                    return self.get_image_data(response, response_format)
+                except Exception as e:
+                    prompt = self.get_retry_prompt(e)
+                    if not prompt:
+                        break
                     retry_count += 1
+                    IMAGE_RETRIES.inc()
                     print(f"Retrying with revised prompt: '{prompt}' (Retry {retry_count}/{retries})")
-                else:
-                    break
+
+        IMAGE_REQUESTS.labels("error").inc()
+
+    async def agenerate_image(self, prompt, size="1024x1024", retries=3, response_format="url", quality="standard"):
+        """
+        Generate an image based on the provided prompt without blocking the event loop.
+
+        :param prompt: The textual description for the image.
+        :param size: The size of the generated image (default is '1024x1024').
+        :param retries: The number of retries with a revised prompt if the initial prompt is rejected (default is 3). Rate limited calls are retried by the scheduler.
+        :param response_format: 'url' to return the URL of the image, or 'b64_json' to return the image itself, base64 encoded (default is 'url').
+        :param quality: 'standard', or 'hd' for finer detail at a higher cost and latency (default is 'standard').
+        :return: The URL or the base64 encoded data of the generated image.
+        """
+        client = client_registry.get_async_client(self.api_key, self.api_version, self.base_url)
+        retry_count = 0
+
+        with IMAGE_LATENCY.time():
+            while retry_count < retries:
+                try:
+                    print(f"Generating image with prompt: '{prompt}', size: '{size}' and quality: '{quality}'")
+                    response = await image_scheduler.acall(priority_for_role(self.role), 0, lambda: client.images.generate(
+                        prompt=prompt,
+                        n=1,
+                        size=size,
+                        quality=quality,
+                        model=self.model,
+                        response_format=response_format
+                    ))
+                    return self.get_image_data(response, response_format)
+                except Exception as e:
+                    prompt = self.get_retry_prompt(e)
+                    if not prompt:
+                        break
+                    retry_count += 1
+                    IMAGE_RETRIES.inc()
+                    print(f"Retrying with revised prompt: '{prompt}' (Retry {retry_count}/{retries})")
+
+        IMAGE_REQUESTS.labels("error").inc()
+
+    def get_image_data(self, response, response_format: str = "url"):
+        """
+        Extracts the image URL or the base64 encoded image from an image generation response.
+
+        :param response: The image generation response.
+        :param response_format: The response format the image was requested in, 'url' or 'b64_json'.
+        :return: The URL or the base64 encoded data of the generated image, or None if the response has none.
+        """
+        print("Image generation response received.")
+        if response.data and response_format == "b64_json" and response.data[0].b64_json is not None:
+            print(f"Generated image data ({len(response.data[0].b64_json)} base64 characters)")
+            IMAGE_REQUESTS.labels("ok").inc()
+            return response.data[0].b64_json
+        if response.data and response_format != "b64_json" and response.data[0].url is not None:
+            image_url = response.data[0].url
+            print(f"Generated image URL: {image_url}")
+            IMAGE_REQUESTS.labels("ok").inc()
+            return image_url
+        print("No image URL found.")
+        IMAGE_REQUESTS.labels("no_image").inc()
+        return None
+
+    def get_retry_prompt(self, error: Exception) -> str:
+        """
+        Determines the prompt to retry with after a failed image generation.
+
+        :param error: The exception raised by the image generation request.
+        :return: The revised prompt suggested by the service, or None if the request should not be retried.
+        """
+        print(f"An error occurred during image generation: {error}")
+        return self.extract_revised_prompt(str(error))
 
     def serialize(self) -> str:
         """
@@ -109,13 +185,24 @@ class DallEAgent:
 
         :return: A JSON string representing the state of the agent.
         """
-        return json.dumps({
-            "api_key": self.api_key,
-            "api_version": self.api_version,
-            "base_url": self.base_url,
-            "model": self.model,
-            "messages": self.messages
-        })
+        return json.dumps(self.get_state())
+
+    def get_state(self) -> dict:
+        """
+        Returns the persisted state of the agent.
+
+        :return: A dictionary representing the state of the agent.
+        """
+        state = {"model": self.model, "messages": self.messages}
+
+        if self.credential_profile:
+            state["credential_profile"] = self.credential_profile
+        else:
+            state["api_key"] = self.api_key
+            state["api_version"] = self.api_version
+            state["base_url"] = self.base_url
+
+        return state
 
     @classmethod
     def deserialize(cls, json_str: str):
@@ -125,13 +212,23 @@ class DallEAgent:
         :param json_str: A JSON string representing the state of the agent.
         :return: A DallEAgent instance.
         """
-        data = json.loads(json_str)
+        return cls.from_state(json.loads(json_str))
+
+    @classmethod
+    def from_state(cls, data: dict):
+        """
+        Creates a DallEAgent instance from its persisted state.
+
+        :param data: A dictionary representing the state of the agent.
+        :return: A DallEAgent instance.
+        """
         return cls(
-            api_key=data["api_key"],
-            api_version=data["api_version"],
-            base_url=data["base_url"],
+            api_key=data.get("api_key"),
+            api_version=data.get("api_version"),
+            base_url=data.get("base_url"),
             model=data["model"],
-            messages=data["messages"]
+            messages=data["messages"],
+            credential_profile=data.get("credential_profile")
         )
 
     def save(self, filepath: str):
@@ -140,10 +237,7 @@ class DallEAgent:
         
         :param filepath: The path to the file where the state should be saved.
         """
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        
-        with open(filepath, 'w') as f:
-            f.write(self.serialize())
+        self.journal.save(filepath, self.get_state())
 
     @classmethod
     def load(cls, filepath: str):
@@ -153,6 +247,7 @@ class DallEAgent:
         :param filepath: The path to the file from which the state should be loaded.
         :return: A DallEAgent instance.
         """
-        with open(filepath, 'r') as f:
-            json_str = f.read()
-        return cls.deserialize(json_str)
\ No newline at end of file
+        state, journal = AgentJournal.load(filepath)
+        agent = cls.from_state(state)
+        agent.journal = journal
+        return agent
\ No newline at end of file
@@ -0,0 +1,54 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import threading
+
+class PromptRegistry:
+    def __init__(self):
+        """
+        Initializes the PromptRegistry, which holds versioned system prompts so that persisted
+        agent state can reference a prompt by ID instead of embedding its text.
+        """
+        self._prompts = {}
+        self._lock = threading.Lock()
+
+    def register(self, prompt_id: str, version: int, text: str):
+        """
+        Registers a version of a system prompt. The highest registered version is the current one.
+
+        :param prompt_id: The ID of the prompt, e.g. 'template_agent'.
+        :param version: The version number of the prompt.
+        :param text: The text of the prompt.
+        """
+        with self._lock:
+            self._prompts.setdefault(prompt_id, {})[version] = text
+
+    def get(self, prompt_id: str, version: int = None) -> str:
+        """
+        Returns the text of a system prompt.
+
+        :param prompt_id: The ID of the prompt.
+        :param version: An optional version number, default is the current version.
+        :return: The text of the prompt.
+        """
+        versions = self._prompts.get(prompt_id)
+        if not versions:
+            raise KeyError(f"No system prompt registered with ID '{prompt_id}'")
+        if version is None:
+            version = self.get_current_version(prompt_id)
+        return versions[version]
+
+    def get_current_version(self, prompt_id: str) -> int:
+        """
+        Returns the current (highest) version number of a system prompt.
+
+        :param prompt_id: The ID of the prompt.
+        :return: The current version number.
+        """
+        versions = self._prompts.get(prompt_id)
+        if not versions:
+            raise KeyError(f"No system prompt registered with ID '{prompt_id}'")
+        return max(versions)
+
+# Process-wide registry shared by all agents
+prompt_registry = PromptRegistry()
@@ -0,0 +1,170 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+class ResponseCache:
+    def __init__(self, cache_dir: str, max_entries: int = 1000, ttl_seconds: float = 7 * 24 * 60 * 60, max_disk_bytes: int = 100 * 1024 * 1024):
+        """
+        Initializes the ResponseCache, a content-addressed cache of model responses with an
+        in-memory LRU in front of a persistent on-disk store.
+
+        :param cache_dir: The directory of the on-disk store.
+        :param max_entries: The maximum number of responses kept in memory.
+        :param ttl_seconds: The number of seconds a response stays valid.
+        :param max_disk_bytes: The maximum size of the on-disk store; the oldest entries are evicted first.
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._disk_bytes = sum(os.path.getsize(path) for path in self._disk_entries())
+
+    @staticmethod
+    def make_key(model: str, messages: list, **params) -> str:
+        """
+        Builds the cache key for a request from the model, the normalized messages and the request parameters.
+
+        :param model: The model (deployment) name.
+        :param messages: The list of messages sent to the model.
+        :param params: Any other request parameters that affect the response.
+        :return: A hex digest identifying the request.
+        """
+        normalized_messages = [
+            {"role": msg["role"], "content": _WHITESPACE_PATTERN.sub(" ", str(msg.get("content") or "")).strip()}
+            for msg in messages
+        ]
+        payload = json.dumps({"model": model, "messages": normalized_messages, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """
+        Looks up a response, first in memory and then on disk.
+
+        :param key: The cache key of the request.
+        :return: The cached response, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry["created"] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry["value"]
+
+            entry = self._read_disk_entry(key)
+            if entry and now - entry["created"] < self.ttl_seconds:
+                self._remember(key, entry)
+                self.disk_hits += 1
+                return entry["value"]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: str):
+        """
+        Stores a response in memory and on disk.
+
+        :param key: The cache key of the request.
+        :param value: The response to store.
+        """
+        entry = {"created": time.time(), "value": value}
+        with self._lock:
+            self._remember(key, entry)
+            self._write_disk_entry(key, entry)
+            self.stores += 1
+
+    def get_stats(self) -> dict:
+        """
+        Returns the hit and miss counters of the cache.
+
+        :return: A dictionary of cache statistics.
+        """
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "disk_bytes": self._disk_bytes
+        }
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _disk_entries(self):
+        for root, dirs, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith(".json"):
+                    yield os.path.join(root, file)
+
+    def _read_disk_entry(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Discarding unreadable cache entry {path}: {e}")
+            self._remove_disk_entry(path)
+            return None
+
+    def _write_disk_entry(self, key, entry):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            self._disk_bytes -= os.path.getsize(path)
+
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(temp_path, path)
+        self._disk_bytes += os.path.getsize(path)
+
+        if self._disk_bytes > self.max_disk_bytes:
+            self._evict_disk_entries()
+
+    def _evict_disk_entries(self):
+        # Evict expired entries and then the least recently written ones until the store fits its budget
+        now = time.time()
+        paths = sorted(self._disk_entries(), key=os.path.getmtime)
+        for path in paths:
+            if self._disk_bytes <= self.max_disk_bytes and now - os.path.getmtime(path) < self.ttl_seconds:
+                break
+            self._remove_disk_entry(path)
+            self.evictions += 1
+
+    def _remove_disk_entry(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._disk_bytes -= size
+        except OSError:
+            pass
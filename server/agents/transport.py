@@ -0,0 +1,394 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+import httpx
+
+# Stand-in transports for the Azure OpenAI clients, so the whole pipeline can run offline:
+# 'record' passes requests through to the service and writes every exchange to a cassette file,
+# 'replay' answers from a cassette and 'synthesize' makes up responses locally.
+LIVE = "live"
+RECORD = "record"
+REPLAY = "replay"
+SYNTHESIZE = "synthesize"
+
+
+def request_key(request: httpx.Request) -> str:
+    """
+    Identifies a request by its method, path and canonical JSON body, ignoring the host and query string.
+
+    :param request: The outgoing request.
+    :return: A hex digest identifying the request.
+    """
+    body = request.content or b""
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True).encode("utf-8")
+    except ValueError:
+        pass
+    digest = hashlib.sha256()
+    digest.update(request.method.encode("utf-8"))
+    digest.update(urlsplit(str(request.url)).path.encode("utf-8"))
+    digest.update(body)
+    return digest.hexdigest()
+
+
+class Cassette:
+    def __init__(self, path: str):
+        """
+        Initializes a Cassette, a JSON-lines file of recorded request/response exchanges.
+        Identical requests are replayed in the order they were recorded, repeating the last one.
+
+        :param path: The path of the cassette file.
+        """
+        self.path = path
+        self._exchanges = defaultdict(list)
+        self._positions = defaultdict(int)
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        exchange = json.loads(line)
+                        self._exchanges[exchange["key"]].append(exchange["response"])
+            print(f"Loaded {sum(len(v) for v in self._exchanges.values())} recorded exchanges from {path}")
+
+    def append(self, key: str, request: httpx.Request, status_code: int, headers: dict, body: bytes):
+        """
+        Records an exchange.
+
+        :param key: The key of the request.
+        :param request: The request that was sent.
+        :param status_code: The status code of the response.
+        :param headers: The headers of the response.
+        :param body: The body of the response.
+        """
+        response = {"status_code": status_code, "headers": headers, "body": body.decode("utf-8")}
+        exchange = {"key": key, "method": request.method, "path": urlsplit(str(request.url)).path, "response": response}
+        with self._lock:
+            self._exchanges[key].append(response)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(exchange) + "\n")
+
+    def next_response(self, key: str) -> dict:
+        """
+        Returns the next recorded response for a request.
+
+        :param key: The key of the request.
+        :return: The recorded response, or None if the request was never recorded.
+        """
+        with self._lock:
+            responses = self._exchanges.get(key)
+            if not responses:
+                return None
+            position = self._positions[key]
+            self._positions[key] = position + 1
+            return responses[min(position, len(responses) - 1)]
+
+
+class _Chunks(httpx.SyncByteStream, httpx.AsyncByteStream):
+    # Streams a response body event by event, pausing between events to mimic token streaming
+    def __init__(self, body: bytes, chunk_delay: float):
+        self.chunks = [chunk + b"\n\n" for chunk in body.split(b"\n\n") if chunk] if b"\n\n" in body else [body]
+        self.chunk_delay = chunk_delay
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            yield chunk
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            yield chunk
+
+
+class _StandInTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    def __init__(self, latency: float = 0.0, chunk_delay: float = 0.0):
+        """
+        :param latency: Seconds to wait before answering each request.
+        :param chunk_delay: Seconds to wait between the events of a streamed response.
+        """
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+
+    def respond(self, request: httpx.Request):
+        """
+        Produces the response to a request. Subclasses override this.
+
+        :param request: The outgoing request.
+        :return: A tuple of (status code, headers, body).
+        """
+        raise NotImplementedError
+
+    def _build_response(self, request, status_code, headers, body):
+        headers = {k: v for k, v in headers.items() if k.lower() not in ("content-length", "content-encoding", "transfer-encoding")}
+        return httpx.Response(status_code, headers=headers, stream=_Chunks(body, self.chunk_delay), request=request)
+
+    def handle_request(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._build_response(request, *self.respond(request))
+
+    async def handle_async_request(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._build_response(request, *self.respond(request))
+
+
+class ReplayTransport(_StandInTransport):
+    def __init__(self, cassette: Cassette, image_base_url: str = None, latency: float = 0.0, chunk_delay: float = 0.0):
+        """
+        Answers requests from a cassette. Recorded image URLs expire, so they are pointed at the local image stub instead.
+
+        :param cassette: The cassette to replay.
+        :param image_base_url: The base URL of the local image stub, if image URLs should be rewritten.
+        :param latency: Seconds to wait before answering each request.
+        :param chunk_delay: Seconds to wait between the events of a streamed response.
+        """
+        super().__init__(latency, chunk_delay)
+        self.cassette = cassette
+        self.image_base_url = image_base_url
+
+    def respond(self, request):
+        key = request_key(request)
+        response = self.cassette.next_response(key)
+        if response is None:
+            print(f"No recorded response for {request.method} {request.url.path}")
+            body = json.dumps({"error": {"code": "NotRecorded", "message": "No recorded response for this request."}})
+            return 404, {"content-type": "application/json"}, body.encode("utf-8")
+
+        body = response["body"].encode("utf-8")
+        if self.image_base_url and "/images/generations" in request.url.path and response["status_code"] == 200:
+            data = json.loads(body)
+            size = json.loads(request.content or b"{}").get("size", "1024x1024")
+            for index, item in enumerate(data.get("data", [])):
+                if item.get("url"):
+                    item["url"] = f"{self.image_base_url}/{size}/{key[:16]}{index}.png"
+            body = json.dumps(data).encode("utf-8")
+        return response["status_code"], response["headers"], body
+
+
+class SyntheticTransport(_StandInTransport):
+    def __init__(self, image_base_url: str, latency: float = 0.0, chunk_delay: float = 0.0):
+        """
+        Makes up plausible responses locally: HTML pages with image placeholders for the template agent,
+        short replies for the other agents and image URLs served by the local image stub.
+
+        :param image_base_url: The base URL of the local image stub.
+        :param latency: Seconds to wait before answering each request.
+        :param chunk_delay: Seconds to wait between the events of a streamed response.
+        """
+        super().__init__(latency, chunk_delay)
+        self.image_base_url = image_base_url
+
+    def respond(self, request):
+        payload = json.loads(request.content or b"{}")
+        if "/images/generations" in request.url.path:
+            return self._image_response(request, payload)
+        return self._chat_response(payload)
+
+    def _image_response(self, request, payload):
+        size = payload.get("size", "1024x1024")
+        name = request_key(request)[:16]
+        item = {"revised_prompt": payload.get("prompt", "")}
+        if payload.get("response_format") == "b64_json":
+            width, height = (int(v) for v in size.split("x"))
+            item["b64_json"] = base64.b64encode(synthetic_png(width, height, name)).decode("ascii")
+        else:
+            item["url"] = f"{self.image_base_url}/{size}/{name}.png"
+        body = json.dumps({"created": int(time.time()), "data": [item]})
+        return 200, {"content-type": "application/json"}, body.encode("utf-8")
+
+    def _chat_response(self, payload):
+        messages = payload.get("messages", [])
+        system_message = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        last_message = messages[-1]["content"] if messages else ""
+
+        if (payload.get("response_format") or {}).get("type") == "json_object" and '"prompts"' in last_message:
+            # Batched image prompts: the descriptions are a JSON list in the user message before the instructions
+            try:
+                descriptions = json.loads(messages[-2]["content"])
+            except (IndexError, ValueError):
+                descriptions = []
+            content = json.dumps({"prompts": [f"A detailed, photorealistic image of {description}" for description in descriptions]})
+        elif (payload.get("response_format") or {}).get("type") == "json_object":
+            content = json.dumps({"reply": "Your website is underway! What tone should it have?", "choices": ["Playful", "Professional", "Minimal"], "title": "Synthetic Site"})
+        elif "HTML" in system_message:
+            content = _SYNTHETIC_PAGE
+        elif "title" in system_message:
+            content = "{Synthetic Site}"
+        elif "image prompt" in system_message:
+            content = f"A detailed, photorealistic image of {last_message}"
+        else:
+            content = 'Your website is underway! What tone should it have? {"choices": ["Playful", "Professional", "Minimal"]}'
+
+        usage = {"prompt_tokens": sum(len(str(m.get("content", ""))) for m in messages) // 4, "completion_tokens": len(content) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if payload.get("stream"):
+            events = []
+            for start in range(0, len(content), 40):
+                chunk = {"id": "synthetic", "object": "chat.completion.chunk", "created": int(time.time()), "model": payload.get("model"),
+                         "choices": [{"index": 0, "delta": {"content": content[start:start + 40]}, "finish_reason": None}]}
+                events.append(f"data: {json.dumps(chunk)}\n\n")
+            events.append("data: [DONE]\n\n")
+            return 200, {"content-type": "text/event-stream"}, "".join(events).encode("utf-8")
+
+        body = {"id": "synthetic", "object": "chat.completion", "created": int(time.time()), "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}], "usage": usage}
+        return 200, {"content-type": "application/json"}, json.dumps(body).encode("utf-8")
+
+
+class RecordingTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    def __init__(self, cassette: Cassette, limits: httpx.Limits, is_async: bool):
+        """
+        Passes requests through to the service and records every exchange in a cassette.
+
+        :param cassette: The cassette to record to.
+        :param limits: The connection limits of the underlying transport.
+        :param is_async: Whether the transport serves an async client.
+        """
+        self.cassette = cassette
+        self.inner = httpx.AsyncHTTPTransport(limits=limits) if is_async else httpx.HTTPTransport(limits=limits)
+
+    def handle_request(self, request):
+        response = self.inner.handle_request(request)
+        body = response.read()
+        self.cassette.append(request_key(request), request, response.status_code, dict(response.headers), body)
+        return httpx.Response(response.status_code, headers=response.headers, content=body, request=request)
+
+    async def handle_async_request(self, request):
+        response = await self.inner.handle_async_request(request)
+        body = await response.aread()
+        self.cassette.append(request_key(request), request, response.status_code, dict(response.headers), body)
+        return httpx.Response(response.status_code, headers=response.headers, content=body, request=request)
+
+    def close(self):
+        self.inner.close()
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+def create_transport_factory(mode: str, cassette_path: str = None, image_base_url: str = None, latency: float = 0.0, chunk_delay: float = 0.0):
+    """
+    Builds the transport factory for the client registry for a transport mode.
+
+    :param mode: One of 'live', 'record', 'replay' or 'synthesize'.
+    :param cassette_path: The cassette file to record to or replay from.
+    :param image_base_url: The base URL of the local image stub, used by 'replay' and 'synthesize'.
+    :param latency: Seconds to wait before answering each request, used by 'replay' and 'synthesize'.
+    :param chunk_delay: Seconds to wait between the events of a streamed response, used by 'replay' and 'synthesize'.
+    :return: A callable taking (limits, is_async) and returning a transport, or None for live traffic.
+    """
+    if mode == LIVE:
+        return None
+    if mode == SYNTHESIZE:
+        transport = SyntheticTransport(image_base_url, latency, chunk_delay)
+        return lambda limits, is_async: transport
+
+    cassette = Cassette(cassette_path)
+    if mode == REPLAY:
+        transport = ReplayTransport(cassette, image_base_url, latency, chunk_delay)
+        return lambda limits, is_async: transport
+    if mode == RECORD:
+        return lambda limits, is_async: RecordingTransport(cassette, limits, is_async)
+    raise ValueError(f"Unknown agent transport mode '{mode}'")
+
+
+def synthetic_png(width: int, height: int, seed: str) -> bytes:
+    """
+    Renders a solid-color PNG whose color is derived from a seed.
+
+    :param width: The width of the image.
+    :param height: The height of the image.
+    :param seed: Any string; equal seeds give equal colors.
+    :return: The PNG bytes.
+    """
+    color = hashlib.sha256(seed.encode("utf-8")).digest()[:3]
+    row = b"\x00" + color * width
+    raw = zlib.compress(row * height, 9)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", raw) + chunk(b"IEND", b"")
+
+
+class _ImageStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # Paths look like /<width>x<height>/<name>.png
+        parts = self.path.strip("/").split("/")
+        try:
+            width, height = (int(v) for v in parts[0].split("x"))
+            body = synthetic_png(min(width, 2048), min(height, 2048), parts[-1])
+        except (ValueError, IndexError):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_image_stub = None
+_image_stub_lock = threading.Lock()
+
+def start_image_stub(port: int) -> str:
+    """
+    Starts the local HTTP stub that serves synthesized images, if it is not running yet.
+
+    :param port: The port to listen on, on 127.0.0.1.
+    :return: The base URL of the stub.
+    """
+    global _image_stub
+    with _image_stub_lock:
+        if _image_stub is None:
+            _image_stub = ThreadingHTTPServer(("127.0.0.1", port), _ImageStubHandler)
+            threading.Thread(target=_image_stub.serve_forever, name="image-stub", daemon=True).start()
+            print(f"Serving synthesized images on http://127.0.0.1:{port}")
+    return f"http://127.0.0.1:{port}"
+
+
+_SYNTHETIC_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>Synthetic Site</title>
+<style>
+.hero { height: 400px; background-size: cover; background-image: url("/img/loading_gradient.gif"); /*A soaring futuristic cityscape for the site banner.*/ }
+.cards { display: flex; gap: 16px; padding: 16px; }
+.card img { width: 100%; border-radius: 5px; }
+</style>
+</head>
+<body>
+<header class="hero"><h1>Synthetic Site</h1></header>
+<main class="cards">
+<div class="card"><img src="/img/loading_gradient.gif" alt="A spread of delicious custom cookies on a colorful background."></div>
+<div class="card"><img src="/img/loading_gradient.gif" alt="A cozy bakery storefront on a rainy evening."></div>
+<div class="card"><img src="/img/loading_gradient.gif" alt="Icon of a smiling cupcake."></div>
+</main>
+<footer>Made offline</footer>
+</body>
+</html>"""
@@ -1,18 +1,19 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-from flask import Flask, request, jsonify, send_from_directory, url_for
+from flask import Flask, Response, request, jsonify, send_from_directory, url_for
 from mimetypes import guess_type
 from flask_cors import CORS
 import os
 from agent_factory import AgentFactory
-import requests
 import re
 import asyncio
 import json
 import pypandoc
 import csv
 import openpyxl
+import time
+import threading
 
 from pypdf import PdfReader
 from config import config
@@ -21,7 +22,13 @@ from azure.mgmt.resource import ResourceManagementClient
 from azure.mgmt.storage import StorageManagementClient
 from azure.mgmt.resource.subscriptions import SubscriptionClient
 from azure.storage.blob import BlobServiceClient, ContentSettings, StaticWebsite
-from image_populator import ImagePopulator
+from image_populator import ImagePopulator, PageReplaced
+from image_downloader import image_downloader
+from agent_loop import run_on_agent_loop
+from job_executor import job_executor, JobCancelled
+from event_hub import event_hub, format_event
+from agents import prompt_registry, MalformedResponseError
+from metrics import TEMPLATE_READY_LATENCY, IMAGES_READY_LATENCY, render_metrics
 
 app = Flask(__name__)
 CORS(app)
@@ -35,6 +42,7 @@ import shutil
 
 @app.route('/sendprompt/<sessionId>', methods=['POST'])
 async def send_prompt(sessionId):
+    started = time.perf_counter()
     if 'prompt' not in request.form:
         return jsonify({"error": "No prompt provided"}), 400
 
@@ -43,7 +51,13 @@ async def send_prompt(sessionId):
     file_content = None
 
     session_dir = get_session_directory(sessionId)
+    # The images of the old page are no longer wanted; a run that commits before the cancellation lands finds
+    # index.html replaced and stops by itself
+    job_executor.cancel_session(sessionId, job_type="images")
     deprecate_index_template(sessionId)
+    # Subscribers start over with the new page instead of replaying the events of the old one
+    event_hub.reset(sessionId)
+    event_hub.publish(sessionId, "started")
     if not os.path.exists(session_dir):
         os.makedirs(session_dir)
 
@@ -65,13 +79,30 @@ async def send_prompt(sessionId):
             else:
                 file_content = saveAttachment(file, sessionId)
 
-        plaintext_response = orchestrator_agent.send_prompt(prompt, file_content)
-        asyncio.create_task(asyncio.to_thread(process_details, prompt, file_content, sessionId, session_title_agent))
-        asyncio.create_task(asyncio.to_thread(process_template, prompt, file_content, sessionId, template_agent))
+        session_title = None
+        plaintext_response = None
+        if config.ORCHESTRATOR_STRUCTURED_REPLY and not os.path.exists(os.path.join(session_dir, "details.json")):
+            try:
+                structured_reply = await run_on_agent_loop(orchestrator_agent.asend_json_prompt(
+                    prompt, file_content,
+                    instructions=prompt_registry.get("orchestrator_structured_reply"),
+                    render=render_orchestrator_reply
+                ))
+                plaintext_response = render_orchestrator_reply(structured_reply)
+                session_title = structured_reply.get("title")
+            except MalformedResponseError as e:
+                # Fall back to a plain reply; the title agent generates the title instead
+                print(f"Structured orchestrator reply for session {sessionId} was malformed, falling back to plain text: {e}")
+        if plaintext_response is None:
+            plaintext_response = await run_on_agent_loop(orchestrator_agent.asend_prompt(prompt, file_content))
+        title_job_id = job_executor.submit("title", process_details(prompt, file_content, sessionId, session_title_agent, session_title), session_id=sessionId)
+        template_url = url_for('serve_html_template', session_id=sessionId, filename='index.html', _external=True)
+        template_job_id = job_executor.submit("template", process_template(prompt, file_content, sessionId, template_agent, started, template_url), session_id=sessionId)
         orchestrator_agent.save(os.path.join(session_dir, 'agents', 'orchestrator_agent.json'))
 
         return jsonify({
-            "response": plaintext_response
+            "response": plaintext_response,
+            "jobs": {"title": title_job_id, "template": template_job_id}
         }), 200
     except Exception as e:
         print(e)
@@ -82,6 +113,10 @@ def deprecate_index_template(sessionId):
     os.makedirs(template_dir, exist_ok=True)
     index_path = os.path.join(template_dir, 'index.html')
     deprecated_path = os.path.join(template_dir, 'index.html.old')
+    partial_path = get_partial_template_path(sessionId)
+
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
     
     if os.path.exists(index_path):
         if os.path.exists(deprecated_path):
@@ -93,12 +128,23 @@ async def get_output(sessionId):
     html_content = None
     session_dir = get_session_directory(sessionId)
     template_path = os.path.join(session_dir, 'template', 'index.html')
+    partial_path = get_partial_template_path(sessionId)
 
     if os.path.exists(template_path):
         with open(template_path, 'r', encoding='utf-8') as f:
             html_content = f.read()
 
         template_url = url_for('serve_html_template', session_id=sessionId, filename='index.html', _external=True)
+    elif os.path.exists(partial_path):
+        # The template is still streaming in, return what has arrived so far
+        with open(partial_path, 'r', encoding='utf-8') as f:
+            html_content = f.read()
+
+        return jsonify({
+            "status": "partial",
+            "htmldata": trim_markdown(html_content),
+            "receivedchars": len(html_content)
+        }), 200
     else:
         # If the template does not exist yet, return a not ready status
         return jsonify({"status": "not ready"}), 200
@@ -113,30 +159,81 @@ async def get_output(sessionId):
 def image_ready_check(sessionId):
     session_dir = get_session_directory(sessionId)
     img_dir = os.path.join(session_dir, 'template', 'img')
-    lock_file = os.path.join(img_dir, 'images.lock')
-    
-    if os.path.exists(img_dir) and os.listdir(img_dir) and not os.path.exists(lock_file):
+
+    if os.path.exists(img_dir) and os.listdir(img_dir) and not agent_factory.image_jobs.is_pending(sessionId):
         return jsonify({"images_ready": True}), 200
     else:
         return jsonify({"images_ready": False}), 200
 
+@app.route('/image_status/<sessionId>', methods=['GET'])
+def image_status(sessionId):
+    img_dir = os.path.join(get_session_directory(sessionId), 'template', 'img')
+    status_file = os.path.join(img_dir, 'status.json')
+    complete = not agent_factory.image_jobs.is_pending(sessionId)
+
+    if not os.path.exists(status_file):
+        return jsonify({"images": [], "counts": {"pending": 0, "ready": 0, "failed": 0}, "complete": complete}), 200
+
+    # ImagePopulator replaces the file atomically as each image is committed, so it is always complete
+    with open(status_file, 'r', encoding='utf-8') as f:
+        status = json.load(f)
+    status["complete"] = complete
+    return jsonify(status), 200
+
     
-def process_template(prompt, file_content, sessionId, template_agent):
-    html_response = template_agent.send_prompt(prompt, file_content)
-    session_dir = get_session_directory(sessionId)
-    template_agent.save(os.path.join(session_dir, 'agents', 'template_agent.json'))
-    html_response = trim_markdown(html_response)
-    saveTemplate(html_response, sessionId)
-    process_images(sessionId)
+async def process_template(prompt, file_content, sessionId, template_agent, started, template_url):
+    partial_path = get_partial_template_path(sessionId)
+    try:
+        with open(partial_path, 'w', encoding='utf-8') as partial_file:
+            # Chunks are published in batches, so a subscriber is not sent an event for every token
+            pending_chunks = []
+            published = {"offset": 0, "time": 0.0}
+
+            def publish_chunks():
+                text = "".join(pending_chunks)
+                pending_chunks.clear()
+                event_hub.publish(sessionId, "template_chunk", {"offset": published["offset"], "text": text})
+                published["offset"] += len(text)
+                published["time"] = time.perf_counter()
+
+            def write_chunk(chunk):
+                partial_file.write(chunk)
+                partial_file.flush()
+                pending_chunks.append(chunk)
+                if time.perf_counter() - published["time"] >= config.EVENT_TEMPLATE_CHUNK_INTERVAL_SECONDS:
+                    publish_chunks()
+
+            html_response = await template_agent.astream_prompt(prompt, file_content, on_chunk=write_chunk)
+            if pending_chunks:
+                publish_chunks()
 
-def process_details(prompt, file_content, sessionId, agent):
+        session_dir = get_session_directory(sessionId)
+        template_agent.save(os.path.join(session_dir, 'agents', 'template_agent.json'))
+        html_response = trim_markdown(html_response)
+        saveTemplate(html_response, sessionId)
+        TEMPLATE_READY_LATENCY.observe(time.perf_counter() - started)
+        event_hub.publish(sessionId, "template_ready", {"templateurl": template_url})
+    except (Exception, asyncio.CancelledError) as e:
+        event_hub.publish(sessionId, "job_failed", {"stage": "template", "error": str(e) or "Cancelled"})
+        raise
+    finally:
+        # Only drop the partial file once index.html is in place so /getoutput never sees a gap
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+    # The job keeps the wall clock time of the prompt, so the images-ready latency survives a restart
+    agent_factory.image_jobs.enqueue(sessionId, requested=time.time() - (time.perf_counter() - started))
+
+async def process_details(prompt, file_content, sessionId, agent, session_title=None):
     session_dir = get_session_directory(sessionId)
     details_file = os.path.join(session_dir, "details.json")
     has_details_file = os.path.exists(details_file)
 
     if not has_details_file:
-        session_title = generate_title_from_prompt(agent, file_content, sessionId, prompt)
-        agent.save(os.path.join(session_dir, 'agents', 'session_title_agent.json'))
+        # The title comes with the orchestrator's structured reply when enabled, otherwise the title agent generates it
+        if not session_title:
+            session_title = await generate_title_from_prompt(agent, file_content, sessionId, prompt)
+            agent.save(os.path.join(session_dir, 'agents', 'session_title_agent.json'))
         details = {
             "title": session_title,
             "sessionId": sessionId
@@ -145,15 +242,94 @@ def process_details(prompt, file_content, sessionId, agent):
         with open(details_file, "w", encoding="utf-8") as f:
             f.write(json.dumps(details))
         print(f"Created details for session {sessionId}")
+        event_hub.publish(sessionId, "title_ready", {"title": session_title})
     else:
         print(f"Details available for session {sessionId}")
 
 
-def process_images(sessionId):
+async def populate_images(job):
+    try:
+        await job_executor.run("images", process_images(job['session_id'], resume=job['resumed']), session_id=job['session_id'])
+    except JobCancelled:
+        # A cancelled run is not retried; the images committed so far stay on the page
+        print(f"Image population for session {job['session_id']} was cancelled")
+        event_hub.publish(job['session_id'], "job_failed", {"stage": "images", "error": "Cancelled"})
+        return
+    except PageReplaced as e:
+        # Not a failure; the job is queued again for the new page once its template is saved
+        print(f"Image population for session {job['session_id']} stopped: {e}")
+        return
+    except Exception as e:
+        event_hub.publish(job['session_id'], "job_failed", {"stage": "images", "error": str(e), "attempt": job['attempts']})
+        raise
+    IMAGES_READY_LATENCY.observe(time.time() - job['requested'])
+    event_hub.publish(job['session_id'], "images_ready")
+
+async def process_images(sessionId, resume=False):
     html_path = os.path.join(get_session_directory(sessionId), 'template', 'index.html')
     img_output_path = os.path.join(get_session_directory(sessionId), 'template', 'img')
-    image_populator = ImagePopulator(html_path=html_path, image_output_folder=img_output_path, session_id=sessionId, agents=agent_factory.get_or_create_agents(sessionId))
-    image_populator.process()
+    image_populator = ImagePopulator(html_path=html_path, image_output_folder=img_output_path, session_id=sessionId, agents=agent_factory.get_or_create_agents(sessionId), concurrency=config.IMAGE_POPULATOR_CONCURRENCY, batch_prompts=config.IMAGE_PROMPT_BATCH, image_cache=agent_factory.image_cache, image_response_format=config.IMAGE_RESPONSE_FORMAT, variant_widths=config.IMAGE_VARIANT_WIDTHS, variant_format=config.IMAGE_VARIANT_FORMAT, variant_quality=config.IMAGE_VARIANT_QUALITY, image_sizes=config.IMAGE_SIZES, infer_sizes=config.IMAGE_INFER_SIZES, large_image_quality=config.IMAGE_LARGE_QUALITY)
+    await image_populator.aprocess(resume)
+
+_image_workers_lock = threading.Lock()
+_image_workers_started = False
+
+def start_image_workers():
+    """
+    Starts the image job workers of this process once. Workers are started by the process that serves requests
+    rather than on import, since the reloader's watching process imports this module too and must not lease jobs.
+    """
+    global _image_workers_started
+    with _image_workers_lock:
+        if _image_workers_started:
+            return
+        _image_workers_started = True
+    agent_factory.image_jobs.start(populate_images, workers=config.IMAGE_JOB_WORKERS)
+
+@app.before_request
+def ensure_image_workers():
+    # Covers servers other than app.run, which never execute the __main__ block
+    start_image_workers()
+
+@app.route('/events/<sessionId>', methods=['GET'])
+def stream_events(sessionId):
+    # EventSource sends the ID of the last event it received when it reconnects
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('lastEventId', ''))
+    subscription = event_hub.subscribe(sessionId, int(last_event_id) if last_event_id.isdigit() else None)
+
+    def generate():
+        try:
+            yield f"retry: {config.EVENT_RETRY_MILLISECONDS}\n\n"
+            while not subscription.closed:
+                message = subscription.get(timeout=config.EVENT_KEEPALIVE_SECONDS)
+                # Comments keep proxies from closing an idle stream and reveal clients that went away
+                yield format_event(message) if message else ": keepalive\n\n"
+        finally:
+            subscription.close()
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    metrics, content_type = render_metrics()
+    return Response(metrics, mimetype=content_type)
+
+@app.route('/jobs/<jobId>', methods=['GET'])
+def get_job_status(jobId):
+    job = job_executor.get_job(jobId)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job), 200
+
+@app.route('/jobs/<jobId>/cancel', methods=['POST'])
+def cancel_job(jobId):
+    if job_executor.get_job(jobId) is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify({"cancelled": job_executor.cancel(jobId)}), 200
+
+@app.route('/sessionjobs/<sessionId>', methods=['GET'])
+def get_session_jobs(sessionId):
+    return jsonify({"jobs": job_executor.list_jobs(sessionId)}), 200
 
 @app.route("/jobs/<session_id>/<filename>", methods=["GET"])
 def serve_html_template(session_id, filename):
@@ -179,7 +355,7 @@ def serve_image(sessionid, filename):
     return send_from_directory(directory, filename)
 
 @app.route('/getimage/<session_id>', methods=['POST'])
-def get_image(session_id):
+async def get_image(session_id):
     if 'prompt' not in request.form:
         return jsonify({"error": "No prompt provided"}), 400
 
@@ -194,16 +370,13 @@ def get_image(session_id):
         image_gen_agent = agents["image_gen_agent"]
 
         # Get the image URL from the LLM client
-        image_url = image_gen_agent.generate_image(image_prompt)
+        image_url = await run_on_agent_loop(image_gen_agent.agenerate_image(image_prompt))
 
         # Download the image
         try:
-            response = requests.get(image_url)
-            response.raise_for_status()  # Check if the request was successful
             image_dir = os.path.join(get_session_directory(session_id), 'images')
             file_path = os.path.join(image_dir, "background.png")
-            with open(file_path, "wb") as file:
-                file.write(response.content)
+            await asyncio.to_thread(image_downloader.download, image_url, file_path)
             print("Image saved as background.png")
         except Exception as e:
             print(f"An error occurred while downloading the image: {e}")
@@ -532,6 +705,9 @@ def get_session_directory(session_id):
     current_dir = os.path.dirname(os.path.abspath(__file__))
     return os.path.join(current_dir, 'jobs', session_id)
 
+def get_partial_template_path(session_id):
+    return os.path.join(get_session_directory(session_id), 'template', 'index.html.partial')
+
 def extract_text(response, start_marker, end_marker):
     """
     Extracts title content from the given response string.
@@ -556,7 +732,23 @@ def extract_text(response, start_marker, end_marker):
     
     return response[start_index:end_index].strip()
 
-def generate_title_from_prompt(agent, file_content, sessionId, prompt):
+def render_orchestrator_reply(structured_reply):
+    """
+    Renders a structured orchestrator reply as plaintext followed by the JSON choices, the format the client parses.
+
+    Args:
+    structured_reply (dict): The JSON response of the orchestrator with a reply and choices.
+
+    Returns:
+    str: The rendered reply.
+    """
+    reply = str(structured_reply.get("reply", "")).strip()
+    choices = structured_reply.get("choices")
+    if not choices:
+        return reply
+    return f"{reply}\n{json.dumps({'choices': choices})}"
+
+async def generate_title_from_prompt(agent, file_content, sessionId, prompt):
     """
     Generates a title from the first prompt in a chat
 
@@ -572,7 +764,7 @@ def generate_title_from_prompt(agent, file_content, sessionId, prompt):
                     Do not include curly brackets as part of the title as the title should be wrapped within curly brackets.
                     """
     try:
-        title_response = agent.send_prompt(title_prompt, file_content)
+        title_response = await agent.asend_prompt(title_prompt, file_content)
         session_title = extract_text(title_response, '{', '}')
         print(f"Chat title for {sessionId} = {session_title}")
         return session_title
@@ -601,4 +793,8 @@ def get_session_details_internal(sessionId):
         }
 
 if __name__ == '__main__':
+    # The reloader runs the server in a child process marked by WERKZEUG_RUN_MAIN; jobs left over from the last
+    # run resume there right away instead of on the first request
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_image_workers()
     app.run(debug=True)
\ No newline at end of file
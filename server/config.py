@@ -3,7 +3,7 @@
 
 import yaml
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -24,6 +24,62 @@ class Config:
     AZURE_OPENAI_DALLE_ENDPOINT: str
     AZURE_OPENAI_DALLE_MODEL: str
     AZURE_STORAGE_ACCOUNT_CONNECTION_STRING: str
+    TEMPLATE_CONTEXT_TOKEN_BUDGET: int = 24000
+    ORCHESTRATOR_CONTEXT_POLICY: str = "full_history"
+    ORCHESTRATOR_CONTEXT_WINDOW: int = 20
+    ORCHESTRATOR_CONTEXT_TOKEN_BUDGET: int = 4000
+    ORCHESTRATOR_STRUCTURED_REPLY: bool = True
+    AGENT_MODELS: dict = field(default_factory=dict)
+    OPENAI_MAX_CONNECTIONS: int = 100
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    OPENAI_KEEPALIVE_EXPIRY: float = 30.0
+    RESPONSE_CACHE_AGENTS: list = field(default_factory=lambda: ["session_title_agent", "image_prompt_agent"])
+    RESPONSE_CACHE_DIR: str = "cache/responses"
+    RESPONSE_CACHE_MAX_ENTRIES: int = 1000
+    RESPONSE_CACHE_TTL_SECONDS: int = 7 * 24 * 60 * 60
+    RESPONSE_CACHE_MAX_DISK_BYTES: int = 100 * 1024 * 1024
+    AGENT_JOURNAL_COMPACT_AFTER_ENTRIES: int = 100
+    AGENT_JOURNAL_FSYNC_EVERY_ENTRIES: int = 20
+    AGENT_JOURNAL_FSYNC_INTERVAL_SECONDS: float = 1.0
+    AGENT_TRANSPORT_MODE: str = "live"
+    AGENT_CASSETTE_PATH: str = "cassettes/agents.jsonl"
+    AGENT_TRANSPORT_LATENCY_SECONDS: float = 0.0
+    AGENT_TRANSPORT_CHUNK_DELAY_SECONDS: float = 0.0
+    AGENT_IMAGE_STUB_PORT: int = 5051
+    IMAGE_POPULATOR_CONCURRENCY: int = 4
+    IMAGE_PROMPT_BATCH: bool = True
+    IMAGE_CACHE_ENABLED: bool = True
+    IMAGE_CACHE_DIR: str = "cache/images"
+    IMAGE_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+    IMAGE_CACHE_KEY_INCLUDES_PROMPT: bool = False
+    IMAGE_RESPONSE_FORMAT: str = "b64_json"
+    IMAGE_DOWNLOAD_POOL_SIZE: int = 10
+    IMAGE_DOWNLOAD_CONNECT_TIMEOUT_SECONDS: float = 5.0
+    IMAGE_DOWNLOAD_READ_TIMEOUT_SECONDS: float = 30.0
+    IMAGE_DOWNLOAD_RETRIES: int = 3
+    IMAGE_VARIANT_WIDTHS: list = field(default_factory=lambda: [480, 960])
+    IMAGE_VARIANT_FORMAT: str = "webp"
+    IMAGE_VARIANT_QUALITY: int = 80
+    IMAGE_SIZES: str = "100vw"
+    IMAGE_INFER_SIZES: bool = True
+    IMAGE_LARGE_QUALITY: str = "standard"
+    IMAGE_JOB_DB_PATH: str = "queue/image_jobs.db"
+    IMAGE_JOB_WORKERS: int = 2
+    IMAGE_JOB_LEASE_SECONDS: float = 60.0
+    IMAGE_JOB_MAX_ATTEMPTS: int = 3
+    JOB_POOL_SIZES: dict = field(default_factory=lambda: {"template": 8, "title": 8, "images": 2})
+    JOB_TIMEOUT_SECONDS: dict = field(default_factory=lambda: {"template": 600, "title": 120, "images": 1800})
+    JOB_RETENTION_SECONDS: float = 3600.0
+    EVENT_HISTORY_SIZE: int = 1000
+    EVENT_KEEPALIVE_SECONDS: float = 15.0
+    EVENT_RETRY_MILLISECONDS: int = 2000
+    EVENT_TEMPLATE_CHUNK_INTERVAL_SECONDS: float = 0.25
+    OPENAI_REQUESTS_PER_MINUTE: int = 0
+    OPENAI_TOKENS_PER_MINUTE: int = 0
+    DALLE_REQUESTS_PER_MINUTE: int = 0
+    RATE_LIMIT_BACKGROUND_HEADROOM: float = 0.2
+    RATE_LIMIT_MAX_RETRIES: int = 5
+    RATE_LIMIT_MAX_BACKOFF_SECONDS: float = 60.0
     
 def get_secret(name):
     return os.getenv(name)
@@ -0,0 +1,193 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+import queue
+import threading
+from collections import deque
+
+class Subscription:
+    def __init__(self, hub, session_id: str, max_pending: int):
+        """
+        Initializes the Subscription, the events of one session waiting to be sent to one client.
+
+        Args:
+        hub (EventHub): The hub the subscription belongs to.
+        session_id (str): The session ID.
+        max_pending (int): The number of events that may wait before the subscriber is considered too slow.
+        """
+        self.hub = hub
+        self.session_id = session_id
+        self.closed = False
+        self._queue = queue.Queue(maxsize=max_pending)
+
+    def put(self, event: dict) -> bool:
+        """
+        Queues an event without waiting.
+
+        Args:
+        event (dict): The event.
+
+        Returns:
+        bool: Whether the event was queued, False if the subscriber has fallen too far behind.
+        """
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            return False
+
+    def get(self, timeout: float) -> dict:
+        """
+        Waits for the next event.
+
+        Args:
+        timeout (float): The number of seconds to wait.
+
+        Returns:
+        dict: The event, or None if none arrived in time or the subscription was closed.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """
+        Stops delivering events to the subscription.
+        """
+        self.hub.unsubscribe(self)
+
+class EventHub:
+    def __init__(self, history_size: int = 1000):
+        """
+        Initializes the EventHub, which fans the events the pipeline publishes for a session out to the clients
+        subscribed to it. The recent events of each session are kept, so a client that subscribes late or
+        reconnects receives the events it missed since its last event ID.
+
+        Args:
+        history_size (int): The number of recent events kept per session.
+        """
+        self._lock = threading.Lock()
+        self._history = {}
+        self._last_ids = {}
+        self._subscriptions = {}
+        self.configure(history_size)
+
+    def configure(self, history_size: int):
+        """
+        Sets the number of recent events kept per session from now on.
+
+        Args:
+        history_size (int): The number of recent events kept per session.
+        """
+        with self._lock:
+            self.history_size = max(1, history_size)
+            self._history = {session_id: deque(history, maxlen=self.history_size) for session_id, history in self._history.items()}
+
+    def publish(self, session_id: str, event: str, data: dict = None) -> int:
+        """
+        Publishes an event to the subscribers of a session. Safe to call from any thread.
+
+        Args:
+        session_id (str): The session ID.
+        event (str): The event name, e.g. 'template_ready'.
+        data (dict): The JSON serializable payload of the event.
+
+        Returns:
+        int: The ID of the event, increasing per session.
+        """
+        with self._lock:
+            event_id = self._last_ids.get(session_id, 0) + 1
+            self._last_ids[session_id] = event_id
+            message = {"id": event_id, "event": event, "data": data or {}}
+            history = self._history.get(session_id)
+            if history is None:
+                history = self._history[session_id] = deque(maxlen=self.history_size)
+            history.append(message)
+            subscriptions = list(self._subscriptions.get(session_id, ()))
+
+        for subscription in subscriptions:
+            if not subscription.put(message):
+                # The client reconnects and catches up from the history with its last event ID
+                print(f"Event subscriber of session {session_id} fell behind, disconnecting it")
+                self.unsubscribe(subscription)
+        return event_id
+
+    def reset(self, session_id: str):
+        """
+        Forgets the events of a session, e.g. when a new prompt starts a new page. Event IDs keep increasing.
+
+        Args:
+        session_id (str): The session ID.
+        """
+        with self._lock:
+            self._history.pop(session_id, None)
+
+    def remove(self, session_id: str):
+        """
+        Forgets a session and disconnects its subscribers.
+
+        Args:
+        session_id (str): The session ID.
+        """
+        with self._lock:
+            self._history.pop(session_id, None)
+            self._last_ids.pop(session_id, None)
+            subscriptions = self._subscriptions.pop(session_id, [])
+        for subscription in subscriptions:
+            self.unsubscribe(subscription)
+
+    def subscribe(self, session_id: str, last_event_id: int = None) -> Subscription:
+        """
+        Subscribes to the events of a session. The subscription starts with the kept events after last_event_id,
+        or all kept events of the session.
+
+        Args:
+        session_id (str): The session ID.
+        last_event_id (int): The ID of the last event the client received, if it is reconnecting.
+
+        Returns:
+        Subscription: The subscription, to be closed when the client disconnects.
+        """
+        subscription = Subscription(self, session_id, max_pending=self.history_size * 2)
+        with self._lock:
+            last_event_id = last_event_id or 0
+            if last_event_id > self._last_ids.get(session_id, 0):
+                # The IDs are from before a restart, so everything kept is new to the client
+                last_event_id = 0
+            for message in self._history.get(session_id, ()):
+                if message["id"] > last_event_id:
+                    subscription.put(message)
+            self._subscriptions.setdefault(session_id, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Stops delivering events to a subscription.
+
+        Args:
+        subscription (Subscription): The subscription.
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.session_id, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.session_id, None)
+            subscription.closed = True
+
+def format_event(message: dict) -> str:
+    """
+    Formats an event as a Server-Sent Events message.
+
+    Args:
+    message (dict): The event with its 'id', 'event' name and 'data'.
+
+    Returns:
+    str: The message, ending with the blank line that dispatches it.
+    """
+    return f"id: {message['id']}\nevent: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+
+# Process-wide hub; AgentFactory configures it from config.yaml
+event_hub = EventHub()
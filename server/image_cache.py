@@ -0,0 +1,204 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from metrics import IMAGE_CACHE_LOOKUPS
+
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+def normalize_description(description: str) -> str:
+    """
+    Normalizes a placeholder description so that trivial differences in case, whitespace and trailing punctuation map to the same image.
+
+    Args:
+    description (str): The description of the placeholder.
+
+    Returns:
+    str: The normalized description.
+    """
+    return _WHITESPACE_PATTERN.sub(" ", description or "").strip().rstrip(".!").lower()
+
+class ImageCache:
+    def __init__(self, cache_dir: str, max_bytes: int = 1024 * 1024 * 1024, key_includes_prompt: bool = False):
+        """
+        Initializes the ImageCache, a store of generated images shared across sessions. Images are stored once
+        under the hash of their content, and entries map a placeholder description (and size, and optionally the
+        image prompt) to an image. The least recently used images are evicted once the store exceeds its byte budget.
+
+        Args:
+        cache_dir (str): The directory of the store.
+        max_bytes (int): The maximum size of the stored images.
+        key_includes_prompt (bool): Whether entries are keyed by the image prompt as well as the description.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.key_includes_prompt = key_includes_prompt
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        os.makedirs(os.path.join(self.cache_dir, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, 'entries'), exist_ok=True)
+        self._disk_bytes = sum(os.path.getsize(path) for path in self._blob_paths())
+
+    def make_key(self, description: str, size: str, image_prompt: str = None) -> str:
+        """
+        Builds the cache key of an image.
+
+        Args:
+        description (str): The description of the placeholder.
+        size (str): The size of the image, e.g. '1024x1024'.
+        image_prompt (str): The image prompt, only part of the key if key_includes_prompt is set.
+
+        Returns:
+        str: A hex digest identifying the image.
+        """
+        payload = {"description": normalize_description(description), "size": size}
+        if self.key_includes_prompt:
+            payload["image_prompt"] = _WHITESPACE_PATTERN.sub(" ", image_prompt or "").strip()
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str, destination_path: str) -> dict:
+        """
+        Places a cached image at a path, hard-linking it where possible and copying it otherwise.
+
+        Args:
+        key (str): The cache key of the image.
+        destination_path (str): The path to place the image at.
+
+        Returns:
+        dict: The entry of the image with its image prompt and URL, or None on a miss.
+        """
+        with self._lock:
+            entry = self._read_entry(key)
+            blob_path = self._blob_path(entry["blob"]) if entry else None
+            if not blob_path or not os.path.exists(blob_path):
+                self.misses += 1
+                IMAGE_CACHE_LOOKUPS.labels("miss").inc()
+                return None
+
+            # Touching the image keeps it at the recent end of the LRU order
+            os.utime(blob_path)
+            link_or_copy(blob_path, destination_path)
+            self.hits += 1
+            IMAGE_CACHE_LOOKUPS.labels("hit").inc()
+            return entry
+
+    def put(self, key: str, image_path: str, image_prompt: str = None, image_url: str = None):
+        """
+        Stores an image under its content hash and records an entry for the key.
+
+        Args:
+        key (str): The cache key of the image.
+        image_path (str): The path of the image file.
+        image_prompt (str): The image prompt the image was generated from.
+        image_url (str): The URL the image was downloaded from.
+        """
+        digest = hashlib.sha256()
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        blob = digest.hexdigest() + os.path.splitext(image_path)[1]
+
+        with self._lock:
+            blob_path = self._blob_path(blob)
+            if os.path.exists(blob_path):
+                os.utime(blob_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                temp_path = f"{blob_path}.tmp"
+                shutil.copyfile(image_path, temp_path)
+                os.replace(temp_path, blob_path)
+                self._disk_bytes += os.path.getsize(blob_path)
+
+            entry_path = self._entry_path(key)
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            temp_path = f"{entry_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"blob": blob, "created": time.time(), "image_prompt": image_prompt, "image_url": image_url}, f)
+            os.replace(temp_path, entry_path)
+            self.stores += 1
+
+            if self._disk_bytes > self.max_bytes:
+                self._evict_blobs()
+
+    def get_stats(self) -> dict:
+        """
+        Returns the hit and miss counters of the cache.
+
+        Returns:
+        dict: A dictionary of cache statistics.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "disk_bytes": self._disk_bytes
+        }
+
+    def _blob_path(self, blob):
+        return os.path.join(self.cache_dir, 'blobs', blob[:2], blob)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, 'entries', key[:2], f"{key}.json")
+
+    def _blob_paths(self):
+        for root, dirs, files in os.walk(os.path.join(self.cache_dir, 'blobs')):
+            for file in files:
+                if not file.endswith(".tmp"):
+                    yield os.path.join(root, file)
+
+    def _read_entry(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Discarding unreadable image cache entry {path}: {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def _evict_blobs(self):
+        # Entries of evicted images are left behind and count as misses until they are overwritten
+        for path in sorted(self._blob_paths(), key=os.path.getmtime):
+            if self._disk_bytes <= self.max_bytes:
+                break
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._disk_bytes -= size
+                self.evictions += 1
+            except OSError:
+                pass
+
+def link_or_copy(source_path, destination_path):
+    """
+    Places a file at a path, hard-linking it where possible and copying it otherwise.
+    The destination is replaced rather than overwritten, so a hard-linked image is never written through.
+
+    Args:
+    source_path (str): The path of the file.
+    destination_path (str): The path to place the file at.
+    """
+    if os.path.exists(destination_path):
+        os.remove(destination_path)
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copyfile(source_path, destination_path)
@@ -0,0 +1,125 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import base64
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import IMAGE_DOWNLOAD_BYTES, IMAGE_DOWNLOAD_LATENCY
+
+# Base64 is decoded in slices of whole 4-character groups, so the decoded image is never held in memory at once
+_BASE64_SLICE_CHARS = 4 * 256 * 1024
+
+def save_base64_image(data: str, destination_path: str) -> int:
+    """
+    Decodes a base64 encoded image straight to a file, replacing it atomically.
+
+    Args:
+    data (str): The base64 encoded image.
+    destination_path (str): The path of the image file.
+
+    Returns:
+    int: The number of bytes written.
+    """
+    temp_path = f"{destination_path}.part"
+    written = 0
+    with open(temp_path, 'wb') as f:
+        for start in range(0, len(data), _BASE64_SLICE_CHARS):
+            chunk = base64.b64decode(data[start:start + _BASE64_SLICE_CHARS])
+            f.write(chunk)
+            written += len(chunk)
+    os.replace(temp_path, destination_path)
+    return written
+
+class ImageDownloader:
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 5.0, read_timeout: float = 30.0, retries: int = 3, chunk_size: int = 64 * 1024):
+        """
+        Initializes the ImageDownloader, which downloads generated images over one pooled HTTP session,
+        streaming each to a temporary file and resuming interrupted downloads with range requests.
+
+        Args:
+        pool_size (int): The maximum number of pooled connections per host.
+        connect_timeout (float): The number of seconds to wait for a connection.
+        read_timeout (float): The number of seconds to wait for data on an open connection.
+        retries (int): The number of times an interrupted download is resumed.
+        chunk_size (int): The number of bytes read and written at a time.
+        """
+        self.chunk_size = chunk_size
+        self._session = None
+        self._lock = threading.Lock()
+        self.configure(pool_size, connect_timeout, read_timeout, retries)
+
+    def configure(self, pool_size: int, connect_timeout: float, read_timeout: float, retries: int):
+        """
+        Sets the pool size, timeouts and retries used from now on.
+
+        Args:
+        pool_size (int): The maximum number of pooled connections per host.
+        connect_timeout (float): The number of seconds to wait for a connection.
+        read_timeout (float): The number of seconds to wait for data on an open connection.
+        retries (int): The number of times an interrupted download is resumed.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        with self._lock:
+            previous, self._session = self._session, session
+            self.timeout = (connect_timeout, read_timeout)
+            self.retries = retries
+        if previous is not None:
+            previous.close()
+
+    def download(self, url: str, destination_path: str) -> int:
+        """
+        Downloads a file, replacing the destination atomically once it is complete.
+
+        Args:
+        url (str): The URL of the file.
+        destination_path (str): The path of the file.
+
+        Returns:
+        int: The number of bytes downloaded.
+        """
+        temp_path = f"{destination_path}.part"
+        started = time.perf_counter()
+        written = 0
+        attempt = 0
+        try:
+            while True:
+                try:
+                    written = self._download_to(url, temp_path, written)
+                    break
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    if attempt >= self.retries:
+                        raise
+                    attempt += 1
+                    print(f"Image download interrupted after {written} bytes, resuming ({attempt}/{self.retries}): {e}")
+                    written = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+            os.replace(temp_path, destination_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        IMAGE_DOWNLOAD_LATENCY.observe(time.perf_counter() - started)
+        IMAGE_DOWNLOAD_BYTES.inc(written)
+        return written
+
+    def _download_to(self, url, temp_path, offset):
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self._session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            # A server that ignores the range sends the whole file again
+            resumed = offset and response.status_code == 206
+            written = offset if resumed else 0
+            with open(temp_path, 'ab' if resumed else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    written += len(chunk)
+        return written
+
+# Process-wide downloader shared by all sessions
+image_downloader = ImageDownloader()
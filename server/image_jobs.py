@@ -0,0 +1,301 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+from agent_loop import get_agent_loop
+from metrics import IMAGE_JOBS
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_jobs (
+    session_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    requested REAL NOT NULL,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    error TEXT
+)
+"""
+
+class ImageJobQueue:
+    def __init__(self, db_path: str, lease_seconds: float = 60.0, max_attempts: int = 3, max_backoff: float = 60.0):
+        """
+        Initializes the ImageJobQueue, which persists one image population job per session in SQLite so that the
+        work survives restarts. Workers hold a job under a lease they keep renewing; a job whose lease expires,
+        because its worker or process died, is picked up again. Regenerating a page while its job runs queues the
+        job again once the current run ends, so a session never has two runs at once.
+
+        Args:
+        db_path (str): The path of the SQLite database.
+        lease_seconds (float): How long a worker holds a job without renewing its lease.
+        max_attempts (int): The number of runs of a job before it is marked failed.
+        max_backoff (float): The maximum delay in seconds before a failed job is retried.
+        """
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.max_backoff = max_backoff
+        self._wakeup = None
+        self._workers = []
+
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(_SCHEMA)
+
+    def enqueue(self, session_id: str, requested: float = None):
+        """
+        Queues the image population of a session, replacing any finished job of the session.
+
+        Args:
+        session_id (str): The session ID.
+        requested (float): The time.time() at which the prompt behind the job was received, defaults to now.
+        """
+        requested = requested or time.time()
+        with self._transaction() as connection:
+            connection.execute("""
+                INSERT INTO image_jobs (session_id, state, requested) VALUES (?, ?, ?)
+                ON CONFLICT(session_id) DO UPDATE SET
+                    generation = generation + 1,
+                    attempts = 0,
+                    requested = excluded.requested,
+                    available_at = 0,
+                    error = NULL,
+                    state = CASE WHEN state = 'running' THEN 'running' ELSE 'queued' END
+            """, (session_id, QUEUED, requested))
+        self._wake()
+
+    def claim(self, owner: str) -> dict:
+        """
+        Leases the oldest job that is queued, or whose lease has expired.
+
+        Args:
+        owner (str): The ID of the claiming worker.
+
+        Returns:
+        dict: The job, with 'resumed' set if an earlier run was cut short, or None if there is nothing to do.
+        """
+        with self._transaction() as connection:
+            while True:
+                now = time.time()
+                job = connection.execute("""
+                    SELECT * FROM image_jobs
+                    WHERE (state = 'queued' AND available_at <= ?) OR (state = 'running' AND lease_expires < ?)
+                    ORDER BY requested LIMIT 1
+                """, (now, now)).fetchone()
+                if job is None:
+                    return None
+
+                job = dict(job)
+                if job['state'] == RUNNING:
+                    print(f"Lease of image job {job['session_id']} held by {job['lease_owner']} expired")
+                    if job['attempts'] >= self.max_attempts:
+                        # A job that keeps taking its worker down is given up on rather than retried forever
+                        connection.execute("UPDATE image_jobs SET state = ?, lease_owner = NULL, error = ? WHERE session_id = ?",
+                                           (FAILED, "Lease expired", job['session_id']))
+                        IMAGE_JOBS.labels("failed").inc()
+                        continue
+                    IMAGE_JOBS.labels("expired").inc()
+
+                connection.execute("""
+                    UPDATE image_jobs SET state = ?, attempts = attempts + 1, lease_owner = ?, lease_expires = ?
+                    WHERE session_id = ?
+                """, (RUNNING, owner, now + self.lease_seconds, job['session_id']))
+                job['attempts'] += 1
+                job['resumed'] = job['attempts'] > 1
+                return job
+
+    def renew(self, job: dict, owner: str) -> bool:
+        """
+        Extends the lease on a job.
+
+        Args:
+        job (dict): The claimed job.
+        owner (str): The ID of the worker holding the lease.
+
+        Returns:
+        bool: Whether the worker still holds the lease.
+        """
+        with self._transaction() as connection:
+            cursor = connection.execute("UPDATE image_jobs SET lease_expires = ? WHERE session_id = ? AND lease_owner = ? AND state = ?",
+                                        (time.time() + self.lease_seconds, job['session_id'], owner, RUNNING))
+            return cursor.rowcount == 1
+
+    def finish(self, job: dict, owner: str, error: Exception = None):
+        """
+        Releases a job after a run, marking it done, queuing it for a retry or a newer page, or marking it failed.
+
+        Args:
+        job (dict): The claimed job.
+        owner (str): The ID of the worker holding the lease.
+        error (Exception): The exception the run failed with, if any.
+        """
+        with self._transaction() as connection:
+            current = connection.execute("SELECT generation, lease_owner FROM image_jobs WHERE session_id = ?", (job['session_id'],)).fetchone()
+            if current is None or current['lease_owner'] != owner:
+                print(f"Image job {job['session_id']} was removed or taken over, discarding its result")
+                return
+
+            if current['generation'] != job['generation']:
+                state, attempts, available_at, outcome = QUEUED, 0, 0, "requeued"
+            elif error is None:
+                state, attempts, available_at, outcome = DONE, job['attempts'], 0, "done"
+            elif job['attempts'] < self.max_attempts:
+                state, attempts, available_at, outcome = QUEUED, job['attempts'], time.time() + min(self.max_backoff, 2 ** job['attempts']), "retried"
+            else:
+                state, attempts, available_at, outcome = FAILED, job['attempts'], 0, "failed"
+            connection.execute("""
+                UPDATE image_jobs SET state = ?, attempts = ?, available_at = ?, lease_owner = NULL, lease_expires = NULL, error = ?
+                WHERE session_id = ?
+            """, (state, attempts, available_at, str(error) if error else None, job['session_id']))
+        IMAGE_JOBS.labels(outcome).inc()
+        if state == QUEUED:
+            self._wake()
+
+    def remove(self, session_id: str):
+        """
+        Deletes the job of a session; a worker running it discards its result.
+
+        Args:
+        session_id (str): The session ID.
+        """
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM image_jobs WHERE session_id = ?", (session_id,))
+
+    def get_job(self, session_id: str) -> dict:
+        """
+        Returns the job of a session.
+
+        Args:
+        session_id (str): The session ID.
+
+        Returns:
+        dict: The job, or None if the session has none.
+        """
+        with self._connect() as connection:
+            job = connection.execute("SELECT * FROM image_jobs WHERE session_id = ?", (session_id,)).fetchone()
+        return dict(job) if job else None
+
+    def is_pending(self, session_id: str) -> bool:
+        """
+        Checks whether the images of a session are still to be populated.
+
+        Args:
+        session_id (str): The session ID.
+
+        Returns:
+        bool: Whether the session has a queued or running job.
+        """
+        job = self.get_job(session_id)
+        return job is not None and job['state'] in (QUEUED, RUNNING)
+
+    def start(self, handler, workers: int = 2):
+        """
+        Starts workers on the agent event loop that run queued jobs until the process exits.
+
+        Args:
+        handler: An async callable taking the job, which populates the images of its session.
+        workers (int): The number of jobs run at once by this process; 0 leaves the jobs to other processes.
+        """
+        loop = get_agent_loop()
+        self._wakeup = asyncio.Event()
+        owner_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        for number in range(workers):
+            owner = f"{owner_prefix}:{number}"
+            self._workers.append(asyncio.run_coroutine_threadsafe(self._work(owner, handler), loop))
+        print(f"Started {workers} image job workers")
+
+    async def _work(self, owner, handler):
+        while True:
+            # Clearing before claiming means a job queued in between still wakes this worker
+            self._wakeup.clear()
+            try:
+                job = await asyncio.to_thread(self.claim, owner)
+            except sqlite3.Error as e:
+                print(f"Image job worker {owner} could not claim a job: {e}")
+                job = None
+            if job is None:
+                try:
+                    # Expired leases and retries that come due wake nobody, so idle workers also poll
+                    await asyncio.wait_for(self._wakeup.wait(), self.lease_seconds / 2)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            print(f"Image job worker {owner} running {job['session_id']} (attempt {job['attempts']}/{self.max_attempts})")
+            error = None
+            task = asyncio.ensure_future(handler(job))
+            heartbeat = asyncio.ensure_future(self._heartbeat(job, owner, task))
+            try:
+                await task
+            except asyncio.CancelledError:
+                if not job.get('lease_lost'):
+                    raise
+                print(f"Image job worker {owner} lost the lease on {job['session_id']}, stopping")
+                continue
+            except Exception as e:
+                print(f"Image job {job['session_id']} failed: {e}")
+                error = e
+            finally:
+                heartbeat.cancel()
+            try:
+                await asyncio.to_thread(self.finish, job, owner, error)
+            except sqlite3.Error as e:
+                print(f"Image job worker {owner} could not release {job['session_id']}, its lease will expire: {e}")
+
+    async def _heartbeat(self, job, owner, task):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                if await asyncio.to_thread(self.renew, job, owner):
+                    continue
+            except sqlite3.Error as e:
+                print(f"Could not renew the lease on image job {job['session_id']}: {e}")
+                continue
+            job['lease_lost'] = True
+            task.cancel()
+            return
+
+    def _wake(self):
+        if self._wakeup is not None:
+            get_agent_loop().call_soon_threadsafe(self._wakeup.set)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return _Connection(connection)
+
+    def _transaction(self):
+        connection = self._connect()
+        connection.begin()
+        return connection
+
+class _Connection:
+    # Commits on success, rolls back on error and always closes, which sqlite3's own context manager does not
+    def __init__(self, connection):
+        self.connection = connection
+
+    def begin(self):
+        # Taking the write lock up front keeps two workers from claiming the same job
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if self.connection.in_transaction:
+                self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.connection.close()
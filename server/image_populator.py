@@ -1,294 +1,668 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import asyncio
+import hashlib
 import os
-import requests
-import re
 import json
-from bs4 import BeautifulSoup
 from urllib.parse import urljoin
-from agent_factory import AgentFactory
+from agents import prompt_registry
+from image_cache import ImageCache, link_or_copy, normalize_description
+from image_downloader import image_downloader, save_base64_image
+from image_processing import create_variants, is_available
+from image_sizing import infer_image_request
+from metrics import IMAGE_POPULATOR_LATENCY, IMAGE_PLACEHOLDERS
+from event_hub import event_hub
+from placeholder_scanner import PlaceholderPage, first_start_tag, set_attributes
+
+DEFAULT_IMAGE_SIZE = "1024x1024"
+# Generated images are PNG whether they are returned in the response or downloaded
+IMAGE_EXTENSION = ".png"
+PLACEHOLDER_SRC = "/img/loading_gradient.gif"
+METADATA_VERSION = 2
+_RESPONSIVE_IMAGE_STYLE = '<style id="responsive-images">:where(img[srcset]) { height: auto; }</style>'
+
+class PageReplaced(Exception):
+    """Raised by ImagePopulator.populate when index.html was replaced by a newer page during the run."""
+
+def get_metadata_key(placeholder_type: str, description: str, context=None) -> str:
+    """
+    Builds the key of a placeholder in the image index of metadata.json.
+
+    Args:
+    placeholder_type (str): 'img', 'style' or 'css'.
+    description (str): The description of the placeholder.
+    context: What else decides how the placeholder is replaced: the attributes of its tag, or the selector and
+    declarations of its CSS rule. Keys without context are those of indexes written before it was included.
+
+    Returns:
+    str: The key, shared by placeholders of the same type and context whose descriptions only differ trivially.
+    """
+    key = f"{placeholder_type}:{normalize_description(description)}"
+    if context is None:
+        return key
+    # Placeholders that share a description but not their attributes or rule are sized and tagged differently
+    digest = hashlib.sha1(json.dumps(context, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return f"{key}:{digest}"
+
+def get_placeholder_key(placeholder: dict) -> str:
+    """
+    Builds the key of a placeholder found by PlaceholderPage.scan in the image index of metadata.json.
+
+    Args:
+    placeholder (dict): The placeholder.
+
+    Returns:
+    str: The key.
+    """
+    if placeholder['type'] == 'css':
+        context = [placeholder['selector'], placeholder['rule']]
+    else:
+        context = placeholder['attributes']
+    return get_metadata_key(placeholder['type'], placeholder['description'], context)
+
+def migrate_metadata(metadata: dict) -> dict:
+    """
+    Converts metadata.json from a list of every mapping ever made, with the element HTML before and after,
+    to the image index, where the most recent mapping of each placeholder key wins.
+
+    Args:
+    metadata (dict): The loaded metadata.json.
+
+    Returns:
+    dict: The metadata with an 'images' index.
+    """
+    if 'images' in metadata:
+        return metadata
+    images = {}
+    for mapping in metadata.get('mappings', []):
+        entry = {name: value for name, value in mapping.items() if name not in ('old_element_html', 'new_element_html')}
+        key = get_metadata_key(mapping['type'], mapping['description'])
+        if mapping['type'] != 'css' and mapping.get('new_element_html'):
+            # Older mappings hold the whole element, only its start tag replaces a placeholder
+            entry['new_tag_html'] = first_start_tag(mapping['new_element_html'])
+            old_placeholders = PlaceholderPage(mapping.get('old_element_html') or '').scan(PLACEHOLDER_SRC)
+            if old_placeholders:
+                key = get_placeholder_key({**old_placeholders[0], 'description': mapping['description']})
+        images[key] = entry
+    print(f"Migrated {len(metadata.get('mappings', []))} metadata mappings to {len(images)} indexed images")
+    return {'version': METADATA_VERSION, 'imageCount': metadata.get('imageCount', 0), 'images': images}
+
+def substitute_images(html_content: str, images: dict) -> str:
+    """
+    Replaces the image placeholders of a page with their images from the image index of metadata.json.
+
+    Args:
+    html_content (str): The HTML of the page.
+    images (dict): The image index of metadata.json.
+
+    Returns:
+    str: The HTML with every placeholder that has an image replaced.
+    """
+    if PLACEHOLDER_SRC not in html_content:
+        return html_content
+    page = PlaceholderPage(html_content)
+    for placeholder in page.scan(PLACEHOLDER_SRC):
+        mapping = images.get(get_placeholder_key(placeholder))
+        if mapping is None and placeholder['type'] == 'css':
+            # CSS placeholders are replaced by their URL alone, so an entry from before keys had context still fits
+            mapping = images.get(get_metadata_key(placeholder['type'], placeholder['description']))
+        replacement = mapping and mapping.get('src' if placeholder['type'] == 'css' else 'new_tag_html')
+        if replacement:
+            page.replace(placeholder['span'], replacement)
+    return page.render()
+
+class ImageSubstitutions:
+    def __init__(self, metadata_path: str):
+        """
+        Initializes the ImageSubstitutions, which puts the generated images of a session into the pages of its
+        template agent when they are sent back to the model, so that its history keeps the raw responses and
+        ImagePopulator never rewrites it. The image index is re-read whenever metadata.json changes.
+
+        Args:
+        metadata_path (str): The path of the session's metadata.json.
+        """
+        self.metadata_path = metadata_path
+        self._images = {}
+        self._loaded_mtime = None
+
+    def __call__(self, content: str) -> str:
+        return substitute_images(content, self.get_images())
+
+    def get_images(self) -> dict:
+        """
+        Returns the image index of the session.
+
+        Returns:
+        dict: The image index, empty if no image has been generated yet.
+        """
+        try:
+            mtime = os.stat(self.metadata_path).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        if mtime != self._loaded_mtime:
+            try:
+                with open(self.metadata_path, 'r', encoding='utf-8') as f:
+                    self._images = migrate_metadata(json.load(f))['images']
+                self._loaded_mtime = mtime
+            except (OSError, ValueError) as e:
+                print(f"Could not read the image index {self.metadata_path}: {e}")
+        return self._images
+
+def write_atomic(path: str, content: str):
+    """
+    Writes a file by writing a temporary file next to it and renaming it into place, so readers never see a partial file.
+
+    Args:
+    path (str): The path of the file.
+    content (str): The content to write.
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(temp_path, path)
 
 class ImagePopulator:
-    def __init__(self, html_path: str, image_output_folder: str, session_id: str, agents: any):
+    def __init__(self, html_path: str, image_output_folder: str, session_id: str, agents: any, concurrency: int = 4, batch_prompts: bool = True, image_cache: ImageCache = None, image_response_format: str = "b64_json", variant_widths: list = None, variant_format: str = "webp", variant_quality: int = 80, image_sizes: str = "100vw", infer_sizes: bool = True, large_image_quality: str = "standard"):
         print(f"Initializing ImagePopulator with html_path: {html_path}, image_output_folder: {image_output_folder}, session_id: {session_id}")
         self.html_path = html_path
+        # Maximum number of placeholders processed at once; 1 processes them one after another
+        self.concurrency = max(1, concurrency)
+        # Whether the image prompts of a page are requested with one batch request instead of one request per placeholder
+        self.batch_prompts = batch_prompts
+        # Generated images shared across sessions and regenerations, if any
+        self.image_cache = image_cache
+        # 'b64_json' returns generated images in the response, 'url' downloads them in a second request
+        self.image_response_format = image_response_format
+        # Widths of the responsive variants each image is transcoded to, or none to serve the generated images as they are
+        self.variant_widths = variant_widths or []
+        self.variant_format = variant_format
+        self.variant_quality = variant_quality
+        # The sizes attribute of <img> tags with variants, telling the browser how wide the image is displayed
+        self.image_sizes = image_sizes
+        # Whether each placeholder gets the image size its context calls for instead of DEFAULT_IMAGE_SIZE
+        self.infer_sizes = infer_sizes
+        # Quality of images rendered larger than icons; small images are always generated at 'standard' quality
+        self.large_image_quality = large_image_quality
         self.image_output_folder = image_output_folder
         self.session_id = session_id
         self.session_dir = self.get_session_directory()
 
         self.prompt_gen_agent = agents["image_prompt_agent"]
         self.image_gen_agent = agents["image_gen_agent"]
-        self.template_agent = agents["template_agent"]
 
         if not os.path.exists(self.image_output_folder):
             os.makedirs(self.image_output_folder)
             print(f"Created image output folder at: {self.image_output_folder}")
 
-    def get_session_directory(self):
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        return os.path.join(current_dir, 'jobs', self.session_id)
+    def size_placeholder(self, placeholder):
+        """
+        Chooses the size and quality of the image of a placeholder from the element or CSS rule it appears in.
 
-    def create_image_lockfile(self):
-        lockfile_path = os.path.join(self.image_output_folder, 'images.lock')
-        with open(lockfile_path, 'w') as f:
-            pass
-        print(f"Created lockfile at: {lockfile_path}")
-
-    def delete_image_lockfile(self):
-        lockfile_path = os.path.join(self.image_output_folder, 'images.lock')
-        if os.path.exists(lockfile_path):
-            os.remove(lockfile_path)
-            print(f"Deleted lockfile at: {lockfile_path}")
+        Args:
+        placeholder (dict): The placeholder.
+        """
+        placeholder['size'] = DEFAULT_IMAGE_SIZE
+        placeholder['quality'] = self.large_image_quality
+        if not self.infer_sizes:
+            return
+
+        if placeholder['type'] == 'css':
+            request = infer_image_request('css', placeholder['description'], placeholder.get('rule', ''), class_names=placeholder.get('selector', ''))
         else:
-            print(f"Lockfile not found at: {lockfile_path}")
+            attributes = placeholder['attributes']
+            request = infer_image_request(placeholder['type'], placeholder['description'], attributes.get('style', ''),
+                                          attributes.get('width'), attributes.get('height'), attributes.get('class', ''))
+        placeholder['size'] = request['size']
+        placeholder['display_width'] = request['display_width']
+        if request['small']:
+            placeholder['quality'] = "standard"
+        print(f"Placeholder {placeholder['index']} gets a {placeholder['size']} {placeholder['quality']} image")
+
+    def get_image_filename(self, index):
+        return f'image_{index}{IMAGE_EXTENSION}'
 
+    def get_session_directory(self):
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        return os.path.join(current_dir, 'jobs', self.session_id)
 
-    def process(self):
-        self.create_image_lockfile()
+    async def generate_image_prompts(self, placeholders):
+        """
+        Generates the image prompts of all placeholders with one JSON-mode request. If the response cannot be used,
+        the placeholders are left without prompts and populate_placeholder requests them one by one.
+
+        Args:
+        placeholders (list): The placeholders to generate image prompts for.
+        """
+        descriptions = [placeholder['description'] for placeholder in placeholders]
+        try:
+            response = await self.prompt_gen_agent.asend_json_prompt(
+                json.dumps(descriptions),
+                instructions=prompt_registry.get("image_prompt_batch")
+            )
+            self.prompt_gen_agent.save(os.path.join(self.session_dir, 'agents', 'prompt_gen_agent.json'))
+        except Exception as e:
+            print(f"Batch image prompt request failed, falling back to one request per placeholder: {e}")
+            return
+
+        image_prompts = response.get('prompts') if isinstance(response, dict) else None
+        if (not isinstance(image_prompts, list) or len(image_prompts) != len(placeholders)
+                or not all(isinstance(image_prompt, str) and image_prompt.strip() for image_prompt in image_prompts)):
+            print("Batch image prompt response did not match the placeholders, falling back to one request per placeholder.")
+            return
+
+        for placeholder, image_prompt in zip(placeholders, image_prompts):
+            placeholder['image_prompt'] = image_prompt.strip()
+        print(f"Generated {len(image_prompts)} image prompts with one request.")
+
+    async def populate_placeholder(self, placeholder, semaphore, prompt_lock):
+        """
+        Generates, downloads and saves the image of one placeholder and records its mapping on the placeholder.
+        A failure only affects this placeholder.
+
+        Args:
+        placeholder (dict): The placeholder, with its assigned index.
+        semaphore (asyncio.Semaphore): Bounds the number of placeholders processed at once.
+        prompt_lock (asyncio.Lock): Serializes requests to the stateful image prompt agent.
+        """
+        index = placeholder['index']
+        description = placeholder['description']
+        image_filename = self.get_image_filename(index)
+        image_path = os.path.join(self.image_output_folder, image_filename)
+        async with semaphore:
+            try:
+                print(f"Processing placeholder {index} with description: {description}")
+
+                # Get image prompt from LLM, unless the batch request already returned it
+                image_prompt = placeholder.get('image_prompt')
+                if not image_prompt:
+                    async with prompt_lock:
+                        image_prompt = await self.prompt_gen_agent.asend_prompt(description)
+                        self.prompt_gen_agent.save(os.path.join(self.session_dir, 'agents', 'prompt_gen_agent.json'))
+                    placeholder['image_prompt'] = image_prompt
+                    print(f"Generated image prompt: {image_prompt}")
+
+                # An image cache keyed by the prompt can only be consulted now that the prompt is known
+                if self.image_cache and self.image_cache.key_includes_prompt and self.restore_cached_image(placeholder):
+                    return
+
+                # Generate image using DALL·E agent
+                image_data = await self.image_gen_agent.agenerate_image(image_prompt, size=placeholder['size'], response_format=self.image_response_format, quality=placeholder['quality'])
+                self.image_gen_agent.save(os.path.join(self.session_dir, 'agents', 'image_gen_agent.json'))
+                if not image_data:
+                    raise ValueError("No image was generated")
+
+                # Save image to disk, decoding it from the response or downloading it from its URL
+                image_url = None
+                if self.image_response_format == "b64_json":
+                    await asyncio.to_thread(save_base64_image, image_data, image_path)
+                else:
+                    image_url = image_data
+                    print(f"Generated image URL: {image_url}")
+                    await asyncio.to_thread(image_downloader.download, image_url, image_path)
+                placeholder['image_url'] = image_url
+            except Exception as e:
+                print(f"Failed to generate image for placeholder {index}: {e}")
+                placeholder['image_path'] = None
+                IMAGE_PLACEHOLDERS.labels("failed").inc()
+                return
+
+        placeholder['image_path'] = image_filename  # Use relative path
+        print(f"Saved image to: {image_path}")
+
+        if self.image_cache:
+            key = self.image_cache.make_key(description, placeholder['size'], image_prompt)
+            await asyncio.to_thread(self.image_cache.put, key, image_path, image_prompt, image_url)
+
+        self.add_mapping(placeholder)
+
+    def restore_cached_image(self, placeholder) -> bool:
+        """
+        Places the cached image of a placeholder in the image output folder, if there is one.
+
+        Args:
+        placeholder (dict): The placeholder, with its assigned index.
+
+        Returns:
+        bool: Whether the image was found in the cache.
+        """
+        image_filename = self.get_image_filename(placeholder['index'])
+        key = self.image_cache.make_key(placeholder['description'], placeholder['size'], placeholder.get('image_prompt'))
+        entry = self.image_cache.get(key, os.path.join(self.image_output_folder, image_filename))
+        if entry is None:
+            return False
+
+        print(f"Reused cached image for placeholder {placeholder['index']}")
+        placeholder['image_prompt'] = placeholder.get('image_prompt') or entry.get('image_prompt')
+        placeholder['image_url'] = entry.get('image_url')
+        placeholder['image_path'] = image_filename
+        self.add_mapping(placeholder)
+        return True
+
+    def copy_image(self, source, placeholder):
+        """
+        Gives a placeholder the image of another placeholder with the same description on the page.
+
+        Args:
+        source (dict): The placeholder whose image was generated.
+        placeholder (dict): The placeholder to give the image to.
+        """
+        if not source.get('image_path'):
+            IMAGE_PLACEHOLDERS.labels("failed").inc()
+            return
+
+        image_filename = self.get_image_filename(placeholder['index'])
+        link_or_copy(os.path.join(self.image_output_folder, source['image_path']), os.path.join(self.image_output_folder, image_filename))
+        placeholder['image_prompt'] = source.get('image_prompt')
+        placeholder['image_url'] = source.get('image_url')
+        placeholder['image_path'] = image_filename
+        self.add_mapping(placeholder)
+        # Variants are only linked to, so duplicates share them with the source
+        if source.get('variants'):
+            placeholder['variants'] = source['variants']
+            placeholder['mapping']['variants'] = source['variants']['variants']
+
+    def add_mapping(self, placeholder):
+        """
+        Records the metadata mapping of a populated placeholder on the placeholder.
+
+        Args:
+        placeholder (dict): The populated placeholder.
+        """
+        # Prepare data for metadata mapping
+        mapping = {
+            'index': placeholder['index'],
+            'type': placeholder['type'],
+            'description': placeholder['description'],
+            'image_prompt': placeholder.get('image_prompt'),
+            'image_url': placeholder.get('image_url'),
+            'image_path': placeholder.get('image_path')
+        }
+
+        # Save mapping in placeholder for later use
+        placeholder['mapping'] = mapping
+
+        IMAGE_PLACEHOLDERS.labels("populated").inc()
+
+    async def post_process(self, placeholder, semaphore):
+        """
+        Transcodes the image of a populated placeholder into responsive variants and a blurred preview.
+        If the image cannot be transcoded, the placeholder keeps the generated image.
+
+        Args:
+        placeholder (dict): The populated placeholder.
+        semaphore (asyncio.Semaphore): Bounds the number of placeholders processed at once.
+        """
+        if not placeholder.get('mapping') or not self.variant_widths:
+            return
+        if not is_available(self.variant_format):
+            print(f"Pillow with {self.variant_format} support is not installed, serving the generated image as it is.")
+            return
+
+        basename = os.path.splitext(placeholder['image_path'])[0]
+        image_path = os.path.join(self.image_output_folder, placeholder['image_path'])
+        widths = list(self.variant_widths)
+        if placeholder.get('display_width'):
+            # A placeholder of a fixed width also gets a variant for high density displays
+            widths.append(2 * placeholder['display_width'])
+        async with semaphore:
+            try:
+                variants = await asyncio.to_thread(create_variants, image_path, self.image_output_folder, basename, widths, self.variant_format, self.variant_quality)
+            except Exception as e:
+                print(f"Failed to create image variants for placeholder {placeholder['index']}: {e}")
+                return
+        placeholder['variants'] = variants
+        placeholder['mapping']['variants'] = variants['variants']
+        print(f"Created {len(variants['variants'])} image variants for placeholder {placeholder['index']}")
+
+    async def populate_group(self, group, semaphore, prompt_lock):
+        """
+        Populates the first of a group of placeholders with the same description, unless its image was restored
+        from the image cache, and commits the whole group.
+
+        Args:
+        group (list): The placeholders sharing one image.
+        semaphore (asyncio.Semaphore): Bounds the number of placeholders processed at once.
+        prompt_lock (asyncio.Lock): Serializes requests to the stateful image prompt agent.
+        """
+        if not group[0].get('mapping'):
+            await self.populate_placeholder(group[0], semaphore, prompt_lock)
+        if self.page_replaced:
+            return
+        await self.post_process(group[0], semaphore)
+        self.commit_group(group)
+
+    def commit_group(self, group):
+        """
+        Commits a group of placeholders sharing one image to index.html, metadata.json and the image status,
+        so that the page shows each image as soon as it is ready.
+
+        Args:
+        group (list): The placeholders sharing one image, the first of which has been populated.
+        """
+        # Writing the page the run started with over a newer one would lose the newer one for good
+        if self.page_replaced or self.get_page_version() != self.page_version:
+            if not self.page_replaced:
+                print(f"{self.html_path} was replaced by a newer page, stopping without committing")
+            self.page_replaced = True
+            return
+
+        for placeholder in group[1:]:
+            self.copy_image(group[0], placeholder)
+
+        for placeholder in group:
+            status = self.image_status[placeholder['index']]
+            if placeholder.get('mapping'):
+                self.apply_mapping(placeholder)
+                self.metadata['images'][get_placeholder_key(placeholder)] = placeholder['mapping']
+                status['status'] = 'ready'
+                status['src'] = placeholder['mapping']['src']
+            else:
+                print(f"No image generated for placeholder at index {placeholder['index']}")
+                status['status'] = 'failed'
+
+        write_atomic(self.html_path, self.page.render())
+        self.page_version = self.get_page_version()
+        self.write_metadata()
+        counts = self.write_image_status()
+        print(f"Committed {len(group)} image(s) to {self.html_path}")
+        event_hub.publish(self.session_id, "image_ready", {
+            "images": [dict(self.image_status[placeholder['index']]) for placeholder in group],
+            "counts": counts
+        })
+
+    def apply_mapping(self, placeholder):
+        """
+        Points a placeholder in the page at its image and records on its mapping what replaces the placeholder:
+        the new start tag of <img> and style attribute placeholders, and the image URL ('src') of CSS placeholders.
+
+        Args:
+        placeholder (dict): The populated placeholder.
+        """
+        mapping = placeholder['mapping']
+        image_base_url = f'http://127.0.0.1:5000/{self.session_id}/template/img/'
+        variants = placeholder.get('variants')
+        # Backgrounds cannot choose between variants, so they get the largest
+        new_image_url = urljoin(image_base_url, variants['variants'][-1]['file'] if variants else placeholder['image_path'])
+        mapping['src'] = new_image_url
+
+        if placeholder['type'] == 'img':
+            old_element_html = self.page.get_text(placeholder['span'])
+            updates = {'src': new_image_url}
+            if variants:
+                updates['srcset'] = ", ".join(f"{urljoin(image_base_url, variant['file'])} {variant['width']}w" for variant in variants['variants'])
+                updates['sizes'] = f"{placeholder['display_width']}px" if placeholder.get('display_width') else self.image_sizes
+                # Reserve the space of the image before it loads, with the blurred preview shown until it does
+                width, height = placeholder['attributes'].get('width'), placeholder['attributes'].get('height')
+                if not width and not height:
+                    updates['width'], updates['height'] = variants['width'], variants['height']
+                elif width and not height and width.isdigit():
+                    updates['height'] = round(int(width) * variants['height'] / variants['width'])
+                updates['loading'] = 'lazy'
+                updates['decoding'] = 'async'
+                style = placeholder['attributes'].get('style', '').strip()
+                preview_style = f"background-image: url({variants['preview']}); background-size: cover;"
+                updates['style'] = f"{style.rstrip(';')}; {preview_style}" if style else preview_style
+                self.add_responsive_image_style()
+            self.page.replace(placeholder['span'], set_attributes(old_element_html, updates))
+            print(f"Updated <img> tag with new src: {new_image_url}")
+
+        elif placeholder['type'] == 'style':
+            old_element_html = self.page.get_text(placeholder['span'])
+            new_style_content = placeholder['style_attribute'].replace(PLACEHOLDER_SRC, new_image_url)
+            self.page.replace(placeholder['span'], set_attributes(old_element_html, {'style': new_style_content}))
+            print(f"Updated style attribute with new background-image URL: {new_image_url}")
+
+        elif placeholder['type'] == 'css':
+            # Only the URL of this placeholder's rule is replaced, other placeholders in the same <style> tag get their own images
+            self.page.replace(placeholder['span'], new_image_url)
+            print(f"Updated <style> tag with new background-image URL: {new_image_url}")
+
+        if placeholder['type'] != 'css':
+            mapping['new_tag_html'] = self.page.get_text(placeholder['span'])
+
+    def add_responsive_image_style(self):
+        """
+        Adds a zero-specificity rule to the page that keeps <img> tags with width and height attributes
+        at their aspect ratio wherever the page only sets their width.
+        """
+        if self.has_responsive_image_style:
+            return
+        self.page.insert(self.page.head_end or 0, _RESPONSIVE_IMAGE_STYLE)
+        self.has_responsive_image_style = True
+
+    def get_page_version(self):
+        """
+        Identifies the version of index.html on disk, which changes whenever the file is replaced.
+
+        Returns:
+        tuple: The inode, modification time and size of the file, or None if there is no file.
+        """
+        try:
+            stat = os.stat(self.html_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def write_metadata(self):
+        write_atomic(self.metadata_file_path, json.dumps(self.metadata, indent=4))
+
+    def read_committed_image_status(self):
+        status_path = os.path.join(self.image_output_folder, 'status.json')
+        if not os.path.exists(status_path):
+            return {}
+        with open(status_path, 'r', encoding='utf-8') as f:
+            images = json.load(f).get('images', [])
+        # The placeholders the earlier run did not commit are still in the page and get new indices
+        return {status['index']: status for status in images if status['status'] == 'ready'}
+
+    def write_image_status(self):
+        images = sorted(self.image_status.values(), key=lambda status: status['index'])
+        counts = {state: sum(1 for status in images if status['status'] == state) for state in ('pending', 'ready', 'failed')}
+        write_atomic(os.path.join(self.image_output_folder, 'status.json'), json.dumps({'images': images, 'counts': counts}, indent=4))
+        return counts
+
+    async def aprocess(self, resume: bool = False):
+        with IMAGE_POPULATOR_LATENCY.time():
+            await self.populate(resume)
+
+    async def populate(self, resume: bool = False):
+        """
+        Populates the image placeholders left in index.html. Every image is committed to the page as soon as it is
+        ready, so a run that was cut short can be resumed by running again: committed placeholders are no longer
+        placeholders, and images generated but not committed are found in the image cache.
+
+        Args:
+        resume (bool): Whether an earlier run on the same page was cut short, in which case the images it committed
+        are kept in the image status.
+
+        Raises:
+        PageReplaced: If index.html was replaced during the run. Images committed before are kept, later ones are not.
+        """
         print("Starting process method.")
         # Read the index.html file
         with open(self.html_path, 'r', encoding='utf-8') as f:
             html_content = f.read()
+            # Taken from the open file, so it is the version that was read even if the file is replaced meanwhile
+            stat = os.fstat(f.fileno())
+        self.page_version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.page_replaced = False
         print("Read HTML content from file.")
 
-        # Parse the HTML with BeautifulSoup
-        soup = BeautifulSoup(html_content, 'html.parser')
-        print("Parsed HTML content with BeautifulSoup.")
-
-        placeholder_src = "/img/loading_gradient.gif"
-        placeholders = []
-
-        # Find all <img> tags with src=placeholder_src
-        img_placeholders = soup.find_all('img', src=placeholder_src)
-        print(f"Found {len(img_placeholders)} <img> placeholders.")
-        for img in img_placeholders:
-            alt_text = img.get('alt', '')
-            placeholders.append({
-                'type': 'img',
-                'tag': img,
-                'description': alt_text
-            })
-
-        # Find elements with style attributes containing background-image
-        background_image_pattern = re.compile(r'background-image\s*:\s*url\([\'"]?(.+?)[\'"]?\)\s*;?')
-
-        elements_with_style = soup.find_all(style=True)
-        print(f"Found {len(elements_with_style)} elements with style attributes.")
-        for elem in elements_with_style:
-            style_content = elem['style']
-            matches = background_image_pattern.findall(style_content)
-            for match in matches:
-                if match.strip() == placeholder_src:
-                    description = elem.get('data-description', '')  # Try to get description from data attribute
-                    placeholders.append({
-                        'type': 'style',
-                        'tag': elem,
-                        'description': description,
-                        'style_attribute': style_content
-                    })
-
-        # Find <style> tags and parse CSS content
-        css_background_image_pattern = re.compile(
-            r'background-image\s*:\s*url\([\'"]?(.+?)[\'"]?\);\s*/\*(.*?)\*/', re.DOTALL)
-
-        style_tags = soup.find_all('style')
-        print(f"Found {len(style_tags)} <style> tags.")
-        for style_tag in style_tags:
-            css_content = style_tag.string
-            if css_content:
-                matches = css_background_image_pattern.findall(css_content)
-                for url, comment in matches:
-                    if url.strip() == placeholder_src:
-                        description = comment.strip()
-                        placeholders.append({
-                            'type': 'css',
-                            'style_tag': style_tag,
-                            'description': description,
-                            'url': url
-                        })
+        # Find all placeholders in one pass over the page
+        self.page = PlaceholderPage(html_content)
+        placeholders = self.page.scan(PLACEHOLDER_SRC)
+        self.has_responsive_image_style = _RESPONSIVE_IMAGE_STYLE in html_content
+        for placeholder_type in ('img', 'style', 'css'):
+            print(f"Found {sum(1 for placeholder in placeholders if placeholder['type'] == placeholder_type)} {placeholder_type} placeholders.")
 
         print(f"Total placeholders found: {len(placeholders)}")
+        IMAGE_PLACEHOLDERS.labels("found").inc(len(placeholders))
 
         # Initialize metadata dictionary
-        metadata_file_path = os.path.join(self.image_output_folder, 'metadata.json')
-        if os.path.exists(metadata_file_path):
-            with open(metadata_file_path, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-            print(f"Loaded existing metadata from {metadata_file_path}")
+        self.metadata_file_path = os.path.join(self.image_output_folder, 'metadata.json')
+        if os.path.exists(self.metadata_file_path):
+            with open(self.metadata_file_path, 'r', encoding='utf-8') as f:
+                metadata = migrate_metadata(json.load(f))
+            print(f"Loaded existing metadata from {self.metadata_file_path}")
         else:
             metadata = {
+                'version': METADATA_VERSION,
                 'imageCount': 0,
-                'mappings': []
+                'images': {}
             }
+        self.metadata = metadata
 
-        start_index = metadata['imageCount']
-        processed_images = 0  # Count of images processed in this run
-
-        # Process each placeholder
+        # Indices are assigned in document order up front, so concurrent runs name their images deterministically
         for placeholder in placeholders:
-            index = start_index + processed_images
-            description = placeholder['description']
-            if not description:
-                print(f"No description found for placeholder at index {index}, skipping.")
+            if not placeholder['description']:
+                print("No description found for placeholder, skipping.")
+                IMAGE_PLACEHOLDERS.labels("skipped").inc()
                 continue
-            print(f"Processing placeholder {index} with description: {description}")
-
-            # Get image prompt from LLM
-            image_prompt = self.prompt_gen_agent.send_prompt(description)
-            self.prompt_gen_agent.save(os.path.join(self.session_dir, 'agents', 'prompt_gen_agent.json'))
-            placeholder['image_prompt'] = image_prompt
-            print(f"Generated image prompt: {image_prompt}")
-
-            # Generate image using DALL·E agent
-            image_url = self.image_gen_agent.generate_image(image_prompt)
-            self.image_gen_agent.save(os.path.join(self.session_dir, 'agents', 'image_gen_agent.json'))
-            placeholder['image_url'] = image_url
-            print(f"Generated image URL: {image_url}")
-
-            # Download image and save to disk
-            response = requests.get(image_url)
-            if response.status_code == 200:
-                image_filename = f'image_{index}.jpg'
-                image_path = os.path.join(self.image_output_folder, image_filename)
-                with open(image_path, 'wb') as f:
-                    f.write(response.content)
-                placeholder['image_path'] = image_filename  # Use relative path
-                print(f"Downloaded and saved image to: {image_path}")
-            else:
-                print(f'Failed to download image from {image_url}')
-                placeholder['image_path'] = None
-                continue  # Skip to the next placeholder if image download failed
-
-            # Prepare data for metadata mapping
-            mapping = {
-                'index': index,
-                'type': placeholder['type'],
-                'description': description,
-                'image_prompt': image_prompt,
-                'image_url': image_url,
-                'image_path': placeholder.get('image_path')
-            }
-
-            # Get the old element HTML before modification
-            if placeholder['type'] == 'img':
-                old_element_html = str(placeholder['tag'])
-            elif placeholder['type'] == 'style':
-                old_element_html = str(placeholder['tag'])
-            elif placeholder['type'] == 'css':
-                old_element_html = str(placeholder['style_tag'])
-
-            mapping['old_element_html'] = old_element_html
-
-            # Save mapping in placeholder for later use
-            placeholder['mapping'] = mapping
-
-            # Increment processed_images and imageCount
-            processed_images += 1
+            placeholder['index'] = metadata['imageCount']
             metadata['imageCount'] += 1
 
-            # Append mapping to metadata
-            metadata['mappings'].append(mapping)
-
-        # Update the HTML with new image paths and collect new element HTML
-        for placeholder in placeholders:
-            mapping = placeholder.get('mapping', {})
-            if placeholder.get('image_path'):
-                new_image_url = urljoin(f'http://127.0.0.1:5000/{self.session_id}/template/img/', placeholder['image_path'])
-
-                if placeholder['type'] == 'img':
-                    img_tag = placeholder['tag']
-                    img_tag['src'] = new_image_url
-                    print(f"Updated <img> tag with new src: {new_image_url}")
-
-                    # Get new element HTML
-                    new_element_html = str(img_tag)
-                    mapping['new_element_html'] = new_element_html
-
-                elif placeholder['type'] == 'style':
-                    elem = placeholder['tag']
-                    style_content = elem['style']
-                    new_style_content = style_content.replace(placeholder_src, new_image_url)
-                    elem['style'] = new_style_content
-                    print(f"Updated style attribute with new background-image URL: {new_image_url}")
-
-                    # Get new element HTML
-                    new_element_html = str(elem)
-                    mapping['new_element_html'] = new_element_html
-
-                elif placeholder['type'] == 'css':
-                    style_tag = placeholder['style_tag']
-                    css_content = style_tag.string
-                    new_css_content = css_content.replace(placeholder_src, new_image_url)
-                    style_tag.string.replace_with(new_css_content)
-                    print(f"Updated <style> tag with new background-image URL: {new_image_url}")
-
-                    # Get new element HTML
-                    new_element_html = str(style_tag)
-                    mapping['new_element_html'] = new_element_html
-
-            else:
-                print(f"No image generated for placeholder at index {mapping.get('index')}")
-
-        # Write the modified HTML back to the file
-        with open(self.html_path, 'w', encoding='utf-8') as f:
-            f.write(str(soup))
-        print("Wrote modified HTML content back to file.")
-
-        # Write the metadata .json file
-        with open(metadata_file_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=4)
-        print(f"Wrote metadata to {metadata_file_path}")
-
-        # Update the assistant message content in the template_agent
-        print("Updating the assistant message content in the template_agent.")
-        assistant_messages = [msg for msg in self.template_agent.messages if msg['role'] == 'assistant']
-        if assistant_messages:
-            last_assistant_message = assistant_messages[-1]
-            assistant_html_content = last_assistant_message['content']
-            # Parse the assistant's HTML content
-            soup_template = BeautifulSoup(assistant_html_content, 'html.parser')
-            print("Parsed assistant's HTML content with BeautifulSoup.")
-
-            # Update the assistant's HTML content using the mappings
-            for mapping in metadata['mappings']:
-                placeholder_type = mapping['type']
-                old_element_html = mapping['old_element_html']
-                new_element_html = mapping['new_element_html']
-
-                if placeholder_type == 'img':
-                    # Find and replace the old <img> tag
-                    old_tag = BeautifulSoup(old_element_html, 'html.parser').find('img')
-                    new_tag = BeautifulSoup(new_element_html, 'html.parser').find('img')
-                    if old_tag and new_tag:
-                        for img_tag in soup_template.find_all('img', src=placeholder_src):
-                            if img_tag.get('alt', '') == old_tag.get('alt', ''):
-                                img_tag.replace_with(new_tag)
-                                print(f"Replaced <img> tag in assistant's HTML content.")
-
-                elif placeholder_type == 'style':
-                    # Find and replace the style attribute in the element
-                    old_tag = BeautifulSoup(old_element_html, 'html.parser').find()
-                    new_tag = BeautifulSoup(new_element_html, 'html.parser').find()
-                    if old_tag and new_tag:
-                        for elem in soup_template.find_all(style=True):
-                            if elem['style'] == old_tag['style']:
-                                elem['style'] = new_tag['style']
-                                print(f"Updated style attribute in assistant's HTML content.")
-
-                elif placeholder_type == 'css':
-                    # Replace the CSS content in the <style> tag
-                    old_style_content = BeautifulSoup(old_element_html, 'html.parser').string
-                    new_style_content = BeautifulSoup(new_element_html, 'html.parser').string
-                    for style_tag in soup_template.find_all('style'):
-                        if style_tag.string and style_tag.string.strip() == old_style_content.strip():
-                            style_tag.string.replace_with(new_style_content)
-                            print(f"Updated <style> tag content in assistant's HTML content.")
-
-            # Update the assistant message's content
-            last_assistant_message['content'] = str(soup_template)
-            print("Assistant message content updated with modified HTML.")
+        indexed_placeholders = [placeholder for placeholder in placeholders if 'index' in placeholder]
+        self.image_status = self.read_committed_image_status() if resume else {}
+        self.image_status.update({
+            placeholder['index']: {'index': placeholder['index'], 'description': placeholder['description'], 'status': 'pending'}
+            for placeholder in indexed_placeholders
+        })
+        # Reserve the indices before any image is written
+        self.write_metadata()
+        self.write_image_status()
+
+        # Placeholders with the same description on a page share one image
+        duplicates = {}
+        for placeholder in indexed_placeholders:
+            self.size_placeholder(placeholder)
+            duplicates.setdefault((normalize_description(placeholder['description']), placeholder['size']), []).append(placeholder)
+        pending_groups = list(duplicates.values())
+
+        # An image cache keyed by the description alone can be consulted before any prompt is generated
+        if self.image_cache and not self.image_cache.key_includes_prompt:
+            uncached_groups = [group for group in pending_groups if not self.restore_cached_image(group[0])]
         else:
-            print("No assistant messages found in the template_agent.")
-        self.template_agent.save(os.path.join(self.session_dir, 'agents', 'template_agent.json'))
-        self.delete_image_lockfile()
+            uncached_groups = pending_groups
+
+        if self.batch_prompts and len(uncached_groups) > 1:
+            await self.generate_image_prompts([group[0] for group in uncached_groups])
+
+        # Process the placeholders, at most self.concurrency at a time, committing each image as it is ready
+        semaphore = asyncio.Semaphore(self.concurrency)
+        prompt_lock = asyncio.Lock()
+        await asyncio.gather(*(self.populate_group(group, semaphore, prompt_lock) for group in pending_groups))
+        if self.page_replaced:
+            raise PageReplaced(f"{self.html_path} was replaced during the run")
+        print("Wrote modified HTML content and metadata.")
+
+        # Images of placeholders that are no longer on the page are dropped from the index. A resumed run
+        # only sees the placeholders the earlier run left, so it keeps the index as it is
+        if not resume:
+            current_keys = {get_placeholder_key(placeholder) for placeholder in indexed_placeholders}
+            stale_keys = [key for key in metadata['images'] if key not in current_keys]
+            for key in stale_keys:
+                del metadata['images'][key]
+            if stale_keys:
+                self.write_metadata()
+                print(f"Compacted {len(stale_keys)} stale images from {self.metadata_file_path}")
@@ -0,0 +1,69 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import base64
+import io
+import os
+
+try:
+    from PIL import Image, ImageFilter, features
+except ImportError:
+    Image = None
+
+_EXTENSIONS = {"webp": ".webp", "avif": ".avif"}
+_PREVIEW_WIDTH = 16
+
+def is_available(image_format: str = "webp") -> bool:
+    """
+    Checks whether images can be transcoded to a format with the installed libraries.
+
+    Args:
+    image_format (str): The target format, 'webp' or 'avif'.
+
+    Returns:
+    bool: Whether Pillow is installed with support for the format.
+    """
+    return Image is not None and image_format in _EXTENSIONS and features.check(image_format)
+
+def create_variants(source_path: str, output_dir: str, basename: str, widths: list, image_format: str = "webp", quality: int = 80) -> dict:
+    """
+    Transcodes an image into responsive variants of several widths and a tiny blurred preview.
+    Variants are never wider than the source, whose own width is always included.
+
+    Args:
+    source_path (str): The path of the generated image.
+    output_dir (str): The directory to write the variants to.
+    basename (str): The file name of the variants without width and extension, e.g. 'image_3'.
+    widths (list): The widths of the variants in pixels.
+    image_format (str): The format of the variants, 'webp' or 'avif'; falls back to 'webp' if 'avif' is unsupported.
+    quality (int): The encoder quality from 0 to 100.
+
+    Returns:
+    dict: The width and height of the source, the variants as a list of {'file', 'width'} from smallest to largest,
+    and the preview as a data URI.
+    """
+    if image_format == "avif" and not is_available("avif"):
+        image_format = "webp"
+    extension = _EXTENSIONS[image_format]
+
+    with Image.open(source_path) as source:
+        source.load()
+        image = source.convert("RGBA" if source.mode in ("RGBA", "LA", "P") else "RGB")
+    width, height = image.size
+
+    variants = []
+    for variant_width in sorted({w for w in widths if w < width} | {width}):
+        variant_height = round(height * variant_width / width)
+        variant = image if variant_width == width else image.resize((variant_width, variant_height), Image.LANCZOS)
+        filename = f"{basename}-{variant_width}w{extension}"
+        temp_path = os.path.join(output_dir, f"{filename}.part")
+        variant.save(temp_path, format=image_format.upper(), quality=quality)
+        os.replace(temp_path, os.path.join(output_dir, filename))
+        variants.append({"file": filename, "width": variant_width})
+
+    preview = image.resize((_PREVIEW_WIDTH, max(1, round(height * _PREVIEW_WIDTH / width))), Image.BILINEAR).filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    preview.save(buffer, format="WEBP", quality=30)
+    preview_uri = "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    return {"width": width, "height": height, "variants": variants, "preview": preview_uri}
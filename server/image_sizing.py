@@ -0,0 +1,95 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import re
+
+# Sizes supported by DALL-E 3
+SQUARE_SIZE = "1024x1024"
+LANDSCAPE_SIZE = "1792x1024"
+PORTRAIT_SIZE = "1024x1792"
+
+_LANDSCAPE_KEYWORDS = ("banner", "hero", "header", "panorama", "landscape", "wide", "jumbotron", "slider", "carousel")
+_PORTRAIT_KEYWORDS = ("portrait", "poster", "tall", "vertical", "skyscraper", "sidebar")
+_SMALL_KEYWORDS = ("icon", "logo", "avatar", "thumbnail", "thumb", "badge", "favicon", "profile picture", "headshot")
+
+_WORD_PATTERN = re.compile(r'[a-z]+')
+_DIMENSION_PATTERN = re.compile(r'(?<![-\w])(width|height|min-height)\s*:\s*([\d.]+)\s*(px|vh|vw|%|rem|em)?', re.IGNORECASE)
+_PIXEL_ATTRIBUTE_PATTERN = re.compile(r'^\s*(\d+)\s*(px)?\s*$')
+
+# Placeholders displayed at most this many pixels wide are small
+_SMALL_MAX_PIXELS = 256
+_ROOT_FONT_PIXELS = 16
+
+def parse_dimensions(style: str, width_attribute: str = None, height_attribute: str = None) -> dict:
+    """
+    Reads the width and height of an element from its style declarations and width/height attributes.
+
+    Args:
+    style (str): The style declarations of the element, from its style attribute or its CSS rule.
+    width_attribute (str): The width attribute of the element, if any.
+    height_attribute (str): The height attribute of the element, if any.
+
+    Returns:
+    dict: The 'width' and 'height' in pixels where they are given in pixels (or rem/em), and whether the element
+    spans the full viewport width ('full_width') or a large part of its height ('tall_viewport').
+    """
+    dimensions = {"width": None, "height": None, "full_width": False, "tall_viewport": False}
+    for name, value, unit in _DIMENSION_PATTERN.findall(style or ""):
+        name, unit, value = name.lower(), (unit or "px").lower(), float(value)
+        if unit in ("rem", "em"):
+            value, unit = value * _ROOT_FONT_PIXELS, "px"
+        if unit == "px":
+            dimensions["width" if name == "width" else "height"] = round(value)
+        elif name == "width" and value >= 90 and unit in ("%", "vw"):
+            dimensions["full_width"] = True
+        elif name != "width" and value >= 40 and unit == "vh":
+            dimensions["tall_viewport"] = True
+
+    for name, attribute in (("width", width_attribute), ("height", height_attribute)):
+        match = _PIXEL_ATTRIBUTE_PATTERN.match(attribute or "")
+        if match and dimensions[name] is None:
+            dimensions[name] = int(match.group(1))
+    return dimensions
+
+def infer_image_request(placeholder_type: str, description: str, style: str = "", width_attribute: str = None, height_attribute: str = None, class_names: str = "") -> dict:
+    """
+    Infers the size of the image a placeholder needs from its context. Explicit pixel dimensions win,
+    then keywords in the description and class names, then whether the placeholder is a background.
+
+    Args:
+    placeholder_type (str): 'img' for <img> tags, 'style' or 'css' for background images.
+    description (str): The description of the placeholder.
+    style (str): The style declarations of the element, from its style attribute or its CSS rule.
+    width_attribute (str): The width attribute of an <img> tag, if any.
+    height_attribute (str): The height attribute of an <img> tag, if any.
+    class_names (str): The class names of the element, or the selector of its CSS rule.
+
+    Returns:
+    dict: The 'size' to request, whether the image is 'small' (rendered at most 256 pixels wide, so the cheapest
+    quality is enough), and its 'display_width' in pixels where the page fixes it.
+    """
+    dimensions = parse_dimensions(style, width_attribute, height_attribute)
+    width, height = dimensions["width"], dimensions["height"]
+    words = set(_WORD_PATTERN.findall(f"{description} {class_names}".lower()))
+
+    def mentions(keywords):
+        return any(keyword in words or (" " in keyword and keyword in description.lower()) for keyword in keywords)
+
+    small = bool(width and width <= _SMALL_MAX_PIXELS) or (not width and mentions(_SMALL_KEYWORDS))
+
+    if width and height:
+        ratio = width / height
+        size = LANDSCAPE_SIZE if ratio >= 1.4 else PORTRAIT_SIZE if ratio <= 0.7 else SQUARE_SIZE
+    elif small:
+        size = SQUARE_SIZE
+    elif mentions(_PORTRAIT_KEYWORDS):
+        size = PORTRAIT_SIZE
+    elif mentions(_LANDSCAPE_KEYWORDS) or dimensions["full_width"] or dimensions["tall_viewport"]:
+        size = LANDSCAPE_SIZE
+    elif placeholder_type in ("style", "css"):
+        # Backgrounds mostly fill page sections, which are wider than they are tall
+        size = LANDSCAPE_SIZE
+    else:
+        size = SQUARE_SIZE
+
+    return {"size": size, "small": small, "display_width": width}
@@ -0,0 +1,278 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import threading
+import time
+import uuid
+from agent_loop import get_agent_loop
+from metrics import JOBS, JOB_LATENCY, JOB_QUEUE_LENGTH, JOB_RUNNING, JOB_SATURATION
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMED_OUT = "timed_out"
+
+_FINISHED = (SUCCEEDED, FAILED, CANCELLED, TIMED_OUT)
+_JSON_TYPES = (str, int, float, bool, list, dict, type(None))
+
+class JobCancelled(Exception):
+    """Raised by JobExecutor.run when the job is cancelled through the executor."""
+
+class JobTimedOut(Exception):
+    """Raised by JobExecutor.run when the job runs longer than the timeout of its type."""
+
+class JobExecutor:
+    def __init__(self, pool_sizes: dict = None, timeouts: dict = None, retention_seconds: float = 3600.0, max_finished_jobs: int = 1000):
+        """
+        Initializes the JobExecutor, which runs background work on the agent event loop in bounded pools, one per
+        job type. Every job gets an ID under which its status, result or error can be looked up until it is evicted,
+        and can be cancelled; jobs running longer than the timeout of their type are cancelled as timed out.
+
+        Args:
+        pool_sizes (dict): The number of jobs of each type run at once; types without a size run one at a time.
+        timeouts (dict): The number of seconds jobs of each type may run; types without a timeout run until done.
+        retention_seconds (float): How long finished jobs can be looked up.
+        max_finished_jobs (int): The number of finished jobs kept at most, oldest evicted first.
+        """
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._tasks = {}
+        self._semaphores = {}
+        self._waiting = {}
+        self._running = {}
+        self.configure(pool_sizes or {}, timeouts or {}, retention_seconds, max_finished_jobs)
+
+    def configure(self, pool_sizes: dict, timeouts: dict, retention_seconds: float, max_finished_jobs: int = 1000):
+        """
+        Sets the pool sizes, timeouts and retention used from now on. Pools of jobs already waiting keep their size.
+
+        Args:
+        pool_sizes (dict): The number of jobs of each type run at once.
+        timeouts (dict): The number of seconds jobs of each type may run; None or 0 for no timeout.
+        retention_seconds (float): How long finished jobs can be looked up.
+        max_finished_jobs (int): The number of finished jobs kept at most.
+        """
+        with self._lock:
+            self.pool_sizes = {job_type: max(1, int(size)) for job_type, size in pool_sizes.items()}
+            self.timeouts = {job_type: timeout for job_type, timeout in timeouts.items() if timeout}
+            self.retention_seconds = retention_seconds
+            self.max_finished_jobs = max_finished_jobs
+            self._semaphores = {}
+
+    def submit(self, job_type: str, coro, session_id: str = None) -> str:
+        """
+        Queues a coroutine in the pool of its type without waiting for it. Safe to call from any thread.
+
+        Args:
+        job_type (str): The job type, e.g. 'template', 'title' or 'images'.
+        coro: The coroutine to run.
+        session_id (str): The session the job belongs to, if any.
+
+        Returns:
+        str: The job ID.
+        """
+        job = self._create_job(job_type, session_id)
+        future = asyncio.run_coroutine_threadsafe(self._execute(job, coro), get_agent_loop())
+        future.add_done_callback(_consume_result)
+        return job['id']
+
+    async def run(self, job_type: str, coro, session_id: str = None):
+        """
+        Runs a coroutine in the pool of its type and waits for its result. Must be awaited on the agent event loop.
+
+        Args:
+        job_type (str): The job type.
+        coro: The coroutine to run.
+        session_id (str): The session the job belongs to, if any.
+
+        Returns:
+        The result of the coroutine.
+
+        Raises:
+        JobCancelled: If the job was cancelled through the executor.
+        JobTimedOut: If the job ran longer than the timeout of its type.
+        """
+        job = self._create_job(job_type, session_id)
+        return await self._execute(job, coro)
+
+    def get_job(self, job_id: str) -> dict:
+        """
+        Returns the status of a job.
+
+        Args:
+        job_id (str): The job ID.
+
+        Returns:
+        dict: A copy of the job, or None if it is unknown or was evicted.
+        """
+        with self._lock:
+            self._evict()
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list_jobs(self, session_id: str = None) -> list:
+        """
+        Returns the status of all jobs, or of the jobs of a session, oldest first.
+
+        Args:
+        session_id (str): The session ID, or None for all sessions.
+
+        Returns:
+        list: Copies of the jobs.
+        """
+        with self._lock:
+            self._evict()
+            return [dict(job) for job in self._jobs.values() if session_id is None or job['session_id'] == session_id]
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancels a pending or running job. Safe to call from any thread.
+
+        Args:
+        job_id (str): The job ID.
+
+        Returns:
+        bool: Whether the job was still pending or running.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] in _FINISHED:
+                return False
+            job['cancel_requested'] = True
+            task = self._tasks.get(job_id)
+        if task is not None:
+            get_agent_loop().call_soon_threadsafe(task.cancel)
+        return True
+
+    def cancel_session(self, session_id: str, job_type: str = None) -> int:
+        """
+        Cancels the pending and running jobs of a session.
+
+        Args:
+        session_id (str): The session ID.
+        job_type (str): The job type to cancel, or None for jobs of every type.
+
+        Returns:
+        int: The number of jobs cancelled.
+        """
+        with self._lock:
+            job_ids = [job['id'] for job in self._jobs.values() if job['session_id'] == session_id and job['status'] not in _FINISHED
+                       and (job_type is None or job['type'] == job_type)]
+        return sum(self.cancel(job_id) for job_id in job_ids)
+
+    def _create_job(self, job_type, session_id):
+        job = {
+            "id": uuid.uuid4().hex,
+            "type": job_type,
+            "session_id": session_id,
+            "status": PENDING,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "result": None,
+            "error": None,
+            "cancel_requested": False
+        }
+        with self._lock:
+            self._evict()
+            self._jobs[job['id']] = job
+        return job
+
+    async def _execute(self, job, coro):
+        job_type = job['type']
+        with self._lock:
+            cancelled = job['cancel_requested']
+            if not cancelled:
+                self._tasks[job['id']] = asyncio.current_task()
+        if cancelled:
+            # Cancelled before the loop got to it
+            coro.close()
+            self._finish(job, CANCELLED, error="Cancelled")
+            raise JobCancelled(job['id'])
+
+        with self._lock:
+            semaphore = self._semaphores.get(job_type)
+            if semaphore is None:
+                semaphore = self._semaphores[job_type] = asyncio.Semaphore(self.pool_sizes.get(job_type, 1))
+            timeout = self.timeouts.get(job_type)
+
+        self._count(self._waiting, job_type, 1)
+        acquired = False
+        try:
+            await semaphore.acquire()
+            acquired = True
+            self._count(self._waiting, job_type, -1)
+            self._count(self._running, job_type, 1)
+            with self._lock:
+                job['status'] = RUNNING
+                job['started'] = time.time()
+
+            try:
+                result = await asyncio.wait_for(coro, timeout)
+            except asyncio.TimeoutError:
+                print(f"{job_type} job {job['id']} timed out after {timeout}s")
+                self._finish(job, TIMED_OUT, error=f"Timed out after {timeout}s")
+                raise JobTimedOut(job['id'])
+            except Exception as e:
+                print(f"{job_type} job {job['id']} failed: {e}")
+                self._finish(job, FAILED, error=str(e))
+                raise
+            self._finish(job, SUCCEEDED, result=result if isinstance(result, _JSON_TYPES) else str(result))
+            return result
+        except asyncio.CancelledError:
+            coro.close()
+            self._finish(job, CANCELLED, error="Cancelled")
+            if job['cancel_requested']:
+                # Cancelled through the executor rather than by the loop shutting down
+                raise JobCancelled(job['id'])
+            raise
+        finally:
+            if acquired:
+                semaphore.release()
+                self._count(self._running, job_type, -1)
+            else:
+                self._count(self._waiting, job_type, -1)
+            with self._lock:
+                self._tasks.pop(job['id'], None)
+
+    def _finish(self, job, status, result=None, error=None):
+        with self._lock:
+            if job['status'] in _FINISHED:
+                return
+            job['status'] = status
+            job['finished'] = time.time()
+            job['result'] = result
+            job['error'] = error
+        JOBS.labels(job['type'], status).inc()
+        if job['started'] is not None:
+            JOB_LATENCY.labels(job['type'], status).observe(job['finished'] - job['started'])
+
+    def _count(self, counts, job_type, delta):
+        # Only called on the agent loop, so the counts need no lock
+        counts[job_type] = counts.get(job_type, 0) + delta
+        if counts is self._waiting:
+            JOB_QUEUE_LENGTH.labels(job_type).set(counts[job_type])
+        else:
+            JOB_RUNNING.labels(job_type).set(counts[job_type])
+            JOB_SATURATION.labels(job_type).set(counts[job_type] / self.pool_sizes.get(job_type, 1))
+
+    def _evict(self):
+        # Called with the lock held; jobs are kept in creation order
+        finished = [job for job in self._jobs.values() if job['status'] in _FINISHED]
+        cutoff = time.time() - self.retention_seconds
+        excess = len(finished) - self.max_finished_jobs
+        for job in finished:
+            if job['finished'] < cutoff or excess > 0:
+                del self._jobs[job['id']]
+                excess -= 1
+
+def _consume_result(future):
+    # Failures are recorded on the job and printed when they happen; retrieving them keeps asyncio from warning
+    if not future.cancelled():
+        future.exception()
+
+# Process-wide executor; AgentFactory configures it from config.yaml
+job_executor = JobExecutor()
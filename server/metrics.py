@@ -0,0 +1,82 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Pipeline stages take seconds to minutes, so the default sub-second buckets are of little use
+_PIPELINE_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+
+IMAGE_DOWNLOAD_BYTES = Counter(
+    "sitebuilder_image_download_bytes_total",
+    "Bytes of generated images downloaded."
+)
+IMAGE_DOWNLOAD_LATENCY = Histogram(
+    "sitebuilder_image_download_duration_seconds",
+    "Duration of generated image downloads.",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30)
+)
+IMAGE_POPULATOR_LATENCY = Histogram(
+    "sitebuilder_image_populator_duration_seconds",
+    "Duration of ImagePopulator runs.",
+    buckets=_PIPELINE_BUCKETS
+)
+IMAGE_PLACEHOLDERS = Counter(
+    "sitebuilder_image_placeholders_total",
+    "Image placeholders handled by ImagePopulator by outcome (found, populated, skipped or failed).",
+    ["outcome"]
+)
+IMAGE_CACHE_LOOKUPS = Counter(
+    "sitebuilder_image_cache_lookups_total",
+    "Generated image cache lookups by outcome (hit or miss).",
+    ["outcome"]
+)
+IMAGE_JOBS = Counter(
+    "sitebuilder_image_jobs_total",
+    "Image population job runs by outcome (done, retried, requeued, expired or failed).",
+    ["outcome"]
+)
+JOBS = Counter(
+    "sitebuilder_jobs_total",
+    "Background jobs run by JobExecutor by type and final status (succeeded, failed, cancelled or timed_out).",
+    ["type", "status"]
+)
+JOB_LATENCY = Histogram(
+    "sitebuilder_job_duration_seconds",
+    "Running time of background jobs by type and final status, excluding time spent queued.",
+    ["type", "status"],
+    buckets=_PIPELINE_BUCKETS
+)
+JOB_QUEUE_LENGTH = Gauge(
+    "sitebuilder_job_queue_length",
+    "Background jobs waiting for a free slot in the pool of their type.",
+    ["type"]
+)
+JOB_RUNNING = Gauge(
+    "sitebuilder_jobs_running",
+    "Background jobs running by type.",
+    ["type"]
+)
+JOB_SATURATION = Gauge(
+    "sitebuilder_job_pool_saturation_ratio",
+    "Fraction of the pool of each job type that is busy; at 1 new jobs of the type queue up.",
+    ["type"]
+)
+TEMPLATE_READY_LATENCY = Histogram(
+    "sitebuilder_template_ready_seconds",
+    "Time from receiving a prompt on /sendprompt until index.html is written.",
+    buckets=_PIPELINE_BUCKETS
+)
+IMAGES_READY_LATENCY = Histogram(
+    "sitebuilder_images_ready_seconds",
+    "Time from receiving a prompt on /sendprompt until all images of the page are populated.",
+    buckets=_PIPELINE_BUCKETS
+)
+
+def render_metrics():
+    """
+    Renders all registered metrics in the Prometheus text exposition format.
+
+    Returns:
+    tuple: The rendered metrics and their content type.
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,240 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import html
+import re
+
+# One pass over the page tokenizes comments, <script> and <style> elements and start tags; everything else is text.
+# The C regex engine does the scanning, and every token keeps its offsets, so edits are spliced into the original
+# text instead of re-serializing a parsed tree.
+_TOKEN_PATTERN = re.compile(
+    r'<!--.*?-->'
+    r'|<(?P<raw>script|style)\b(?P<raw_attributes>(?:[^>"\']|"[^"]*"|\'[^\']*\')*)>(?P<raw_content>.*?)</(?P=raw)\s*>'
+    r'|<(?P<tag>[a-zA-Z][\w:-]*)(?P<attributes>(?:[^>"\']|"[^"]*"|\'[^\']*\')*)>',
+    re.DOTALL | re.IGNORECASE
+)
+_ATTRIBUTE_PATTERN = re.compile(r'([^\s"\'>/=]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+)))?')
+_STYLE_BACKGROUND_IMAGE_PATTERN = re.compile(r'background-image\s*:\s*url\([\'"]?(.+?)[\'"]?\)\s*;?')
+# The URL cannot contain a parenthesis, so a match never runs from one rule into the next
+_CSS_BACKGROUND_IMAGE_PATTERN = re.compile(r'background-image\s*:\s*url\([\'"]?([^)]+?)[\'"]?\);\s*/\*(.*?)\*/', re.DOTALL)
+
+def parse_attributes(attributes_html: str) -> dict:
+    """
+    Parses the attributes of a start tag. Names are lower-cased and values unescaped; the first occurrence of an attribute wins, as in browsers.
+
+    Args:
+    attributes_html (str): The text of the start tag between its name and its closing '>'.
+
+    Returns:
+    dict: The attribute values by name, '' for attributes without a value.
+    """
+    attributes = {}
+    for name, double_quoted, single_quoted, unquoted in _ATTRIBUTE_PATTERN.findall(attributes_html):
+        name = name.lower()
+        if name not in attributes:
+            value = double_quoted or single_quoted or unquoted
+            attributes[name] = html.unescape(value) if value else value
+    return attributes
+
+def set_attributes(tag_html: str, updates: dict) -> str:
+    """
+    Sets attributes of a start tag, rewriting the attributes that change in place and appending new ones.
+
+    Args:
+    tag_html (str): The start tag, e.g. '<img src="a.gif" alt="A">'.
+    updates (dict): The new attribute values by lower-case name.
+
+    Returns:
+    str: The start tag with the new attribute values.
+    """
+    match = _TOKEN_PATTERN.match(tag_html)
+    if not match or not match.group('tag'):
+        raise ValueError(f"Not a start tag: {tag_html[:80]}")
+    attributes_html = match.group('attributes')
+    attributes_start = match.start('attributes')
+    pending = dict(updates)
+
+    parts = []
+    position = 0
+    for attribute in _ATTRIBUTE_PATTERN.finditer(attributes_html):
+        name = attribute.group(1).lower()
+        if name in pending:
+            parts.append(attributes_html[position:attribute.start()])
+            parts.append(f'{name}="{html.escape(str(pending.pop(name)), quote=True)}"')
+            position = attribute.end()
+    parts.append(attributes_html[position:])
+    attributes_html = "".join(parts)
+
+    # New attributes go before a self-closing slash
+    body = attributes_html.rstrip()
+    closing = ""
+    if body.endswith("/"):
+        body, closing = body[:-1].rstrip(), " /"
+    added = "".join(f' {name}="{html.escape(str(value), quote=True)}"' for name, value in pending.items())
+    return f"{tag_html[:attributes_start]}{body}{added}{closing}>"
+
+class PlaceholderPage:
+    def __init__(self, html_content: str):
+        """
+        Initializes the PlaceholderPage, an HTML page whose image placeholders are found in one pass and replaced
+        by splicing edits into the original text.
+
+        Args:
+        html_content (str): The HTML of the page.
+        """
+        self.html = html_content
+        # Replacement text by (start, end) span of the original text; an empty span inserts text
+        self._edits = {}
+        self.head_end = None
+
+    def scan(self, placeholder_src: str) -> list:
+        """
+        Finds the image placeholders of the page in document order: <img> tags with the placeholder as their src,
+        elements whose style attribute uses it as background image, and background images of CSS rules in
+        <style> elements followed by a /* description */ comment.
+
+        Args:
+        placeholder_src (str): The src of placeholder images.
+
+        Returns:
+        list: The placeholders, each with its 'type', 'description' and 'span' in the page. Tag placeholders
+        have their 'attributes'; CSS placeholders the 'block_span' of their <style> element, and the 'selector'
+        and declarations ('rule') of their CSS rule.
+        """
+        placeholders = []
+        for token in _TOKEN_PATTERN.finditer(self.html):
+            if token.group('raw'):
+                if token.group('raw').lower() == 'style':
+                    placeholders.extend(self._scan_css(token, placeholder_src))
+                continue
+
+            tag = token.group('tag')
+            if tag is None:
+                continue
+            tag = tag.lower()
+            if tag == 'head' and self.head_end is None:
+                self.head_end = token.end()
+            attributes_html = token.group('attributes')
+            # Most tags have neither a src nor a style, so they are not parsed
+            lowered = attributes_html.lower()
+            if 'src' not in lowered and 'style' not in lowered:
+                continue
+            attributes = parse_attributes(attributes_html)
+            span = token.span()
+
+            if tag == 'img' and attributes.get('src') == placeholder_src:
+                placeholders.append({
+                    'type': 'img',
+                    'span': span,
+                    'attributes': attributes,
+                    'description': attributes.get('alt', '')
+                })
+            elif 'style' in attributes:
+                for match in _STYLE_BACKGROUND_IMAGE_PATTERN.finditer(attributes['style']):
+                    if match.group(1).strip() == placeholder_src:
+                        placeholders.append({
+                            'type': 'style',
+                            'span': span,
+                            'attributes': attributes,
+                            'description': attributes.get('data-description', ''),
+                            'style_attribute': attributes['style']
+                        })
+                        break
+        return placeholders
+
+    def _scan_css(self, token, placeholder_src):
+        css_content = token.group('raw_content')
+        offset = token.start('raw_content')
+        for match in _CSS_BACKGROUND_IMAGE_PATTERN.finditer(css_content):
+            url, comment = match.groups()
+            if url.strip() != placeholder_src:
+                continue
+            # The rule around the placeholder tells how large the background is displayed
+            rule_start = css_content.rfind('{', 0, match.start())
+            rule_end = css_content.find('}', match.end())
+            yield {
+                'type': 'css',
+                'span': (offset + match.start(1), offset + match.end(1)),
+                'block_span': token.span(),
+                'description': comment.strip(),
+                'url': url,
+                'selector': css_content[css_content.rfind('}', 0, rule_start) + 1:rule_start].strip() if rule_start >= 0 else '',
+                'rule': css_content[rule_start + 1:rule_end if rule_end >= 0 else len(css_content)]
+            }
+
+    def get_text(self, span: tuple) -> str:
+        """
+        Returns the current text of a span of the original page, with the edits inside it applied.
+
+        Args:
+        span (tuple): The (start, end) offsets in the original page.
+
+        Returns:
+        str: The current text of the span.
+        """
+        if span in self._edits:
+            return self._edits[span]
+        return self.render(*span)
+
+    def replace(self, span: tuple, text: str):
+        """
+        Replaces a span of the original page. Replacing the same span again overrides the earlier edit,
+        and edits must not partially overlap.
+
+        Args:
+        span (tuple): The (start, end) offsets in the original page.
+        text (str): The replacement text.
+        """
+        self._edits[span] = text
+
+    def insert(self, position: int, text: str):
+        """
+        Inserts text at an offset of the original page, after any text inserted there before.
+
+        Args:
+        position (int): The offset in the original page.
+        text (str): The text to insert.
+        """
+        span = (position, position)
+        self._edits[span] = self._edits.get(span, "") + text
+
+    def render(self, start: int = 0, end: int = None) -> str:
+        """
+        Renders the page, or a part of it, with all edits applied. Text inserted at the start or end of a part
+        belongs to the text around it, so it is left out unless the part reaches the start or end of the page.
+
+        Args:
+        start (int): The offset in the original page to start at.
+        end (int): The offset in the original page to end at, defaults to the end of the page.
+
+        Returns:
+        str: The edited HTML.
+        """
+        end = len(self.html) if end is None else end
+        parts = []
+        position = start
+        for (edit_start, edit_end), text in sorted(self._edits.items()):
+            if edit_start < start or edit_end > end or edit_start < position:
+                continue
+            if edit_start == edit_end and (0 < edit_start == start or edit_end == end < len(self.html)):
+                continue
+            parts.append(self.html[position:edit_start])
+            parts.append(text)
+            position = edit_end
+        parts.append(self.html[position:end])
+        return "".join(parts)
+
+def first_start_tag(html_content: str) -> str:
+    """
+    Returns the first start tag of an HTML fragment.
+
+    Args:
+    html_content (str): The HTML fragment.
+
+    Returns:
+    str: The start tag, or None if the fragment has none.
+    """
+    for token in _TOKEN_PATTERN.finditer(html_content):
+        if token.group('tag'):
+            return token.group(0)
+    return None
@@ -0,0 +1,120 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+# Compares finding and replacing the image placeholders of generated pages of 100 KB to 1 MB with
+# PlaceholderPage against BeautifulSoup's html.parser, which ImagePopulator used before. Each page
+# is scanned once and re-rendered after every replacement, as ImagePopulator commits every image.
+# BeautifulSoup is only needed for the comparison: pip install beautifulsoup4
+
+import os
+import re
+import sys
+import time
+
+rel_path = os.path.join(os.path.dirname(__file__), "../")
+sys.path.append(os.path.abspath(rel_path))
+
+from placeholder_scanner import PlaceholderPage, set_attributes
+
+PLACEHOLDER_SRC = "/img/loading_gradient.gif"
+PAGE_SIZES_KB = (100, 250, 500, 1000)
+# One placeholder per this many bytes of page, like a long landing page
+PLACEHOLDER_EVERY_BYTES = 4000
+REPEATS = 3
+
+def make_page(size_bytes):
+    css_rules = "\n".join(
+        f".section-{i} {{ height: 60vh; background-image: url('{PLACEHOLDER_SRC}'); /* Background of section {i} */ }}"
+        for i in range(5)
+    )
+    parts = [f"<!DOCTYPE html><html><head><title>Benchmark</title><style>{css_rules}</style></head><body>"]
+    length = len(parts[0])
+    i = 0
+    while length < size_bytes:
+        if i % 4 == 0:
+            block = f'<div class="hero" data-description="Hero {i}" style="color: #333; background-image: url(\'{PLACEHOLDER_SRC}\');"><h2>Section {i}</h2></div>'
+        else:
+            block = f'<section class="card"><h3>Card {i}</h3><img src="{PLACEHOLDER_SRC}" alt="Picture number {i}" class="card-image"/>'
+        filler = "".join(f'<p class="copy">Paragraph {j} of block {i} with <a href="#link-{j}">a link</a> and <strong>some</strong> text.</p>' for j in range(PLACEHOLDER_EVERY_BYTES // 110))
+        block += filler + ("</section>" if i % 4 else "")
+        parts.append(block)
+        length += len(block)
+        i += 1
+    parts.append("</body></html>")
+    return "".join(parts)
+
+def scan_beautifulsoup(page):
+    from bs4 import BeautifulSoup
+    css_pattern = re.compile(r'background-image\s*:\s*url\([\'"]?(.+?)[\'"]?\);\s*/\*(.*?)\*/', re.DOTALL)
+    style_pattern = re.compile(r'background-image\s*:\s*url\([\'"]?(.+?)[\'"]?\)\s*;?')
+
+    soup = BeautifulSoup(page, 'html.parser')
+    placeholders = [('img', tag) for tag in soup.find_all('img', src=PLACEHOLDER_SRC)]
+    placeholders += [('style', tag) for tag in soup.find_all(style=True) if any(m.strip() == PLACEHOLDER_SRC for m in style_pattern.findall(tag['style']))]
+    placeholders += [('css', tag) for tag in soup.find_all('style') if tag.string and css_pattern.search(tag.string)]
+    return soup, placeholders
+
+def run_beautifulsoup(page):
+    soup, placeholders = scan_beautifulsoup(page)
+    for i, (placeholder_type, tag) in enumerate(placeholders):
+        if placeholder_type == 'img':
+            tag['src'] = f"image_{i}.png"
+        elif placeholder_type == 'style':
+            tag['style'] = tag['style'].replace(PLACEHOLDER_SRC, f"image_{i}.png")
+        else:
+            tag.string.replace_with(tag.string.replace(PLACEHOLDER_SRC, f"image_{i}.png", 1))
+        html = str(soup)
+    return len(placeholders), html
+
+def scan_scanner(page):
+    document = PlaceholderPage(page)
+    return document, document.scan(PLACEHOLDER_SRC)
+
+def run_scanner(page):
+    document, placeholders = scan_scanner(page)
+
+    for i, placeholder in enumerate(placeholders):
+        if placeholder['type'] == 'img':
+            document.replace(placeholder['span'], set_attributes(document.get_text(placeholder['span']), {'src': f"image_{i}.png"}))
+        elif placeholder['type'] == 'style':
+            document.replace(placeholder['span'], set_attributes(document.get_text(placeholder['span']), {'style': placeholder['style_attribute'].replace(PLACEHOLDER_SRC, f"image_{i}.png")}))
+        else:
+            document.replace(placeholder['span'], f"image_{i}.png")
+        html = document.render()
+    return len(placeholders), html
+
+def best_of(function, page, repeats=REPEATS):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = function(page)
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+def main():
+    try:
+        import bs4  # noqa: F401
+        has_beautifulsoup = True
+    except ImportError:
+        has_beautifulsoup = False
+        print("BeautifulSoup is not installed, only timing PlaceholderPage.")
+
+    # 'scan' finds the placeholders, 'populate' also renders the page after each replacement
+    print(f"{'page':>8} {'placeholders':>13} {'scan':>10} {'bs4 scan':>10} {'populate':>10} {'bs4 populate':>13}")
+    for size_kb in PAGE_SIZES_KB:
+        page = make_page(size_kb * 1000)
+        scan_time, _ = best_of(scan_scanner, page)
+        populate_time, (count, html) = best_of(run_scanner, page)
+        assert PLACEHOLDER_SRC not in html, "PlaceholderPage left placeholders behind"
+        row = f"{size_kb:>6}KB {count:>13} {scan_time * 1000:>8.1f}ms"
+        if has_beautifulsoup:
+            soup_scan_time, _ = best_of(scan_beautifulsoup, page)
+            # Re-serializing the tree after every replacement is quadratic, one run is slow enough
+            soup_populate_time, _ = best_of(run_beautifulsoup, page, repeats=1)
+            row += f" {soup_scan_time * 1000:>8.1f}ms {populate_time * 1000:>8.1f}ms {soup_populate_time * 1000:>11.1f}ms"
+        else:
+            row += f" {'-':>10} {populate_time * 1000:>8.1f}ms {'-':>13}"
+        print(row)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+# Checks that journal entries left behind by a crash right after a snapshot replaced the previous one are not
+# replayed onto the new snapshot: python -m pytest test_scripts/test_agent_journal.py
+
+import os
+import sys
+
+rel_path = os.path.join(os.path.dirname(__file__), "../")
+sys.path.append(os.path.abspath(rel_path))
+
+import pytest
+from agents import AzureOpenAIAgent, AgentJournal
+import agent_journal
+
+def make_agent():
+    return AzureOpenAIAgent(api_key="test-agent-journal", api_version="2024-02-01", base_url="https://example.invalid", system_message="You are a test agent.")
+
+def converse(agent, *prompts):
+    for prompt in prompts:
+        agent.add_prompt(prompt)
+        agent.messages.append({"role": "assistant", "content": f"Reply to {prompt}"})
+
+def test_stale_journal_entries_are_not_replayed_after_reset(tmp_path, monkeypatch):
+    path = str(tmp_path / "agents" / "orchestrator_agent.json")
+    agent = make_agent()
+    agent.save(path)
+    converse(agent, "first", "second")
+    agent.save(path)
+    assert os.path.exists(f"{path}.journal")
+
+    agent.reset()
+    converse(agent, "after reset")
+
+    # Crash after the new snapshot is in place but before the old journal is removed
+    def crash(_):
+        raise OSError("Simulated crash")
+    monkeypatch.setattr(agent_journal.os, "remove", crash)
+    with pytest.raises(OSError):
+        agent.save(path)
+    monkeypatch.undo()
+    assert os.path.exists(f"{path}.journal")
+
+    loaded = AzureOpenAIAgent.load(path)
+    assert [message["content"] for message in loaded.messages] == ["You are a test agent.", "after reset", "Reply to after reset"]
+
+    # The next save replaces the stale journal, and later turns are journaled and replayed as usual
+    converse(loaded, "third")
+    loaded.save(path)
+    converse(loaded, "fourth")
+    loaded.save(path)
+    reloaded = AzureOpenAIAgent.load(path)
+    assert reloaded.messages == loaded.messages
+
+def test_journal_without_generations_is_replayed(tmp_path):
+    # Snapshots and journals written before generations were introduced carry none
+    path = str(tmp_path / "agent.json")
+    agent = make_agent()
+    agent.save(path)
+    with open(path) as f:
+        state = f.read()
+    with open(path, "w") as f:
+        f.write(state.replace(', "journal_generation": "' + agent.journal.generation + '"', ""))
+    with open(f"{path}.journal", "w") as f:
+        f.write('{"op": "append", "index": 1, "message": {"role": "user", "content": "legacy"}}\n')
+
+    state, journal = AgentJournal.load(path)
+    assert [message["content"] for message in state["messages"]][-1] == "legacy"
+    assert not journal.needs_snapshot
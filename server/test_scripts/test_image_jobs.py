@@ -0,0 +1,118 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+# Checks how ImageJobQueue leases, requeues and gives up on jobs: python -m pytest test_scripts/test_image_jobs.py
+
+import os
+import sys
+
+rel_path = os.path.join(os.path.dirname(__file__), "../")
+sys.path.append(os.path.abspath(rel_path))
+
+import pytest
+import image_jobs
+from image_jobs import ImageJobQueue, QUEUED, RUNNING, DONE, FAILED
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(image_jobs.time, "time", clock.time)
+    return clock
+
+@pytest.fixture
+def jobs(tmp_path, clock):
+    return ImageJobQueue(str(tmp_path / "jobs" / "image_jobs.db"), lease_seconds=60, max_attempts=2, max_backoff=10)
+
+def test_claim_leases_oldest_queued_job(jobs, clock):
+    jobs.enqueue("newer", requested=clock.now)
+    jobs.enqueue("older", requested=clock.now - 5)
+
+    job = jobs.claim("worker-a")
+    assert job['session_id'] == "older"
+    assert job['attempts'] == 1 and not job['resumed']
+    assert jobs.get_job("older")['lease_owner'] == "worker-a"
+    assert jobs.claim("worker-b")['session_id'] == "newer"
+    assert jobs.claim("worker-c") is None
+
+def test_expired_lease_is_claimed_again(jobs, clock):
+    jobs.enqueue("session")
+    job = jobs.claim("worker-a")
+
+    # A renewed lease keeps the job with its worker
+    clock.now += 50
+    assert jobs.renew(job, "worker-a")
+    clock.now += 50
+    assert jobs.claim("worker-b") is None
+
+    # Once the worker stops renewing, another one takes the job over
+    clock.now += 61
+    resumed = jobs.claim("worker-b")
+    assert resumed['session_id'] == "session"
+    assert resumed['attempts'] == 2 and resumed['resumed']
+    assert not jobs.renew(job, "worker-a")
+
+    # The first worker's late result is discarded
+    jobs.finish(job, "worker-a")
+    assert jobs.get_job("session")['state'] == RUNNING
+    jobs.finish(resumed, "worker-b")
+    assert jobs.get_job("session")['state'] == DONE
+
+def test_enqueue_during_run_requeues_job(jobs, clock):
+    jobs.enqueue("session")
+    job = jobs.claim("worker-a")
+
+    # A new page while the job runs does not start a second run
+    jobs.enqueue("session")
+    assert jobs.get_job("session")['state'] == RUNNING
+    assert jobs.claim("worker-b") is None
+
+    # The run ends with the older generation, so the job goes back to the queue for the newer page
+    jobs.finish(job, "worker-a")
+    current = jobs.get_job("session")
+    assert current['state'] == QUEUED
+    assert current['attempts'] == 0 and current['lease_owner'] is None
+
+    rerun = jobs.claim("worker-b")
+    assert rerun['generation'] == job['generation'] + 1
+    assert rerun['attempts'] == 1
+    jobs.finish(rerun, "worker-b")
+    assert jobs.get_job("session")['state'] == DONE
+
+def test_failed_runs_are_retried_until_max_attempts(jobs, clock):
+    jobs.enqueue("session")
+    job = jobs.claim("worker-a")
+    jobs.finish(job, "worker-a", RuntimeError("Image service unavailable"))
+
+    # The retry waits out its backoff
+    retried = jobs.get_job("session")
+    assert retried['state'] == QUEUED and retried['error'] == "Image service unavailable"
+    assert jobs.claim("worker-a") is None
+    clock.now = retried['available_at']
+
+    job = jobs.claim("worker-a")
+    assert job['attempts'] == 2
+    jobs.finish(job, "worker-a", RuntimeError("Image service unavailable"))
+    assert jobs.get_job("session")['state'] == FAILED
+    assert not jobs.is_pending("session")
+    clock.now += 3600
+    assert jobs.claim("worker-a") is None
+
+def test_expired_lease_at_max_attempts_fails_job(jobs, clock):
+    jobs.enqueue("crashing")
+    jobs.claim("worker-a")
+    clock.now += 61
+    assert jobs.claim("worker-b")['attempts'] == 2
+
+    # The second worker dies as well, so the job is given up on instead of being claimed a third time
+    jobs.enqueue("healthy")
+    clock.now += 61
+    assert jobs.claim("worker-c")['session_id'] == "healthy"
+    failed = jobs.get_job("crashing")
+    assert failed['state'] == FAILED and failed['error'] == "Lease expired"
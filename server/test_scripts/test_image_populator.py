@@ -0,0 +1,95 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+# Checks that an image run still going when a new prompt replaces index.html stops instead of writing its page
+# over the new one. Runs offline with stand-in agents: python -m pytest test_scripts/test_image_populator.py
+
+import asyncio
+import base64
+import os
+import sys
+
+rel_path = os.path.join(os.path.dirname(__file__), "../")
+sys.path.append(os.path.abspath(rel_path))
+
+import pytest
+from agents.transport import synthetic_png
+from image_populator import ImagePopulator, PageReplaced, PLACEHOLDER_SRC, write_atomic
+
+PAGE_A = f"""<html><head></head><body>
+<img src="{PLACEHOLDER_SRC}" alt="A lighthouse at dusk">
+<img src="{PLACEHOLDER_SRC}" alt="A harbor full of sailboats">
+</body></html>"""
+PAGE_B = f"""<html><head></head><body>
+<h1>The new page</h1>
+<img src="{PLACEHOLDER_SRC}" alt="A field of sunflowers">
+</body></html>"""
+
+class PromptAgent:
+    async def asend_prompt(self, description):
+        return f"A photo of {description}"
+
+    def save(self, filepath):
+        pass
+
+class ImageAgent:
+    def __init__(self, held_prompt):
+        # The request for this prompt is held until the test releases it
+        self.held_prompt = held_prompt
+        self.held = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def agenerate_image(self, image_prompt, size, response_format, quality):
+        if self.held_prompt and self.held_prompt in image_prompt:
+            self.held.set()
+            await self.release.wait()
+        return base64.b64encode(synthetic_png(4, 4, image_prompt)).decode("ascii")
+
+    def save(self, filepath):
+        pass
+
+@pytest.fixture
+def html_path(tmp_path):
+    template_dir = tmp_path / "template"
+    template_dir.mkdir()
+    path = str(template_dir / "index.html")
+    write_atomic(path, PAGE_A)
+    return path
+
+def make_populator(html_path, image_agent):
+    agents = {"image_prompt_agent": PromptAgent(), "image_gen_agent": image_agent}
+    return ImagePopulator(html_path, os.path.join(os.path.dirname(html_path), "img"), "test-image-populator", agents,
+                          batch_prompts=False, image_response_format="b64_json", infer_sizes=False)
+
+def read(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+def test_run_stops_when_page_is_replaced(html_path):
+    async def run():
+        image_agent = ImageAgent("sailboats")
+        populator = make_populator(html_path, image_agent)
+        task = asyncio.ensure_future(populator.aprocess())
+
+        # The lighthouse is committed while the sailboats are still being generated
+        await image_agent.held.wait()
+        while PLACEHOLDER_SRC + '" alt="A lighthouse' in read(html_path):
+            await asyncio.sleep(0.01)
+
+        # A new prompt replaces the page, then the held image arrives
+        write_atomic(html_path, PAGE_B)
+        image_agent.release.set()
+        with pytest.raises(PageReplaced):
+            await task
+
+    asyncio.run(run())
+    assert read(html_path) == PAGE_B
+
+def test_next_run_populates_the_new_page(html_path):
+    write_atomic(html_path, PAGE_B)
+    image_agent = ImageAgent(None)
+    image_agent.release.set()
+    asyncio.run(make_populator(html_path, image_agent).aprocess())
+
+    page = read(html_path)
+    assert "The new page" in page and PLACEHOLDER_SRC not in page
@@ -0,0 +1,92 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+# Checks which image placeholders PlaceholderPage finds and that edits are spliced into the original page:
+# python -m pytest test_scripts/test_placeholder_scanner.py
+
+import os
+import sys
+
+rel_path = os.path.join(os.path.dirname(__file__), "../")
+sys.path.append(os.path.abspath(rel_path))
+
+import pytest
+from placeholder_scanner import PlaceholderPage, set_attributes, first_start_tag
+
+PLACEHOLDER_SRC = "/img/loading_gradient.gif"
+
+def scan(html_content):
+    page = PlaceholderPage(html_content)
+    return page, page.scan(PLACEHOLDER_SRC)
+
+def test_placeholders_in_comments_and_scripts_are_skipped():
+    page, placeholders = scan(f"""<html><body>
+<!-- <img src="{PLACEHOLDER_SRC}" alt="Commented out"> -->
+<script>document.body.innerHTML += '<img src="{PLACEHOLDER_SRC}" alt="Added by a script">';</script>
+<img src="{PLACEHOLDER_SRC}" alt="Visible">
+</body></html>""")
+    assert [placeholder['description'] for placeholder in placeholders] == ["Visible"]
+
+def test_greater_than_inside_quoted_attributes():
+    html_content = f'<div title="a > b"><img alt=\'x > y\' src="{PLACEHOLDER_SRC}" data-note="1 > 0"></div>'
+    page, placeholders = scan(html_content)
+    assert len(placeholders) == 1
+    placeholder = placeholders[0]
+    assert placeholder['description'] == "x > y"
+    assert html_content[slice(*placeholder['span'])] == f'<img alt=\'x > y\' src="{PLACEHOLDER_SRC}" data-note="1 > 0">'
+
+def test_uppercase_and_unquoted_attributes():
+    page, placeholders = scan(f'<IMG SRC={PLACEHOLDER_SRC} ALT="Upper case" Class=hero>')
+    assert len(placeholders) == 1
+    assert placeholders[0]['type'] == 'img'
+    assert placeholders[0]['attributes'] == {"src": PLACEHOLDER_SRC, "alt": "Upper case", "class": "hero"}
+
+def test_entity_escaped_style_url():
+    page, placeholders = scan(f'<div data-description="Banner &amp; logo" style="background-image: url(&quot;{PLACEHOLDER_SRC}&quot;);">Hi</div>')
+    assert len(placeholders) == 1
+    assert placeholders[0]['type'] == 'style'
+    assert placeholders[0]['description'] == "Banner & logo"
+    assert placeholders[0]['style_attribute'] == f'background-image: url("{PLACEHOLDER_SRC}");'
+
+def test_css_rules_with_description_comments():
+    html_content = f"""<html><head><style>
+.hero {{ height: 400px; background-image: url('{PLACEHOLDER_SRC}'); /* A mountain lake at dawn */ }}
+.plain {{ background-image: url('{PLACEHOLDER_SRC}'); }}
+.footer {{ background-image: url("{PLACEHOLDER_SRC}");/*Footer texture*/ }}
+</style></head><body></body></html>"""
+    page, placeholders = scan(html_content)
+    assert [placeholder['description'] for placeholder in placeholders] == ["A mountain lake at dawn", "Footer texture"]
+    assert [placeholder['selector'] for placeholder in placeholders] == [".hero", ".footer"]
+    assert "height: 400px" in placeholders[0]['rule']
+    assert all(html_content[slice(*placeholder['span'])] == PLACEHOLDER_SRC for placeholder in placeholders)
+    assert all(html_content[slice(*placeholder['block_span'])].startswith("<style>") for placeholder in placeholders)
+
+def test_render_after_several_edits():
+    html_content = f"""<html><head><style>.hero {{ background-image: url('{PLACEHOLDER_SRC}'); /* Hero */ }}</style></head>
+<body><img src="{PLACEHOLDER_SRC}" alt="First"><p>Text</p><img src="{PLACEHOLDER_SRC}" alt="Second" /></body></html>"""
+    page, placeholders = scan(html_content)
+    css, first, second = placeholders
+    assert page.head_end == html_content.index("<head>") + len("<head>")
+
+    page.replace(first['span'], set_attributes(page.get_text(first['span']), {"src": "/a.png", "width": 100}))
+    page.replace(css['span'], "/hero.png")
+    page.insert(page.head_end, '<link rel="preload" href="/hero.png">')
+    page.insert(page.head_end, '<link rel="preload" href="/a.png">')
+    page.replace(second['span'], set_attributes(page.get_text(second['span']), {"src": "/b.png"}))
+    # Replacing a span again overrides the earlier edit
+    page.replace(first['span'], set_attributes(page.get_text(first['span']), {"src": "/c.png"}))
+
+    assert page.render() == f"""<html><head><link rel="preload" href="/hero.png"><link rel="preload" href="/a.png"><style>.hero {{ background-image: url('/hero.png'); /* Hero */ }}</style></head>
+<body><img src="/c.png" alt="First" width="100"><p>Text</p><img src="/b.png" alt="Second" /></body></html>"""
+    assert page.render(*css['block_span']) == "<style>.hero { background-image: url('/hero.png'); /* Hero */ }</style>"
+    # The original page is kept, so offsets stay valid
+    assert page.html == html_content
+
+def test_set_attributes():
+    assert set_attributes('<IMG SRC=a.gif alt="Say &quot;hi&quot;"/>', {"src": 'b "1".png', "loading": "lazy"}) == '<IMG src="b &quot;1&quot;.png" alt="Say &quot;hi&quot;" loading="lazy" />'
+    with pytest.raises(ValueError):
+        set_attributes("<!-- not a tag -->", {"src": "a.png"})
+
+def test_first_start_tag():
+    assert first_start_tag('<!-- <img src="x"> --><picture><img src="y"></picture>') == "<picture>"
+    assert first_start_tag("plain text") is None
@@ -0,0 +1,43 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+# Checks that a JSON mode reply which is not a JSON object leaves the history as it was, so the prompt can be
+# sent again as a plain prompt. Runs offline against the synthesize transport: python -m pytest test_scripts/test_structured_reply.py
+
+import asyncio
+import os
+import sys
+
+rel_path = os.path.join(os.path.dirname(__file__), "../")
+sys.path.append(os.path.abspath(rel_path))
+
+import pytest
+from agents import AzureOpenAIAgent, MalformedResponseError, client_registry
+from agents.transport import SyntheticTransport
+
+class PlainTextTransport(SyntheticTransport):
+    # Answers JSON mode requests with the plain reply, like a model ignoring the response format
+    def _chat_response(self, payload):
+        return super()._chat_response(dict(payload, response_format=None))
+
+@pytest.fixture
+def agent():
+    client_registry.set_transport_factory(lambda limits, is_async: PlainTextTransport("http://127.0.0.1:0"))
+    try:
+        # A key of its own gives the agent clients created with the transport above
+        yield AzureOpenAIAgent(api_key="test-structured-reply", api_version="2024-02-01", base_url="https://example.invalid", system_message="You are an orchestrator.")
+    finally:
+        client_registry.set_transport_factory(None)
+
+def test_malformed_json_reply_rolls_back_prompt(agent):
+    async def converse():
+        with pytest.raises(MalformedResponseError):
+            await agent.asend_json_prompt("Build me a bakery website", instructions="Reply with a JSON object.")
+        assert [message["role"] for message in agent.messages] == ["system"]
+
+        # The fallback sends the same prompt as a plain prompt
+        reply = await agent.asend_prompt("Build me a bakery website")
+        assert "choices" in reply
+
+    asyncio.run(converse())
+    assert [message["role"] for message in agent.messages] == ["system", "user", "assistant"]